@@ -1,3 +1,4 @@
 from . import bus_call
 from . import setup_logging
 from . import utils
+from . import gst_buffer
@@ -0,0 +1,261 @@
+"""
+Uploads finished recording segments and snapshots to blob storage.
+
+Files are queued in sqlite, so pending uploads survive a restart. `concurrency` worker threads upload them;
+the azure backend also splits large files into blocks sent in parallel. Failures are retried with jittered
+exponential backoff.
+
+Backends:
+- "azure": azure-storage-blob, e.g. against Azurite with connection_string="UseDevelopmentStorage=true"
+- "filesystem": copies blobs under a local directory, a stand-in for tests and development
+"""
+
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import threading
+from time import sleep, time
+
+try:
+    from azure.storage.blob import BlobServiceClient
+except ImportError:
+    BlobServiceClient = None
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+class FilesystemBackend(object):
+    def __init__(self, conf):
+        self.root = conf.get("root", "/tmp/blob_storage")
+        os.makedirs(self.root, exist_ok=True)
+
+    def upload(self, path, blob_name):
+        destination = os.path.join(self.root, blob_name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # never expose a partial blob
+        partial = f"{destination}.partial"
+        shutil.copyfile(path, partial)
+        os.replace(partial, destination)
+
+
+class AzureBlobBackend(object):
+    def __init__(self, conf):
+        if BlobServiceClient is None:
+            logger.error("[AzureBlobBackend] azure-storage-blob is not installed")
+            raise RuntimeError
+        # files above max_single_put_size are uploaded as blocks of max_block_size, max_concurrency at a time
+        service = BlobServiceClient.from_connection_string(
+            conf["connection_string"],
+            max_block_size=conf.get("max_block_size", 4 * 1024 ** 2),
+            max_single_put_size=conf.get("max_single_put_size", 8 * 1024 ** 2))
+        self.container = service.get_container_client(conf.get("container", "oakd"))
+        self.max_concurrency = conf.get("max_concurrency", 4)
+        if not self.container.exists():
+            self.container.create_container()
+
+    def upload(self, path, blob_name):
+        with open(path, 'rb') as f:
+            self.container.upload_blob(blob_name, f, overwrite=True, max_concurrency=self.max_concurrency)
+
+
+def create_upload_backend(conf):
+    if conf["type"] == "azure":
+        return AzureBlobBackend(conf)
+    elif conf["type"] == "filesystem":
+        return FilesystemBackend(conf)
+    logger.error(f"[create_upload_backend] Invalid upload backend type ({conf['type']})")
+    raise RuntimeError
+
+
+class UploadQueue(object):
+    """
+    Persistent upload queue, one row per file: pending -> uploading -> done | failed, or dropped when the file
+    was deleted (recording quota) before it could be uploaded
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                         "path TEXT PRIMARY KEY, blob_name TEXT NOT NULL, state TEXT NOT NULL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, "
+                         "last_error TEXT, created REAL NOT NULL)")
+        # uploads interrupted by a restart start over
+        self._db.execute("UPDATE uploads SET state='pending' WHERE state='uploading'")
+
+    def add(self, path, blob_name):
+        now = time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads (path, blob_name, state, attempts, next_attempt, created) "
+                             "VALUES (?, ?, 'pending', 0, ?, ?)", (path, blob_name, now, now))
+
+    def claim(self):
+        """
+        @return: (path, blob_name, attempts) of the oldest due pending upload, now marked uploading, or None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path, blob_name, attempts FROM uploads "
+                                   "WHERE state='pending' AND next_attempt <= ? "
+                                   "ORDER BY created LIMIT 1", (time(),)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE uploads SET state='uploading' WHERE path=?", (row[0],))
+            return row
+
+    # the outcome of an upload only applies while it is still uploading (not dropped meanwhile)
+    def done(self, path):
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state='done', last_error=NULL WHERE path=? AND state='uploading'",
+                             (path,))
+
+    def retry(self, path, attempts, next_attempt, error):
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state='pending', attempts=?, next_attempt=?, last_error=? "
+                             "WHERE path=? AND state='uploading'", (attempts, next_attempt, error, path))
+
+    def fail(self, path, attempts, error):
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state='failed', attempts=?, last_error=? "
+                             "WHERE path=? AND state='uploading'", (attempts, error, path))
+
+    def drop(self, path, reason):
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state='dropped', last_error=? "
+                             "WHERE path=? AND state IN ('pending', 'uploading')", (reason, path))
+
+    def is_pending(self, path):
+        """ @return: True while `path` is waiting for or in the middle of an upload """
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM uploads WHERE path=? AND state IN ('pending', 'uploading')",
+                                   (path,)).fetchone()
+        return row is not None
+
+    def in_flight(self):
+        """ @return: number of uploads running or due now (pending ones waiting for a retry are not counted) """
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM uploads WHERE state='uploading' "
+                                    "OR (state='pending' AND next_attempt <= ?)", (time(),)).fetchone()[0]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM uploads GROUP BY state").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class BlobUploader(object):
+    """
+    enqueue(path) is cheap and thread safe: it is meant to be the on_written/on_recorded callback of the
+    snapshot writer and the recorders.
+    """
+
+    def __init__(self, conf):
+        self.backend = create_upload_backend(conf["backend"])
+        self.queue = UploadQueue(conf.get("queue_path", "/gstreamer/logs/upload_queue.sqlite"))
+        # blob names are <prefix>/<path relative to the first matching root>
+        self.prefix = conf.get("prefix", "")
+        self.roots = conf.get("roots", [])
+        self.max_attempts = conf.get("max_attempts", 10)
+        self.backoff = conf.get("backoff_seconds", 2)
+        self.max_backoff = conf.get("max_backoff_seconds", 300)
+        self.delete_after_upload = conf.get("delete_after_upload", False)
+
+        self.run_flag = True
+        self.uploaded_bytes = 0
+        self._wakeup = threading.Event()
+        self._threads = [threading.Thread(target=self.work, name=f"blob_uploader_{i}", daemon=True)
+                         for i in range(conf.get("concurrency", 2))]
+        for thread in self._threads:
+            thread.start()
+
+    def blob_name(self, path):
+        name = os.path.basename(path)
+        for root in self.roots:
+            relative = os.path.relpath(path, root)
+            if not relative.startswith(os.pardir):
+                name = relative
+                break
+        return "/".join(part for part in (self.prefix, name.replace(os.sep, "/")) if part)
+
+    def enqueue(self, path):
+        self.queue.add(path, self.blob_name(path))
+        self._wakeup.set()
+
+    def is_pending(self, path):
+        """ the recording quota keeps files that are not uploaded yet """
+        return self.queue.is_pending(path)
+
+    def drop(self, path):
+        """ `path` was deleted before it could be uploaded (recording quota over its hard limit) """
+        logger.warning(f"[BlobUploader.drop] ({path}) was deleted before its upload, dropped from the queue")
+        self.queue.drop(path, "deleted by the recording quota")
+
+    def next_attempt(self, attempts):
+        # jittered, so uploads failing together do not retry together
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return time() + delay * random.uniform(0.5, 1.5)
+
+    def work(self):
+        _log_prefix = "[BlobUploader.work]\n-- "
+        while self.run_flag:
+            item = self.queue.claim()
+            if item is None:
+                self._wakeup.wait(timeout=1)
+                self._wakeup.clear()
+                continue
+            path, blob_name, attempts = item
+            attempts += 1
+            try:
+                size = os.path.getsize(path)
+                self.backend.upload(path, blob_name)
+            except FileNotFoundError:
+                # evicted by the recording quota (or removed) before it could be uploaded
+                logger.warning(f"{_log_prefix} ({path}) no longer exists")
+                self.queue.fail(path, attempts, "file not found")
+                continue
+            except Exception as UploadError:
+                if attempts >= self.max_attempts:
+                    logger.error(f"{_log_prefix} Giving up on ({path}) after {attempts} attempts: {UploadError}")
+                    self.queue.fail(path, attempts, str(UploadError))
+                else:
+                    logger.warning(f"{_log_prefix} Upload of ({path}) failed (attempt {attempts}): {UploadError}")
+                    self.queue.retry(path, attempts, self.next_attempt(attempts), str(UploadError))
+                continue
+            self.uploaded_bytes += size
+            self.queue.done(path)
+            logger.info(f"{_log_prefix} Uploaded ({path}) -> ({blob_name})")
+            if self.delete_after_upload:
+                try:
+                    os.remove(path)
+                except OSError as err:
+                    logger.warning(f"{_log_prefix} Could not delete ({path}): {err}")
+
+    def stats(self):
+        return {"uploaded_bytes": self.uploaded_bytes, **self.queue.counts()}
+
+    def stop(self, drain_timeout=0, join_timeout=5):
+        """
+        drain_timeout: seconds to wait for due uploads to finish before stopping the workers
+        join_timeout: seconds to wait for each worker after that, a hung upload is abandoned (it is retried
+        after the next start)
+        """
+        _log_prefix = "[BlobUploader.stop]\n-- "
+        deadline = time() + drain_timeout
+        while time() < deadline and self.queue.in_flight():
+            sleep(0.5)
+        self.run_flag = False
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(join_timeout)
+        if any(thread.is_alive() for thread in self._threads):
+            # the queue stays open for the stuck worker, the daemon thread goes away with the process
+            logger.warning(f"{_log_prefix} Uploads still running after {join_timeout}s, leaving them behind")
+            return
+        self.queue.close()
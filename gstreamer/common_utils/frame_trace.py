@@ -0,0 +1,130 @@
+"""
+Per-frame stage tracing from the device to the RTP payloader.
+
+Frames are identified by (stream_id, depthai sequence number). Inside GStreamer the buffer pts is used
+to find the frame again, SensorFactory binds pts -> sequence number when it pushes the frame.
+Timestamps are CLOCK_MONOTONIC nanoseconds, the clock depthai uses for device timestamps on the host.
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+from time import monotonic_ns
+
+from gstreamer.common_utils.stage_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# order of the stages a frame goes through, latency of a stage is measured from the previous marked stage
+STAGES = ("capture", "dequeue", "processed", "push", "encoded", "payloaded")
+
+
+class FrameTracer(object):
+
+    def __init__(self, max_frames=5000):
+        self.max_frames = max_frames
+        self._lock = threading.Lock()
+        # (stream_id, seq) -> {stage: t_ns}, frames still moving through the pipeline
+        self._active = OrderedDict()
+        # (stream_id, pts) -> seq
+        self._pts = {}
+        # finished (or evicted) frames kept for export
+        self._done = deque(maxlen=max_frames)
+        # (stream_id, stage) -> LatencyHistogram
+        self._histograms = {}
+
+    def mark(self, stream_id, seq, stage, t_ns=None):
+        if t_ns is None:
+            t_ns = monotonic_ns()
+        key = (stream_id, seq)
+        with self._lock:
+            frame = self._active.get(key)
+            if frame is None:
+                frame = self._active[key] = {"stages": {}, "pts": None}
+                if len(self._active) > self.max_frames:
+                    self._retire(next(iter(self._active)))
+            if stage in frame["stages"]:
+                # e.g. every RTP packet of a frame carries its pts, only the first one counts
+                return
+            previous = [frame["stages"][s] for s in STAGES if s in frame["stages"]]
+            frame["stages"][stage] = t_ns
+            if previous:
+                histogram = self._histograms.get((stream_id, stage))
+                if histogram is None:
+                    histogram = self._histograms[(stream_id, stage)] = LatencyHistogram()
+                histogram.add(t_ns - previous[-1])
+            if stage == STAGES[-1]:
+                self._retire(key)
+
+    def _retire(self, key):
+        frame = self._active.pop(key)
+        if frame["pts"] is not None:
+            self._pts.pop((key[0], frame["pts"]), None)
+        self._done.append((key, frame["stages"]))
+
+    def bind_pts(self, stream_id, seq, pts):
+        with self._lock:
+            frame = self._active.get((stream_id, seq))
+            if frame is None:
+                return
+            frame["pts"] = pts
+            self._pts[(stream_id, pts)] = seq
+
+    def mark_pts(self, stream_id, pts, stage, t_ns=None):
+        with self._lock:
+            seq = self._pts.get((stream_id, pts))
+        if seq is not None:
+            self.mark(stream_id, seq, stage, t_ns)
+
+    def histograms(self):
+        """
+        @return: {stream_id: {stage: histogram summary}}
+        """
+        with self._lock:
+            summary = {}
+            for (stream_id, stage), histogram in self._histograms.items():
+                summary.setdefault(stream_id, {})[stage] = histogram.summary()
+            return summary
+
+    def latencies(self, first_stage, last_stage):
+        """
+        @return: {stream_id: [ns from first_stage to last_stage]} for frames that have both marks
+        """
+        with self._lock:
+            frames = list(self._done) + [(key, dict(frame["stages"])) for key, frame in self._active.items()]
+        result = {}
+        for (stream_id, _), stages in frames:
+            if first_stage in stages and last_stage in stages:
+                result.setdefault(stream_id, []).append(stages[last_stage] - stages[first_stage])
+        return result
+
+    def chrome_trace(self):
+        """
+        @return: trace in the Chrome trace event format (chrome://tracing, ui.perfetto.dev),
+                 one track per stream and one span per stage
+        """
+        with self._lock:
+            frames = list(self._done) + [(key, dict(frame["stages"])) for key, frame in self._active.items()]
+
+        streams = sorted({key[0] for key, _ in frames})
+        tids = {stream_id: i + 1 for i, stream_id in enumerate(streams)}
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": stream_id}}
+                  for stream_id, tid in tids.items()]
+        for (stream_id, seq), stages in frames:
+            marks = [(stage, stages[stage]) for stage in STAGES if stage in stages]
+            for (_, start), (stage, end) in zip(marks, marks[1:]):
+                events.append({
+                    "name": stage, "ph": "X", "pid": 1, "tid": tids[stream_id],
+                    "ts": start / 1e3, "dur": (end - start) / 1e3, "args": {"seq": seq},
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path):
+        _log_prefix = "[FrameTracer.export]\n-- "
+        try:
+            with open(path, 'w', encoding="UTF-8") as f:
+                json.dump({**self.chrome_trace(), "histograms": self.histograms()}, f)
+            logger.info(f"{_log_prefix} Saved frame trace: {path}")
+        except Exception as err:
+            logger.error(f"{_log_prefix} Error writing frame trace ({path}): {err}")
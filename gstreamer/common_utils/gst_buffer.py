@@ -0,0 +1,320 @@
+"""
+Helpers for moving NumPy frames into and out of GStreamer without copying them.
+
+The PyGObject API (tobytes -> Gst.Buffer.new_allocate -> fill) copies every frame twice.
+Here the ndarray memory is wrapped directly with gst_buffer_new_wrapped_full() through ctypes,
+and the array is kept alive until GStreamer frees the buffer.
+
+The other way (Gst.Buffer.extract_dup / map in PyGObject copy the data), MappedBuffer maps a buffer with
+gst_buffer_map() and exposes the mapped memory as an ndarray until it is released.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import itertools
+import logging
+import threading
+
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo
+
+logger = logging.getLogger(__name__)
+
+# GST_MEMORY_FLAG_READONLY: downstream elements copy the memory before writing into it
+GST_MEMORY_FLAG_READONLY = 1 << 1
+GST_MAP_READ = 1 << 0
+
+_GDestroyNotify = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+
+
+class _GstMiniObject(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_size_t),
+        ("refcount", ctypes.c_int),
+        ("lockstate", ctypes.c_int),
+        ("flags", ctypes.c_uint),
+        ("copy", ctypes.c_void_p),
+        ("dispose", ctypes.c_void_p),
+        ("free", ctypes.c_void_p),
+        ("priv_uint", ctypes.c_uint),
+        ("priv_pointer", ctypes.c_void_p),
+    ]
+
+
+class _GstBuffer(ctypes.Structure):
+    _fields_ = [
+        ("mini_object", _GstMiniObject),
+        ("pool", ctypes.c_void_p),
+        ("pts", ctypes.c_uint64),
+        ("dts", ctypes.c_uint64),
+        ("duration", ctypes.c_uint64),
+        ("offset", ctypes.c_uint64),
+        ("offset_end", ctypes.c_uint64),
+    ]
+
+
+class _GstMapInfo(ctypes.Structure):
+    _fields_ = [
+        ("memory", ctypes.c_void_p),
+        ("flags", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("size", ctypes.c_size_t),
+        ("maxsize", ctypes.c_size_t),
+        ("user_data", ctypes.c_void_p * 4),
+        ("_gst_reserved", ctypes.c_void_p * 4),
+    ]
+
+
+def _load_library(name, soname):
+    path = ctypes.util.find_library(name) or soname
+    try:
+        return ctypes.CDLL(path)
+    except OSError as err:
+        logger.warning(f"[gst_buffer] Unable to load {path}, zero-copy push is disabled: {err}")
+        return None
+
+
+_libgst = _load_library("gstreamer-1.0", "libgstreamer-1.0.so.0")
+_libgstapp = _load_library("gstapp-1.0", "libgstapp-1.0.so.0")
+
+if _libgst is not None:
+    _libgst.gst_buffer_new_wrapped_full.restype = ctypes.c_void_p
+    _libgst.gst_buffer_new_wrapped_full.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_size_t, ctypes.c_size_t,
+        ctypes.c_void_p, _GDestroyNotify
+    ]
+    _libgst.gst_buffer_map.restype = ctypes.c_int
+    _libgst.gst_buffer_map.argtypes = [ctypes.c_void_p, ctypes.POINTER(_GstMapInfo), ctypes.c_int]
+    _libgst.gst_buffer_unmap.restype = None
+    _libgst.gst_buffer_unmap.argtypes = [ctypes.c_void_p, ctypes.POINTER(_GstMapInfo)]
+    _libgst.gst_object_get_name.restype = ctypes.c_char_p
+    _libgst.gst_object_get_name.argtypes = [ctypes.c_void_p]
+if _libgstapp is not None:
+    _libgstapp.gst_app_src_push_buffer.restype = ctypes.c_int
+    _libgstapp.gst_app_src_push_buffer.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+# Arrays currently owned by GStreamer, keyed by the user_data handed to the destroy notify
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_keys = itertools.count(1)
+
+
+@_GDestroyNotify
+def _release_array(user_data):
+    with _in_flight_lock:
+        entry = _in_flight.pop(user_data, None)
+    if entry is not None and entry[1] is not None:
+        entry[1]()
+
+
+_PyCapsule_GetPointer = ctypes.pythonapi.PyCapsule_GetPointer
+_PyCapsule_GetPointer.restype = ctypes.c_void_p
+_PyCapsule_GetPointer.argtypes = [ctypes.py_object, ctypes.c_char_p]
+
+# result of _check_pointers(), run once before the first zero-copy or map use
+_pointers_checked = None
+
+
+def zero_copy_available():
+    return _libgst is not None and _libgstapp is not None and _check_pointers()
+
+
+def map_available():
+    return _libgst is not None and _check_pointers()
+
+
+def gobject_pointer(obj):
+    """
+    Address of the C instance wrapped by a PyGObject object: the __gpointer__ capsule of GObjects, the hash of
+    wrappers without one (boxed types such as Gst.Buffer hash by their pointer). Both are checked against
+    known instances by _check_pointers().
+    """
+    capsule = getattr(obj, "__gpointer__", None)
+    if capsule is not None:
+        return ctypes.c_void_p(_PyCapsule_GetPointer(capsule, None))
+    return ctypes.c_void_p(hash(obj))
+
+
+def _check_pointers():
+    """
+    @return: True if gobject_pointer() resolves a Gst.Object and a Gst.Buffer to their C instances, checked
+    by reading their name and pts back through the C structures
+    """
+    global _pointers_checked
+    if _pointers_checked is not None:
+        return _pointers_checked
+    try:
+        if not Gst.is_initialized():
+            Gst.init(None)
+        element = Gst.Bin.new("gobject_pointer_check")
+        buf = Gst.Buffer.new()
+        buf.pts = 0x1234567
+        _pointers_checked = _libgst.gst_object_get_name(gobject_pointer(element)) == b"gobject_pointer_check" \
+            and _GstBuffer.from_address(gobject_pointer(buf).value).pts == 0x1234567
+    except Exception as CheckError:
+        logger.error(f"[gst_buffer] Could not check PyGObject instance pointers: {CheckError}")
+        _pointers_checked = False
+    if not _pointers_checked:
+        logger.error("[gst_buffer] PyGObject instance pointers do not match, zero-copy push and map are disabled")
+    return _pointers_checked
+
+
+def in_flight_count():
+    with _in_flight_lock:
+        return len(_in_flight)
+
+
+def _set_timing(buf_ptr, pts, duration, offset):
+    meta = _GstBuffer.from_address(buf_ptr)
+    meta.pts = meta.dts = pts
+    meta.duration = duration
+    meta.offset = Gst.BUFFER_OFFSET_NONE if offset is None else offset
+
+
+def push_ndarray(appsrc, frame, pts, duration, offset=None, on_release=None):
+    """
+    Push `frame` into `appsrc` by wrapping its memory in a GstBuffer (no copy).
+    `on_release` is called once GStreamer has released the buffer.
+    @return: (Gst.FlowReturn, bytes copied on the host)
+    """
+    copied = 0
+    if not frame.flags['C_CONTIGUOUS']:
+        frame = np.ascontiguousarray(frame)
+        copied = frame.nbytes
+
+    key = next(_keys)
+    with _in_flight_lock:
+        _in_flight[key] = (frame, on_release)
+
+    buf_ptr = _libgst.gst_buffer_new_wrapped_full(
+        GST_MEMORY_FLAG_READONLY, frame.ctypes.data, frame.nbytes, 0, frame.nbytes, key, _release_array)
+    if not buf_ptr:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+        logger.error("[push_ndarray] gst_buffer_new_wrapped_full returned NULL")
+        raise RuntimeError
+
+    _set_timing(buf_ptr, pts, duration, offset)
+    # gst_app_src_push_buffer takes ownership of the buffer, ctypes drops the GIL while it blocks
+    ret = _libgstapp.gst_app_src_push_buffer(gobject_pointer(appsrc), buf_ptr)
+    return Gst.FlowReturn(ret), copied
+
+
+def push_copy(appsrc, frame, pts, duration, offset=None):
+    """
+    Legacy push path: frame.tobytes() then Gst.Buffer.fill(), i.e. two full frame copies.
+    @return: (Gst.FlowReturn, bytes copied on the host)
+    """
+    data = frame.tobytes()
+    buf = Gst.Buffer.new_allocate(None, len(data), None)
+    buf.fill(0, data)
+    buf.pts = buf.dts = pts
+    buf.duration = duration
+    buf.offset = Gst.BUFFER_OFFSET_NONE if offset is None else offset
+    ret = appsrc.emit('push-buffer', buf)
+    return ret, 2 * len(data)
+
+
+class MappedBuffer(object):
+    """
+    A Gst.Buffer mapped for reading, `data` is a flat uint8 ndarray over the mapped memory (no copy).
+    The buffer is referenced until release() (or the end of a with block), the arrays handed out must not be
+    used after that: copy() what has to be kept.
+    """
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._info = _GstMapInfo()
+        if not _libgst.gst_buffer_map(gobject_pointer(buf), ctypes.byref(self._info), GST_MAP_READ):
+            self._buf = None
+            logger.error("[MappedBuffer] gst_buffer_map failed")
+            raise RuntimeError
+        self.data = np.frombuffer((ctypes.c_uint8 * self._info.size).from_address(self._info.data), dtype=np.uint8)
+        self.data.flags.writeable = False
+
+    def release(self):
+        if self._buf is None:
+            return
+        self.data = None
+        _libgst.gst_buffer_unmap(gobject_pointer(self._buf), ctypes.byref(self._info))
+        self._buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+def video_frame_view(data, caps):
+    """
+    View the mapped memory of a raw video buffer as a frame: (h, w, channels) for packed RGB formats (row
+    padding is skipped through the strides), (h, w) for GRAY8, (h * 3 // 2, w) for unpadded NV12/I420.
+    """
+    info = GstVideo.VideoInfo()
+    if not info.from_caps(caps):
+        logger.error(f"[video_frame_view] Not raw video caps: {caps.to_string()}")
+        raise RuntimeError
+    fmt = info.finfo.name
+    width, height, stride = info.width, info.height, info.stride[0]
+    if fmt in ("NV12", "I420"):
+        if stride != width or data.size < width * height * 3 // 2:
+            logger.error(f"[video_frame_view] Padded {fmt} planes are not supported ({width}x{height})")
+            raise RuntimeError
+        return data[:width * height * 3 // 2].reshape(height * 3 // 2, width)
+    channels = {"GRAY8": 1, "BGR": 3, "RGB": 3, "BGRx": 4, "RGBx": 4, "BGRA": 4, "RGBA": 4}.get(fmt)
+    if channels is None:
+        logger.error(f"[video_frame_view] Unsupported format ({fmt})")
+        raise RuntimeError
+    shape, strides = (height, width, channels), (stride, channels, 1)
+    if channels == 1:
+        shape, strides = (height, width), (stride, 1)
+    return np.lib.stride_tricks.as_strided(data, shape=shape, strides=strides, writeable=False)
+
+
+class FramePool(object):
+    """
+    Ring of preallocated frames. A frame is written in place (e.g. cv2.resize(..., dst=frame)),
+    pushed without copying, and returns to the ring once GStreamer releases its buffer.
+    """
+
+    def __init__(self, shape, size=4, dtype=np.uint8):
+        assert size > 0
+        self.shape = tuple(shape)
+        self.frames = [np.empty(self.shape, dtype=dtype) for _ in range(size)]
+        self.exhausted = 0
+        self._free = collections.deque(range(size))
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        @return: (index, frame), or (None, None) while every frame is still owned by GStreamer
+        """
+        with self._lock:
+            if not self._free:
+                self.exhausted += 1
+                return None, None
+            index = self._free.popleft()
+        return index, self.frames[index]
+
+    def release(self, index):
+        with self._lock:
+            # a frame given back twice (e.g. by a failed delivery after push() released it) stays listed once
+            if index not in self._free:
+                self._free.append(index)
+
+    def free_count(self):
+        with self._lock:
+            return len(self._free)
+
+    def push(self, appsrc, index, pts, duration, offset=None):
+        return push_ndarray(appsrc, self.frames[index], pts, duration, offset,
+                            on_release=lambda: self.release(index))
@@ -0,0 +1,116 @@
+"""
+Per-frame metadata carried in-band in the H.264 stream, as a user_data_unregistered SEI message
+(payload type 5) inserted in every access unit before its first slice:
+
+    uuid (16 bytes) | version (u8) | seq_num (u64) | capture wall clock time in ns (u64), big endian
+
+The server writes it (SensorFactory), clients read it back (RtspClient) to get the camera sequence number
+and the end-to-end latency of every frame. Latency across hosts is only as good as their clock sync (NTP/PTP).
+"""
+
+import struct
+import uuid
+
+FRAME_META_UUID = uuid.uuid5(uuid.NAMESPACE_URL, "https://github.com/SuperElectron/oakd_gstreamer/frame_meta").bytes
+FRAME_META_VERSION = 1
+_FRAME_META = struct.Struct(">BQQ")
+
+NAL_SEI = 6
+SEI_USER_DATA_UNREGISTERED = 5
+# the first access unit of x264 carries a long SEI with its settings, slices follow well within this
+HEAD_BYTES = 4096
+
+
+def _escape(rbsp):
+    """ emulation prevention: no 00 00 0x (x <= 3) sequence may appear inside a NAL unit """
+    out = bytearray()
+    zeros = 0
+    for byte in rbsp:
+        if zeros >= 2 and byte <= 3:
+            out.append(3)
+            zeros = 0
+        out.append(byte)
+        zeros = zeros + 1 if byte == 0 else 0
+    return bytes(out)
+
+
+def _unescape(ebsp):
+    return ebsp.replace(b"\x00\x00\x03", b"\x00\x00")
+
+
+def _sei_value(value):
+    # payload type and size are coded as a run of 0xff bytes plus the remainder
+    return b"\xff" * (value // 255) + bytes([value % 255])
+
+
+def frame_meta_nal(seq_num, capture_ns):
+    """
+    @return: an Annex B SEI NAL unit (with a 4 byte start code) carrying `seq_num` and `capture_ns`
+    """
+    payload = FRAME_META_UUID + _FRAME_META.pack(FRAME_META_VERSION, seq_num & (2 ** 64 - 1), capture_ns)
+    rbsp = _sei_value(SEI_USER_DATA_UNREGISTERED) + _sei_value(len(payload)) + payload + b"\x80"
+    return b"\x00\x00\x00\x01" + bytes([NAL_SEI]) + _escape(rbsp)
+
+
+def nal_units(data):
+    """
+    Walk the NAL units of an Annex B byte stream.
+    @return: generator of (offset of the start code, nal type, start of the nal header)
+    """
+    i = data.find(b"\x00\x00\x01")
+    while 0 <= i < len(data) - 3:
+        start = i - 1 if i > 0 and data[i - 1] == 0 else i
+        yield start, data[i + 3] & 0x1f, i + 3
+        i = data.find(b"\x00\x00\x01", i + 3)
+
+
+def vcl_offset(data):
+    """
+    @return: offset of the start code of the first slice (VCL nal types 1-5) in `data`, or None
+    """
+    for start, nal_type, _ in nal_units(data):
+        if 1 <= nal_type <= 5:
+            return start
+    return None
+
+
+def _parse_sei(rbsp):
+    i = 0
+    while i < len(rbsp) and rbsp[i] != 0x80:
+        values = []
+        for _ in range(2):
+            value = 0
+            while i < len(rbsp) and rbsp[i] == 0xff:
+                value += 255
+                i += 1
+            if i >= len(rbsp):
+                return None
+            values.append(value + rbsp[i])
+            i += 1
+        payload_type, size = values
+        payload = rbsp[i:i + size]
+        i += size
+        if payload_type == SEI_USER_DATA_UNREGISTERED and payload[:16] == FRAME_META_UUID \
+                and len(payload) >= 16 + _FRAME_META.size:
+            version, seq_num, capture_ns = _FRAME_META.unpack_from(payload, 16)
+            if version == FRAME_META_VERSION:
+                return seq_num, capture_ns
+    return None
+
+
+def parse_frame_meta(data):
+    """
+    Look for the frame metadata SEI in the head of an access unit (the NAL units before its first slice).
+    @return: (seq_num, capture_ns) or None
+    """
+    units = list(nal_units(data))
+    for index, (_, nal_type, header) in enumerate(units):
+        if 1 <= nal_type <= 5:
+            break
+        if nal_type != NAL_SEI:
+            continue
+        end = units[index + 1][0] if index + 1 < len(units) else len(data)
+        meta = _parse_sei(_unescape(data[header + 1:end]))
+        if meta is not None:
+            return meta
+    return None
@@ -0,0 +1,161 @@
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+from time import monotonic
+
+import cv2
+
+from gstreamer.common_utils import yuv
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+IMAGE_FORMATS = ("jpg", "png")
+
+
+class _RateLimit(object):
+    """ every_n: store one frame out of N, every_seconds: at most one frame per T seconds (0 disables either) """
+
+    def __init__(self, every_n=1, every_seconds=0):
+        self.every_n = max(every_n, 1)
+        self.every_seconds = every_seconds
+        self.seen = 0
+        self.last_time = None
+
+    def admit(self, now):
+        self.seen += 1
+        if (self.seen - 1) % self.every_n != 0:
+            return False
+        if self.every_seconds and self.last_time is not None and now - self.last_time < self.every_seconds:
+            return False
+        self.last_time = now
+        return True
+
+
+class SnapshotWriter(object):
+    """
+    Stores camera frames as images without blocking the capture thread: submit() rate limits per camera and
+    queues the frame, a pool of worker threads encodes (opencv releases the GIL) and writes it under
+    <directory>/<camera>/YYYY/MM/DD/HH/<camera>_<seq_num>_<HHMMSS.mmm>.<format>.
+    Frames submitted while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, directory="./logs/images", image_format="jpg", quality=90, workers=2, max_queue=16,
+                 every_n=1, every_seconds=0, cameras=None, on_written=None):
+        assert image_format in IMAGE_FORMATS
+        assert workers > 0
+        self.directory = directory
+        self.image_format = image_format
+        if image_format == "jpg":
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        else:
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        self.every_n = every_n
+        self.every_seconds = every_seconds
+        # camera name -> {"every_n": N, "every_seconds": T}, overrides the defaults above
+        self.cameras = cameras or {}
+        # called with the path of every image written, from a worker thread
+        self.on_written = on_written
+
+        self.written = {}
+        self.dropped = {}
+        self.failed = 0
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = [threading.Thread(target=self.work, name=f"snapshot_writer_{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @classmethod
+    def from_conf(cls, conf, on_written=None):
+        return cls(directory=conf.get("directory", "./logs/images"),
+                   image_format=conf.get("format", "jpg"),
+                   quality=conf.get("quality", 90),
+                   workers=conf.get("workers", 2),
+                   max_queue=conf.get("max_queue", 16),
+                   every_n=conf.get("every_n", 1),
+                   every_seconds=conf.get("every_seconds", 0),
+                   cameras=conf.get("cameras"),
+                   on_written=on_written)
+
+    def _limit(self, stream_id):
+        limit = self._limits.get(stream_id)
+        if limit is None:
+            limit = self._limits[stream_id] = self.rate_limit(stream_id)
+        return limit
+
+    def rate_limit(self, stream_id):
+        """
+        @return: a separate rate limiter with the settings of `stream_id`, for callers that decide in another
+        process (camera workers), their admitted frames are submitted with admitted=True
+        """
+        camera = self.cameras.get(stream_id, {})
+        return _RateLimit(camera.get("every_n", self.every_n), camera.get("every_seconds", self.every_seconds))
+
+    def admit(self, stream_id):
+        """
+        Counts a frame of `stream_id` against its rate limit, so callers can skip preparing rejected frames.
+        @return: True if the frame is to be stored (then submit it with admitted=True)
+        """
+        with self._lock:
+            return self._limit(stream_id).admit(monotonic())
+
+    def submit(self, stream_id, img, seq_num, frame_format="BGR", admitted=False):
+        """
+        Queue `img` if the camera's rate limit admits it (or admit() already did). The frame is copied, the
+        caller keeps ownership.
+        @return: True if the frame was queued
+        """
+        if not admitted and not self.admit(stream_id):
+            return False
+        try:
+            self._queue.put_nowait((stream_id, img.copy(), seq_num, frame_format, datetime.now()))
+        except queue.Full:
+            with self._lock:
+                self.dropped[stream_id] = self.dropped.get(stream_id, 0) + 1
+            return False
+        return True
+
+    def path(self, stream_id, seq_num, timestamp):
+        directory = os.path.join(self.directory, stream_id, timestamp.strftime("%Y/%m/%d/%H"))
+        filename = f"{stream_id}_{seq_num}_{timestamp.strftime('%H%M%S.%f')[:-3]}.{self.image_format}"
+        return directory, os.path.join(directory, filename)
+
+    def work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            stream_id, img, seq_num, frame_format, timestamp = item
+            directory, path = self.path(stream_id, seq_num, timestamp)
+            try:
+                ok, data = cv2.imencode(f".{self.image_format}", yuv.to_bgr(img, frame_format), self.params)
+                if not ok:
+                    raise RuntimeError("imencode failed")
+                os.makedirs(directory, exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data.tobytes())
+            except Exception as WriteError:
+                self.failed += 1
+                logger.error(f"[SnapshotWriter] Could not write ({path}): {WriteError}")
+                continue
+            with self._lock:
+                self.written[stream_id] = self.written.get(stream_id, 0) + 1
+            if self.on_written is not None:
+                self.on_written(path)
+
+    def stats(self):
+        with self._lock:
+            return {"written": dict(self.written), "dropped": dict(self.dropped), "failed": self.failed,
+                    "queued": self._queue.qsize()}
+
+    def stop(self):
+        """ writes the frames still queued, then stops the workers """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
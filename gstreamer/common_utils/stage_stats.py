@@ -0,0 +1,103 @@
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats(object):
+    """
+    Thread safe per-stage timing accumulator, e.g. stats.record("resize", 0.004)
+    """
+
+    def __init__(self, name="stages"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {"count": 0, "total": 0.0, "max": 0.0}
+            entry["count"] += 1
+            entry["total"] += seconds
+            if seconds > entry["max"]:
+                entry["max"] = seconds
+
+    @contextmanager
+    def measure(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - start)
+
+    def summary(self):
+        """
+        @return: {stage: {"count": int, "mean_ms": float, "max_ms": float}}
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "count": entry["count"],
+                    "mean_ms": round(1e3 * entry["total"] / entry["count"], 3),
+                    "max_ms": round(1e3 * entry["max"], 3),
+                }
+                for stage, entry in self._stages.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def log_summary(self, level=logging.INFO):
+        for stage, entry in self.summary().items():
+            logger.log(level, f"[{self.name}] {stage}: count={entry['count']} "
+                              f"mean={entry['mean_ms']}ms max={entry['max_ms']}ms")
+
+
+class LatencyHistogram(object):
+    """
+    Power-of-two bucketed latency histogram (bucket i counts latencies below 2**i microseconds)
+    """
+
+    def __init__(self, buckets=32):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def add(self, latency_ns):
+        latency_us = max(latency_ns, 0) / 1e3
+        bucket = min(int(latency_us).bit_length(), len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_us += latency_us
+        self.max_us = max(self.max_us, latency_us)
+
+    def percentile(self, fraction):
+        """
+        @return: upper bound (in ms) of the bucket holding the given fraction of samples
+        """
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return round((2 ** bucket) / 1e3, 3)
+        return round(self.max_us / 1e3, 3)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_us / self.count / 1e3, 3) if self.count else None,
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_us / 1e3, 3),
+            "buckets_us": {f"<{2 ** i}": c for i, c in enumerate(self.counts) if c},
+        }
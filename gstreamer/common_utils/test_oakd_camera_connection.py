@@ -3,6 +3,8 @@ import depthai as dai
 from pprint import pprint
 import logging
 from threading import Thread
+from gstreamer.src.server.devices import create_backend
+from gstreamer.common_utils.snapshot_writer import SnapshotWriter
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +21,10 @@ class CameraCapture(object):
         # Names of capture_av devices that are discovered via usb or poe connection
         self.camera_ids = {}
         self.set_configs(conf['capture_av'])
+        self.device_backend = create_backend(self.conf.get('device_backend'))
+        self.snapshots = None
+        if self.conf['store_img_enabled']:
+            self.snapshots = SnapshotWriter.from_conf(self.conf.get('snapshots', {}))
         # Create a list of available cameras to use
         self.probe_cameras()
         self.t_camera = Thread(target=self.run, daemon=True)
@@ -60,10 +66,8 @@ class CameraCapture(object):
     def probe_cameras(self):
         _log_prefix = "[probe_cameras]\n --"
 
-        counter = 0
-        for device in dai.Device.getAllAvailableDevices():
-            cam_id = device.getMxId()
-            self.camera_ids[cam_id] = "available"
+        for descriptor in self.device_backend.list_devices():
+            self.camera_ids[descriptor.mxid] = "available"
         logging.info(f"{_log_prefix} Cameras available: {self.camera_ids}")
 
     def send_frames(self, stream_id, img, seq_num):
@@ -72,26 +76,34 @@ class CameraCapture(object):
         resized = cv2.resize(img, (self.conf['frame_resize']['width'], self.conf['frame_resize']['height']),
                              interpolation=cv2.INTER_AREA)
 
-        if self.conf['store_img_enabled']:
-            filename = f"./logs/images/src{stream_id}_{seq_num}.png"
-            cv2.imwrite(filename, img)
+        if self.snapshots is not None:
+            self.snapshots.submit(stream_id, img, seq_num)
 
         if seq_num == 0 or seq_num % 100 == 0:
             logger.info(f"{_log_prefix} src=({stream_id}) count=({seq_num})")
 
-    def run(self):
-        _log_prefix = "[run]\n --"
-
+    @staticmethod
+    def create_pipeline():
         pipeline = dai.Pipeline()
         camRgb = pipeline.createColorCamera()
         xoutRgb = pipeline.createXLinkOut()
         xoutRgb.setStreamName("rgb")
         camRgb.preview.link(xoutRgb.input)
+        return pipeline
+
+    def run(self):
+        _log_prefix = "[run]\n --"
 
-        device_info = dai.DeviceInfo(CAMERA_ID)
+        descriptors = [d for d in self.device_backend.list_devices() if d.mxid == CAMERA_ID]
+        if not descriptors:
+            # no camera with CAMERA_ID (e.g. simulated backend), use the first one found
+            descriptors = self.device_backend.list_devices()[:1]
+        if not descriptors:
+            logging.error(f"{_log_prefix} No camera available")
+            raise RuntimeError
         # device_info.state = dai.XLinkDeviceState.X_LINK_FLASH_BOOTED
 
-        with dai.Device(pipeline, device_info) as device:
+        with self.device_backend.open(descriptors[0], self.create_pipeline) as device:
             q = device.getOutputQueue(name="rgb", maxSize=4, blocking=False)
             logging.debug(f"{_log_prefix} Reading from the queue")
             while True:
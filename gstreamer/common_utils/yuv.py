@@ -0,0 +1,91 @@
+"""
+Helpers for 4:2:0 frames kept in their native layout, a single uint8 array of shape (height * 3 // 2, width):
+
+- NV12: Y plane, then interleaved UV at half resolution (OAK-D ColorCamera video output)
+- I420: Y plane, then the U and V planes at half resolution
+"""
+
+import cv2
+import numpy as np
+
+YUV_FORMATS = ("NV12", "I420")
+FRAME_FORMATS = ("BGR",) + YUV_FORMATS
+
+
+def frame_shape(frame_format, width, height):
+    if frame_format == "BGR":
+        return height, width, 3
+    return height * 3 // 2, width
+
+
+def frame_bytes(frame_format, width, height):
+    return int(np.prod(frame_shape(frame_format, width, height)))
+
+
+def frame_size(frame, frame_format):
+    """
+    @return: (width, height) of the picture held by `frame`
+    """
+    if frame_format == "BGR":
+        return frame.shape[1], frame.shape[0]
+    return frame.shape[1], frame.shape[0] * 2 // 3
+
+
+def _planes(frame, frame_format, width, height):
+    """ views on the planes of a yuv frame, each one shaped as an image opencv can resize """
+    y = frame[:height]
+    if frame_format == "NV12":
+        return [y, frame[height:].reshape(height // 2, width // 2, 2)]
+    chroma = frame[height:].reshape(-1)
+    quarter = (height // 2) * (width // 2)
+    return [y, chroma[:quarter].reshape(height // 2, width // 2), chroma[quarter:].reshape(height // 2, width // 2)]
+
+
+def resize(frame, frame_format, width, height, dst=None, interpolation=cv2.INTER_AREA):
+    """
+    Resize a BGR or YUV frame, plane by plane for YUV so it never goes through BGR.
+    Writes into `dst` when it has the output shape.
+    """
+    if frame_format == "BGR":
+        return cv2.resize(frame, (width, height), dst=dst, interpolation=interpolation)
+    if dst is None or dst.shape != frame_shape(frame_format, width, height):
+        dst = np.empty(frame_shape(frame_format, width, height), dtype=np.uint8)
+    src_width, src_height = frame_size(frame, frame_format)
+    for src_plane, dst_plane in zip(_planes(frame, frame_format, src_width, src_height),
+                                    _planes(dst, frame_format, width, height)):
+        cv2.resize(src_plane, (dst_plane.shape[1], dst_plane.shape[0]), dst=dst_plane, interpolation=interpolation)
+    return dst
+
+
+def from_bgr(img, frame_format):
+    if frame_format == "BGR":
+        return img
+    i420 = cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420)
+    if frame_format == "I420":
+        return i420
+    height, width = img.shape[:2]
+    nv12 = np.empty_like(i420)
+    y, u, v = _planes(i420, "I420", width, height)
+    nv12[:height] = y
+    uv = _planes(nv12, "NV12", width, height)[1]
+    uv[..., 0] = u
+    uv[..., 1] = v
+    return nv12
+
+
+def nv12_to_i420(frame):
+    width, height = frame_size(frame, "NV12")
+    i420 = np.empty_like(frame)
+    i420[:height] = frame[:height]
+    _, u, v = _planes(i420, "I420", width, height)
+    uv = _planes(frame, "NV12", width, height)[1]
+    u[...] = uv[..., 0]
+    v[...] = uv[..., 1]
+    return i420
+
+
+def to_bgr(frame, frame_format):
+    if frame_format == "BGR":
+        return frame
+    code = cv2.COLOR_YUV2BGR_NV12 if frame_format == "NV12" else cv2.COLOR_YUV2BGR_I420
+    return cv2.cvtColor(frame, code)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Compare the legacy copying push path against the zero-copy push path.
+
+    python3 gstreamer/src/benchmark/push_copy_bench.py --width 1920 --height 1080 --frames 300
+"""
+
+import argparse
+import json
+import logging
+from time import perf_counter
+
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from gstreamer.common_utils.gst_buffer import push_ndarray, push_copy, zero_copy_available, in_flight_count
+
+logger = logging.getLogger(__name__)
+
+
+def create_sink_pipeline(width, height, fps):
+    # no encoder, so the measurement isolates the host side of the push
+    caps = f"video/x-raw,format=BGR,width=(int){width},height=(int){height},framerate=(fraction){fps}/1"
+    launch_string = f"appsrc name=source is-live=true format=time caps={caps} ! fakesink sync=false"
+    pipeline = Gst.parse_launch(launch_string)
+    return pipeline, pipeline.get_by_name("source")
+
+
+def run_mode(mode, frames, width, height, fps):
+    pipeline, source = create_sink_pipeline(width, height, fps)
+    pipeline.set_state(Gst.State.PLAYING)
+    duration = int(Gst.SECOND / fps)
+    frame = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+
+    copied = 0
+    start = perf_counter()
+    for n in range(frames):
+        if mode == "zero_copy":
+            _, c = push_ndarray(source, frame, n * duration, duration, n)
+        else:
+            _, c = push_copy(source, frame, n * duration, duration, n)
+        copied += c
+    elapsed = perf_counter() - start
+
+    source.emit("end-of-stream")
+    pipeline.get_bus().timed_pop_filtered(5 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+
+    return {
+        "mode": mode,
+        "frames": frames,
+        "frame_bytes": frame.nbytes,
+        "bytes_copied_per_frame": copied / frames,
+        "us_per_frame": 1e6 * elapsed / frames,
+        "buffers_in_flight_after_eos": in_flight_count() if mode == "zero_copy" else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--output", default=None, help="optional path for the json results")
+    args = parser.parse_args()
+
+    Gst.init(None)
+    modes = ["copy", "zero_copy"] if zero_copy_available() else ["copy"]
+    results = [run_mode(mode, args.frames, args.width, args.height, args.fps) for mode in modes]
+
+    for r in results:
+        print(f"{r['mode']:>10}: {r['bytes_copied_per_frame'] / 1e6:8.2f} MB copied/frame, "
+              f"{r['us_per_frame']:9.1f} us/frame")
+    if args.output:
+        with open(args.output, 'w', encoding="UTF-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
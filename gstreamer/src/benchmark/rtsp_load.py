@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Headless rtsp load generator: opens a growing number of concurrent RtspClient sessions in one process, on one
+shared GLib main loop, and reports how many viewers the server sustains before frames drop.
+
+    python3 gstreamer/src/benchmark/rtsp_load.py --local --steps 1,2,4,8,16,32     # against a local GstServer
+    python3 gstreamer/src/benchmark/rtsp_load.py --url rtsp://192.168.1.10:8554/camera1 --steps 4,8 --transport tcp
+    python3 gstreamer/src/benchmark/rtsp_load.py --local --decode                   # include client side decoding
+
+Every step adds sessions up to the step count, waits --settle seconds, then measures --hold seconds. A session
+keeps up when it receives at least --min-ratio of --fps frames per second without stalls (gaps over --stall-ms);
+the fan-out capacity is the last step before the first one where any session falls behind.
+
+--local starts a GstServer fed with synthetic frames (as in server_bench.py), sessions are spread over its
+--cameras mounts. Results are printed and saved as json (with the git commit).
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from time import sleep
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+from gstreamer.src.benchmark.server_bench import (create_config, create_frames, current_rss_mb, feed_camera,
+                                                  git_commit, percentile)
+from gstreamer.src.client.rtsp_client import RtspClient
+from gstreamer.src.server.oakd_capture import CameraPipeline
+
+logger = logging.getLogger(__name__)
+
+
+def start_local_server(args):
+    """
+    @return: (CameraPipeline, urls, stop event), synthetic frames are fed until the event is set
+    """
+    args.duration = len(args.steps) * (args.settle + args.hold) + 10
+    app = CameraPipeline(create_config(args))
+    for stream_id, device_id in app.conf['cameras'].items():
+        app.router.bind(device_id)
+    app.gst_app.thread.start()
+    frames = create_frames(args)
+    stop = threading.Event()
+    for name in app.conf['cameras']:
+        threading.Thread(target=feed_camera, args=(app, name, frames, args.format, args.fps, args.duration, stop),
+                         name=f"feeder_{name}", daemon=True).start()
+    return app, [f"rtsp://127.0.0.1:{args.port}/{name}" for name in app.conf['cameras']], stop
+
+
+def create_session(args, url, index, loop):
+    conf = {
+        "name": f"session{index}",
+        "url": url,
+        "sink": "fakesink",
+        # frames are counted as they arrive, not when they would be displayed
+        "sync": False,
+        "decode": args.decode,
+        "transport": args.transport,
+        "latency": args.latency,
+        "stall_ms": args.stall_ms,
+        # a refused or reset session is a fan-out failure, reported as an error rather than reconnected
+        "reconnect": {"enabled": False},
+        "debug_dot": False,
+    }
+    session = RtspClient(conf=conf, loop=loop)
+    session.start()
+    return session
+
+
+def measure_step(args, sessions):
+    for session in sessions:
+        session.reset_stats()
+    sleep(args.hold)
+    stats = [session.stats() for session in sessions]
+    fps = [s["fps"] for s in stats]
+    behind = [i for i, s in enumerate(stats) if s["fps"] < args.min_ratio * args.fps or s["stalls"] or s["error"]]
+    return {
+        "sessions": len(sessions),
+        "keeping_up": len(sessions) - len(behind),
+        "ok": not behind,
+        "fps": {p: percentile(fps, f) for p, f in (("min", 0.0), ("p50", 0.5), ("max", 1.0))},
+        "aggregate_fps": round(sum(fps), 2),
+        "jitter_ms_p90": percentile([s["jitter_ms"] for s in stats], 0.9),
+        "max_gap_ms": max(s["max_gap_ms"] for s in stats),
+        "stalls": sum(s["stalls"] for s in stats),
+        # capture to client latency, from the server's frame metadata SEI
+        "latency_ms_p90": percentile([s["latency_ms"]["p90"] for s in stats if s["latency_ms"]], 0.9),
+        "lost_frames": sum(s["lost_frames"] for s in stats),
+        "errors": sorted({s["error"] for s in stats if s["error"]}),
+        "per_session": stats,
+    }
+
+
+def run(args):
+    loop = GLib.MainLoop()
+    loop_thread = threading.Thread(target=loop.run, name="rtsp_load_loop", daemon=True)
+    loop_thread.start()
+
+    app, stop = None, None
+    if args.local:
+        app, urls, stop = start_local_server(args)
+        sleep(1)
+    else:
+        urls = [args.url]
+
+    sessions = []
+    steps = []
+    capacity = 0
+    try:
+        for count in args.steps:
+            while len(sessions) < count:
+                sessions.append(create_session(args, urls[len(sessions) % len(urls)], len(sessions), loop))
+            sleep(args.settle)
+            step = measure_step(args, sessions)
+            if app is not None:
+                step["server"] = app.gst_app.stats()
+            steps.append(step)
+            print(f"  {count} sessions: {step['keeping_up']} keeping up, fps {step['fps']}, "
+                  f"jitter p90 {step['jitter_ms_p90']} ms, stalls {step['stalls']}, "
+                  f"latency p90 {step['latency_ms_p90']} ms, lost {step['lost_frames']}")
+            if not step["ok"]:
+                break
+            capacity = count
+    finally:
+        for session in sessions:
+            session.stop()
+        if stop is not None:
+            stop.set()
+            app.processor.stop()
+            app.gst_app.stop()
+        loop.quit()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "config": vars(args),
+        "urls": urls,
+        "capacity_sessions": capacity,
+        "rss_mb": round(current_rss_mb(), 1),
+        "steps": steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="rtsp url every session pulls")
+    target.add_argument("--local", action="store_true", help="start a local server with synthetic cameras")
+    parser.add_argument("--steps", type=lambda v: [int(n) for n in v.split(",")], default=[1, 2, 4, 8, 16],
+                        help="comma separated session counts")
+    parser.add_argument("--settle", type=float, default=3, help="seconds between opening sessions and measuring")
+    parser.add_argument("--hold", type=float, default=10, help="measured seconds per step")
+    parser.add_argument("--transport", default=None, choices=["udp", "tcp"], help="default: rtspsrc negotiates")
+    parser.add_argument("--latency", type=int, default=None, help="rtspsrc jitterbuffer latency (ms)")
+    parser.add_argument("--decode", action="store_true", help="decode with avdec_h264 in every session")
+    parser.add_argument("--fps", type=int, default=30, help="stream fps, and the rate fed to a --local server")
+    parser.add_argument("--min-ratio", type=float, default=0.95, help="fraction of --fps a session has to receive")
+    parser.add_argument("--stall-ms", type=float, default=500)
+    # --local server
+    parser.add_argument("--cameras", type=int, default=1)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--format", default="NV12", choices=["BGR", "NV12", "I420"])
+    parser.add_argument("--port", type=int, default=8601)
+    parser.add_argument("--output", default=None, help="json results path")
+    args = parser.parse_args()
+    # the rest of server_bench's synthetic camera settings
+    args.src_width = args.src_height = None
+    args.workers, args.policy, args.pattern = 4, "drop-oldest", "gradient"
+
+    logging.basicConfig(level=logging.WARNING)
+    Gst.init(None)
+    print(f"target={'local' if args.local else args.url} transport={args.transport} decode={args.decode}")
+    results = run(args)
+    print(f"  fan-out capacity: {results['capacity_sessions']} sessions at >= {args.min_ratio * args.fps} fps")
+
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    output = args.output or f"/gstreamer/logs/bench/rtsp_load-{results['commit']}-{stamp}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding="UTF-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"  saved {output}")
+
+
+if __name__ == "__main__":
+    main()
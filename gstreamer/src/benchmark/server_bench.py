@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Drive the server hot path (CameraPipeline.send_frames -> SensorFactory.push -> x264enc) with synthetic cameras.
+
+    python3 gstreamer/src/benchmark/server_bench.py --cameras 2 --width 1920 --height 1080 --fps 30 --duration 30
+    python3 gstreamer/src/benchmark/server_bench.py --cameras 4 --rtsp-client   # also pull every mount over rtsp
+    python3 gstreamer/src/benchmark/server_bench.py --format NV12   # compare cpu_percent_per_camera with BGR
+
+Synthetic frames are NV12 like the OAK-D video output and go through CameraPipeline.read_frame,
+so --format BGR includes the host colour conversion a real camera costs.
+
+Results are printed and saved as json (with the git commit) so runs can be compared across commits.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import threading
+from datetime import datetime
+from time import monotonic, perf_counter, process_time, sleep
+
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from gstreamer.common_utils import yuv
+from gstreamer.src.server.devices import SimulatedFrame
+from gstreamer.src.server.oakd_capture import CameraPipeline
+
+logger = logging.getLogger(__name__)
+
+
+def create_config(args):
+    cameras = {f"camera{i + 1}": f"SYNTHETIC{i + 1}" for i in range(args.cameras)}
+    pipeline_conf = [
+        {
+            "name": name,
+            "fps": args.fps,
+            "width": args.width,
+            "height": args.height,
+            "source": {"type": "oakd", "format": args.format},
+            "backpressure": {"policy": args.policy, "max_buffers": 2, "max_bytes": 0},
+            # encode from the start, with or without rtsp clients
+            "on_demand": False,
+            "extension": f"/{name}",
+        }
+        for name in cameras
+    ]
+    return {
+        "camera": {
+            "camera_caps": {"resolution": "1080p", "color_order": "BGR", "fps": str(args.fps)},
+            "frame_resize": {"width": args.width, "height": args.height},
+            "cameras": cameras,
+            "store_img_enabled": False,
+            "gst_enabled": True,
+            "connection": "usb",
+            "timezone": "UTC",
+            "trace": {"enabled": True, "max_frames": args.cameras * args.fps * (args.duration + 5)},
+            "processing": {"workers": args.workers, "max_pending": 8, "report_interval": 3600},
+        },
+        "rtsp": {"ip_address": "127.0.0.1", "port": str(args.port), "pipeline_conf": pipeline_conf},
+    }
+
+
+def create_frames(args, count=8):
+    """ a few distinct NV12 frames, so the encoder does not see a static image """
+    height, width = args.src_height or args.height, args.src_width or args.width
+    if args.pattern == "noise":
+        return [yuv.from_bgr(np.random.randint(0, 255, (height, width, 3), dtype=np.uint8), "NV12")
+                for _ in range(count)]
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frames = []
+    for i in range(count):
+        shift = 255 * i / count
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (x + shift) % 256
+        frame[..., 1] = (y + shift) % 256
+        frame[..., 2] = (x + y + shift) % 256
+        frames.append(yuv.from_bgr(frame, "NV12"))
+    return frames
+
+
+def feed_camera(app, stream_id, frames, frame_format, fps, duration, stop):
+    """ paced like a camera at `fps`, fps=0 pushes as fast as the pipeline accepts """
+    interval = 1 / fps if fps else 0
+    start = perf_counter()
+    seq_num = 0
+    while not stop.is_set() and perf_counter() - start < duration:
+        video = SimulatedFrame(frames[seq_num % len(frames)].copy(), seq_num, None)
+        app.tracer.mark(stream_id, seq_num, "dequeue")
+        app.send_frames(stream_id, app.read_frame(video, frame_format), seq_num)
+        seq_num += 1
+        if interval:
+            delay = start + seq_num * interval - perf_counter()
+            if delay > 0:
+                sleep(delay)
+    return seq_num
+
+
+def create_rtsp_client(url):
+    pipeline = Gst.parse_launch(f"rtspsrc location={url} latency=0 ! rtph264depay ! fakesink name=sink sync=false")
+    pipeline.set_state(Gst.State.PLAYING)
+    return pipeline
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    app = CameraPipeline(create_config(args))
+    for stream_id, device_id in app.conf['cameras'].items():
+        app.router.bind(device_id)
+    app.gst_app.thread.start()
+
+    clients = []
+    if args.rtsp_client:
+        clients = [create_rtsp_client(f"rtsp://127.0.0.1:{args.port}/{name}") for name in app.conf['cameras']]
+        sleep(2)
+
+    frames = create_frames(args)
+    stop = threading.Event()
+    sent = {}
+
+    def feeder(name):
+        sent[name] = feed_camera(app, name, frames, args.format, args.fps, args.duration, stop)
+
+    cpu_start, wall_start = process_time(), monotonic()
+    feeders = [threading.Thread(target=feeder, args=(name,), daemon=True) for name in app.conf['cameras']]
+    for thread in feeders:
+        thread.start()
+    for thread in feeders:
+        thread.join()
+    app.processor.stop()
+    sleep(0.5)
+    cpu, wall = process_time() - cpu_start, monotonic() - wall_start
+
+    histograms = app.tracer.histograms()
+    end_to_end = app.tracer.latencies("dequeue", "encoded")
+    last_stage = "payloaded" if clients else "encoded"
+    streams = {}
+    for name in app.conf['cameras']:
+        latencies = [ns / 1e6 for ns in end_to_end.get(name, [])]
+        encoded = histograms.get(name, {}).get(last_stage, {}).get("count", 0)
+        streams[name] = {
+            "sent_frames": sent.get(name, 0),
+            "output_frames": encoded,
+            "achieved_fps": round(encoded / wall, 2),
+            "latency_ms": {p: round(percentile(latencies, f), 3) if latencies else None
+                           for p, f in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+            "stages": histograms.get(name, {}),
+            "gstreamer": app.gst_app.stats()[name],
+        }
+
+    for client in clients:
+        client.set_state(Gst.State.NULL)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "host": {"node": platform.node(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": vars(args),
+        "wall_s": round(wall, 3),
+        "cpu_percent_total": round(100 * cpu / wall, 1),
+        "cpu_percent_per_camera": round(100 * cpu / wall / args.cameras, 1),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_mb": round(current_rss_mb(), 1),
+        "aggregate_fps": round(sum(s["achieved_fps"] for s in streams.values()), 2),
+        "host_stages": app.processor.stats.summary(),
+        "streams": streams,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cameras", type=int, default=1)
+    parser.add_argument("--width", type=int, default=1920, help="stream (frame_resize) width")
+    parser.add_argument("--height", type=int, default=1080, help="stream (frame_resize) height")
+    parser.add_argument("--src-width", type=int, default=None, help="synthetic frame width, defaults to --width")
+    parser.add_argument("--src-height", type=int, default=None, help="synthetic frame height, defaults to --height")
+    parser.add_argument("--fps", type=int, default=30, help="per camera, 0 pushes as fast as possible")
+    parser.add_argument("--duration", type=int, default=20, help="seconds")
+    parser.add_argument("--workers", type=int, default=4, help="FrameProcessor workers")
+    parser.add_argument("--policy", default="block", choices=["block", "drop-oldest", "drop-newest"])
+    parser.add_argument("--pattern", default="gradient", choices=["gradient", "noise"])
+    parser.add_argument("--format", default="BGR", choices=list(yuv.FRAME_FORMATS),
+                        help="frame format pushed to appsrc, NV12/I420 skip the host colour conversions")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--rtsp-client", action="store_true", help="pull every mount with a local rtsp client")
+    parser.add_argument("--output", default=None, help="json results path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    Gst.init(None)
+    results = run(args)
+
+    print(f"commit={results['commit']} cameras={args.cameras} {args.width}x{args.height}@{args.fps}")
+    for name, stream in results["streams"].items():
+        print(f"  {name}: {stream['achieved_fps']} fps, latency {stream['latency_ms']}, "
+              f"dropped {stream['gstreamer']['dropped_frames']}")
+    print(f"  aggregate {results['aggregate_fps']} fps, cpu {results['cpu_percent_per_camera']}%/camera, "
+          f"rss {results['rss_mb']} MB (max {results['max_rss_mb']} MB)")
+    print(f"  host stages {results['host_stages']}")
+
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    output = args.output or f"/gstreamer/logs/bench/server_bench-{results['commit']}-{stamp}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding="UTF-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"  saved {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,240 @@
 #!/usr/bin/env python3
 
+import random
 import sys
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime
 import gi
 import logging
-from time import sleep
+from time import monotonic_ns, time_ns
 
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GLib
+from gstreamer.common_utils import sei
+from gstreamer.common_utils.gst_buffer import MappedBuffer, map_available, video_frame_view
 from gstreamer.common_utils.utils import (save_debug_log, sec_to_hms)
 
 logger = logging.getLogger(__name__)
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
 
+def latency_percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {p: round(values[min(int(f * len(values)), len(values) - 1)], 2)
+            for p, f in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))}
+
+
+class Frame(object):
+    """
+    A decoded frame pulled from the appsink. `array` is a read-only view of the GstBuffer memory (no copy),
+    valid until release(): copy() it to keep the pixels. seq_num/capture_ns come from the frame metadata SEI.
+    """
+
+    def __init__(self, sample, seq_num=None, capture_ns=None):
+        buf = sample.get_buffer()
+        self.pts = buf.pts
+        self.seq_num = seq_num
+        self.capture_ns = capture_ns
+        self._mapped = MappedBuffer(buf)
+        self.array = video_frame_view(self._mapped.data, sample.get_caps())
+
+    def release(self):
+        self.array = None
+        self._mapped.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
 class RtspClient:
-    def __init__(self, conf=None):
-        self.__my_name = "RtspClient"
+    """
+    Pulls one rtsp url: rtspsrc ! rtph264depay ! h264parse [! avdec_h264] ! sink.
+
+    conf: "url", plus optionally
+    - "sink": sink element (default xvimagesink), "sync": sink sync, "decode": decode before the sink
+    - "transport": "udp", "tcp" or None (rtspsrc tries udp then tcp), "latency": rtspsrc jitterbuffer ms
+    - "stall_ms": a gap between frames longer than this counts as a stall
+    - "reconnect": {"enabled", "initial_delay", "max_delay", "jitter", "stall_seconds"}, see schedule_reconnect()
+
+    With "sink": "appsink" the decoded frames are handed to the application (frames(), pull_frame() or
+    set_frame_callback()) instead of being displayed:
+    - "frame_format" (default BGR), "frame_width"/"frame_height" (default: stream size) of the frames
+    - "decode_threads": avdec_h264 max-threads (0: one per core)
+    - "latest_only" (default True): keep only the newest decoded frame, a slow consumer skips frames instead of
+      holding back the pipeline; False queues up to "max_frames" and applies backpressure
+
+    Access units carrying the server's frame metadata SEI (see sei.py) give the camera seq_num, so frames lost
+    anywhere between the camera and this client are counted, and the capture to sink latency.
+
+    Pass `loop` to run many clients on one shared GLib main loop (the caller runs it, see start()/stop()),
+    otherwise run() owns a loop and reconnects until run_flag is cleared.
+    """
+
+    def __init__(self, conf=None, loop=None):
+        self.__my_name = conf.get("name", "RtspClient")
         self.run_flag = True
         self.log_path = '/gstreamer/logs'
         logger.info(f"{__file__} Starting pipeline {self.__my_name} ")
         self.runtime_clock = {"start": -1, "stop": -1, "runtime": -1}
         self.frame_counter = 0
         self.rtsp_url = conf["url"]
+        self.sink_name = conf.get("sink", "xvimagesink")
+        self.sync = conf.get("sync", True)
+        self.decode = conf.get("decode", True)
+        self.appsink = self.sink_name == "appsink"
+        if self.appsink:
+            if not map_available():
+                logger.error(f"{__file__} The frame api needs libgstreamer-1.0 through ctypes")
+                raise RuntimeError
+            # frames are always decoded for the frame api
+            self.decode = True
+        self.frame_format = conf.get("frame_format", "BGR")
+        self.frame_width = conf.get("frame_width")
+        self.frame_height = conf.get("frame_height")
+        self.decode_threads = conf.get("decode_threads", 0)
+        self.latest_only = conf.get("latest_only", True)
+        self.max_frames = conf.get("max_frames", 2)
+        # pts -> (seq_num, capture_ns) of decoded frames waiting in the appsink
+        self.frame_meta = OrderedDict()
+        self.callback_thread = None
+        self.transport = conf.get("transport")
+        self.latency = conf.get("latency")
+        self.stall_ns = int(conf.get("stall_ms", 500) * 1e6)
+        # dot files on every state change, too many for load tests
+        self.debug_dot = conf.get("debug_dot", True)
+        # seconds between stats reports of run() (fps, jitter, lost frames, latency percentiles)
+        self.report_interval = conf.get("report_interval", 10)
+        self.owns_loop = loop is None
+        self.loop = loop
+        self.error = None
+        self.last_seq = None
+
+        # when the source fails (server down/restarting, stream ended, no frames for stall_seconds) only rtspsrc
+        # is rebuilt, retried after a jittered exponential backoff capped at max_delay, so a restarted server
+        # is picked up at most max_delay after it comes back
+        reconnect = conf.get("reconnect", {})
+        self.reconnect_enabled = reconnect.get("enabled", True)
+        self.reconnect_initial_delay = reconnect.get("initial_delay", 0.05)
+        self.reconnect_max_delay = reconnect.get("max_delay", 1.0)
+        self.reconnect_jitter = reconnect.get("jitter", 0.3)
+        self.stall_reconnect_ns = int(reconnect.get("stall_seconds", 5) * 1e9)
+        self.reconnect_attempts = 0
+        self.reconnect_timer = None
+        self.reconnects = 0
+        # monotonic ns: start of the current outage, rebuild of the current source, last frame ever received
+        self.disconnected_ns = None
+        self.source_started_ns = None
+        self.last_seen_ns = None
+        self.last_outage_ms = None
+        self.reconnect_first_frame_ms = None
+        # pts -> capture wall clock ns, from the parser until the frame reaches the sink
+        self.pending_meta = {}
+        self.reset_stats()
         self.set_up_pipeline()
 
+    def reset_stats(self):
+        """ start a new measurement window, the frame counter keeps running """
+        self.window_start = monotonic_ns()
+        self.window_frames = 0
+        self.first_frame_ns = None
+        self.last_frame_ns = None
+        self.interval_sum = 0
+        self.interval_sq_sum = 0
+        self.max_gap_ns = 0
+        self.stalls = 0
+        self.stalled_ns = 0
+        self.sei_frames = 0
+        self.lost_frames = 0
+        self.latencies_ms = deque(maxlen=10000)
+
+    def on_access_unit(self, pad, info):
+        buf = info.get_buffer()
+        meta = sei.parse_frame_meta(buf.extract_dup(0, min(buf.get_size(), sei.HEAD_BYTES)))
+        if meta is None:
+            return Gst.PadProbeReturn.OK
+        seq_num, capture_ns = meta
+        self.sei_frames += 1
+        if self.last_seq is not None and seq_num > self.last_seq + 1:
+            self.lost_frames += seq_num - self.last_seq - 1
+        self.last_seq = seq_num
+        if len(self.pending_meta) > 256:
+            # the decoder dropped frames, forget them
+            self.pending_meta.clear()
+        self.pending_meta[buf.pts] = meta
+        return Gst.PadProbeReturn.OK
+
+    def on_frame(self, pad, info):
+        now = monotonic_ns()
+        self.last_seen_ns = now
+        if self.disconnected_ns is not None:
+            # first frame after a reconnect
+            self.last_outage_ms = round((now - self.disconnected_ns) / 1e6, 1)
+            self.reconnect_first_frame_ms = round((now - self.source_started_ns) / 1e6, 1)
+            self.disconnected_ns = None
+            self.reconnect_attempts = 0
+            logger.info(f"{__file__} [{self.__my_name}] Stream resumed after {self.last_outage_ms} ms "
+                        f"({self.reconnect_first_frame_ms} ms after reconnecting)")
+        pts = info.get_buffer().pts
+        meta = self.pending_meta.pop(pts, None)
+        if meta is not None:
+            self.latencies_ms.append((time_ns() - meta[1]) / 1e6)
+            if self.appsink:
+                self.frame_meta[pts] = meta
+                while len(self.frame_meta) > 64:
+                    self.frame_meta.popitem(last=False)
+        self.frame_counter += 1
+        self.window_frames += 1
+        if self.first_frame_ns is None:
+            self.first_frame_ns = now
+        elif self.last_frame_ns is not None:
+            gap = now - self.last_frame_ns
+            self.interval_sum += gap
+            self.interval_sq_sum += gap * gap
+            self.max_gap_ns = max(self.max_gap_ns, gap)
+            if gap > self.stall_ns:
+                self.stalls += 1
+                self.stalled_ns += gap
+        self.last_frame_ns = now
+        return Gst.PadProbeReturn.OK
+
+    def stats(self):
+        """
+        Frames received since reset_stats(): rate, inter-frame jitter (standard deviation of the gaps),
+        longest gap and stalls, plus time to first frame
+        """
+        now = monotonic_ns()
+        elapsed = (now - self.window_start) / 1e9
+        intervals = self.window_frames - 1
+        mean = self.interval_sum / intervals if intervals > 0 else 0
+        variance = self.interval_sq_sum / intervals - mean * mean if intervals > 0 else 0
+        # a session that stopped receiving is stalled up to now
+        gap = now - self.last_frame_ns if self.last_frame_ns is not None else now - self.window_start
+        return {
+            "frames": self.window_frames,
+            "total_frames": self.frame_counter,
+            "fps": round(self.window_frames / elapsed, 2) if elapsed > 0 else 0,
+            "first_frame_ms": round((self.first_frame_ns - self.window_start) / 1e6, 1)
+            if self.first_frame_ns is not None else None,
+            "interval_ms": round(mean / 1e6, 3),
+            "jitter_ms": round(max(variance, 0) ** 0.5 / 1e6, 3),
+            "max_gap_ms": round(max(self.max_gap_ns, gap) / 1e6, 1),
+            "stalls": self.stalls + (1 if gap > self.stall_ns else 0),
+            "stalled_s": round((self.stalled_ns + (gap if gap > self.stall_ns else 0)) / 1e9, 3),
+            "sei_frames": self.sei_frames,
+            "lost_frames": self.lost_frames,
+            "latency_ms": latency_percentiles(list(self.latencies_ms)),
+            "reconnects": self.reconnects,
+            "last_outage_ms": self.last_outage_ms,
+            "reconnect_first_frame_ms": self.reconnect_first_frame_ms,
+            "error": self.error,
+        }
+
     def on_pad_added(self, src, new_pad):
         # handler for the pad-added signal
         video_depay = self.pipeline.get_by_name('video_depay')
@@ -60,7 +270,11 @@ class RtspClient:
 
         if t == Gst.MessageType.EOS:
             logger.info(f"{__file__} bus_call: End-of-stream\n")
-            self.loop.quit()
+            if self.reconnect_enabled and self.run_flag:
+                # the server ended the session (e.g. it is shutting down), wait for the stream to come back
+                self.schedule_reconnect()
+            else:
+                self.finish()
 
         elif t == Gst.MessageType.ELEMENT:
             logger.info(f"ELEMENT_MESSAGE: {message.src.__class__.__name__}")
@@ -76,6 +290,8 @@ class RtspClient:
                     f"{__file__} Pipeline state changed from "
                     f"'{Gst.Element.state_get_name(old_state)}' to '{Gst.Element.state_get_name(new_state)}'"
                 )
+                if not self.debug_dot:
+                    return True
                 try:
                     file_name = self.__my_name + Gst.Element.state_get_name(old_state) + "_" + Gst.Element.state_get_name(new_state)
                     save_debug_log(self.pipeline, file_name=file_name, log_dir=self.log_path)
@@ -90,24 +306,89 @@ class RtspClient:
             err, debug = message.parse_error()
             logger.error(f"{__file__} bus_call:\n\tError: {err} ")
 
-            if 'Could not open resource for reading and writing.' in err.__str__() and v_src == message.src:
-                logger.warning(f"{__file__} bus_call:\n\tCould not connect to source. Trying again in 5 seconds...")
-                sleep(5)
-            else:
-                self.run_flag = False
+            if self.reconnect_enabled and self.run_flag and v_src is not None \
+                    and (message.src == v_src or message.src.has_as_ancestor(v_src)):
+                # connection refused/lost: rebuild the source later, never block the main loop here
+                self.schedule_reconnect()
+                return True
+
+            self.error = str(err)
+            self.run_flag = False
+            if not self.owns_loop:
+                # the shared loop keeps running the other sessions
+                self.pipeline.set_state(Gst.State.NULL)
+                return True
 
             logger.warning(f"{__file__} Terminate the pipeline")
             self.loop.quit()
 
         return True
 
+    def create_source(self):
+        source = Gst.ElementFactory.make("rtspsrc", "source")
+        source.connect("pad-added", self.on_pad_added)
+        source.set_property("location", self.rtsp_url)
+        if self.transport is not None:
+            Gst.util_set_object_arg(source, "protocols", self.transport)
+        if self.latency is not None:
+            source.set_property("latency", self.latency)
+        self.source_started_ns = monotonic_ns()
+        return source
+
+    def schedule_reconnect(self):
+        """
+        Rebuild the source after initial_delay * 2^attempts (capped at max_delay) +/- jitter, unless a
+        reconnect is already pending
+        """
+        if self.reconnect_timer is not None:
+            return
+        if self.disconnected_ns is None:
+            self.disconnected_ns = monotonic_ns()
+        delay = min(self.reconnect_max_delay, self.reconnect_initial_delay * 2 ** self.reconnect_attempts)
+        delay *= random.uniform(1 - self.reconnect_jitter, 1 + self.reconnect_jitter)
+        self.reconnect_attempts += 1
+        logger.warning(f"{__file__} [{self.__my_name}] Reconnecting to {self.rtsp_url} in {round(delay, 3)}s "
+                       f"(attempt {self.reconnect_attempts})")
+        self.reconnect_timer = GLib.timeout_add(max(int(delay * 1000), 1), self.reconnect)
+
+    def reconnect(self):
+        """ GLib timeout: replace rtspsrc, the depayloader, parser, decoder and sink are kept """
+        self.reconnect_timer = None
+        if not self.run_flag:
+            return False
+        self.reconnects += 1
+        old = self.pipeline.get_by_name('source')
+        if old is not None:
+            old.set_state(Gst.State.NULL)
+            self.pipeline.remove(old)
+        # clear the EOS/segment left downstream by the old session
+        depay_sink = self.pipeline.get_by_name('video_depay').get_static_pad("sink")
+        depay_sink.send_event(Gst.Event.new_flush_start())
+        depay_sink.send_event(Gst.Event.new_flush_stop(True))
+        source = self.create_source()
+        self.pipeline.add(source)
+        source.sync_state_with_parent()
+        return False
+
+    def watchdog(self):
+        """ GLib timeout: a source that stopped delivering frames without an error is reconnected too """
+        if not self.run_flag:
+            return False
+        last = max(self.last_seen_ns or 0, self.source_started_ns or 0)
+        if self.reconnect_enabled and self.reconnect_timer is None and self.stall_reconnect_ns \
+                and monotonic_ns() - last > self.stall_reconnect_ns:
+            logger.warning(f"{__file__} [{self.__my_name}] No frames for {self.stall_reconnect_ns / 1e9}s")
+            self.schedule_reconnect()
+        return True
+
     def set_up_pipeline(self):
         Gst.init(None)
 
         ##################################################################
         # Create pipeline objects to manage pipeline state
-        self.loop = GLib.MainLoop()
-        self.pipeline = Gst.Pipeline()
+        if self.owns_loop:
+            self.loop = GLib.MainLoop()
+        self.pipeline = Gst.Pipeline.new(self.__my_name)
         self.bus = self.pipeline.get_bus()
         self.bus.add_signal_watch()
         self.bus.connect("message", self.bus_call)
@@ -123,13 +404,34 @@ class RtspClient:
         # Create pipeline elements
 
         logger.debug(f"{__file__} Creating Pipeline ...")
-        source = Gst.ElementFactory.make("rtspsrc", "source")
-        source.connect("pad-added", self.on_pad_added)
-        source.set_property("location", self.rtsp_url)
+        source = self.create_source()
         video_depay = Gst.ElementFactory.make("rtph264depay", "video_depay")
         video_parse = Gst.ElementFactory.make("h264parse", "video_parse")
-        video_decode = Gst.ElementFactory.make("avdec_h264", "video_decode")
-        sink = Gst.ElementFactory.make("xvimagesink", "video_sink")
+        video_decode = Gst.ElementFactory.make("avdec_h264", "video_decode") if self.decode else None
+        if video_decode is not None:
+            video_decode.set_property("max-threads", self.decode_threads)
+        sink = Gst.ElementFactory.make(self.sink_name, "video_sink")
+        if sink is None:
+            logger.error(f"{__file__} Unable to create sink ({self.sink_name})")
+            raise RuntimeError
+        sink.set_property("sync", self.sync)
+        # appsink: videoconvert ! videoscale ! capsfilter to the requested frame format and size
+        frame_elements = []
+        if self.appsink:
+            caps = f"video/x-raw,format={self.frame_format}"
+            if self.frame_width and self.frame_height:
+                caps += f",width={self.frame_width},height={self.frame_height}"
+            frame_elements = [Gst.ElementFactory.make("videoconvert", "frame_convert"),
+                              Gst.ElementFactory.make("videoscale", "frame_scale"),
+                              Gst.ElementFactory.make("capsfilter", "frame_caps")]
+            frame_elements[2].set_property("caps", Gst.Caps.from_string(caps))
+            sink.set_property("emit-signals", False)
+            sink.set_property("max-buffers", 1 if self.latest_only else self.max_frames)
+            # latest only: the appsink replaces its queued frame, the decoder never waits for the consumer
+            sink.set_property("drop", self.latest_only)
+        # every buffer reaching the sink is a frame (access unit when not decoding)
+        sink.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_frame)
+        video_parse.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_access_unit)
 
         ##################################################################
         # Add elements to pipeline bin
@@ -138,7 +440,10 @@ class RtspClient:
         self.pipeline.add(source)
         self.pipeline.add(video_depay)
         self.pipeline.add(video_parse)
-        self.pipeline.add(video_decode)
+        if video_decode is not None:
+            self.pipeline.add(video_decode)
+        for element in frame_elements:
+            self.pipeline.add(element)
         self.pipeline.add(sink)
 
         ##################################################################
@@ -147,11 +452,74 @@ class RtspClient:
         logger.debug(f"{__file__} Linking elements in the Pipeline ...")
         source.link(video_depay)
         video_depay.link(video_parse)
-        # video_parse.link(video_decode)
-        video_parse.link(video_decode)
-        video_decode.link(sink)
+        chain = [video_parse] + ([video_decode] if video_decode is not None else []) + frame_elements + [sink]
+        for upstream, downstream in zip(chain, chain[1:]):
+            upstream.link(downstream)
 
         self.pipeline.set_state(Gst.State.READY)
+        if self.reconnect_enabled:
+            GLib.timeout_add(500, self.watchdog)
+
+    def pull_frame(self, timeout=1.0):
+        """
+        @return: the next decoded Frame (the caller releases it), or None if none arrived within `timeout` s
+        """
+        sample = self.pipeline.get_by_name('video_sink').emit("try-pull-sample", int(timeout * Gst.SECOND))
+        if sample is None:
+            return None
+        seq_num, capture_ns = self.frame_meta.pop(sample.get_buffer().pts, (None, None))
+        return Frame(sample, seq_num, capture_ns)
+
+    def frames(self, timeout=1.0):
+        """
+        Iterate over decoded frames until the client stops, each one is released when the next one is requested
+        """
+        while self.run_flag:
+            frame = self.pull_frame(timeout)
+            if frame is None:
+                continue
+            try:
+                yield frame
+            finally:
+                frame.release()
+
+    def set_frame_callback(self, callback, timeout=1.0):
+        """
+        Call `callback(frame)` for every decoded frame, on a thread of its own (never on a streaming thread).
+        The frame is released when the callback returns.
+        """
+        def deliver():
+            for frame in self.frames(timeout):
+                try:
+                    callback(frame)
+                except Exception as CallbackError:
+                    logger.error(f"{__file__} [{self.__my_name}] Frame callback failed: {CallbackError}")
+
+        self.callback_thread = threading.Thread(target=deliver, name=f"frames_{self.__my_name}", daemon=True)
+        self.callback_thread.start()
+        return self.callback_thread
+
+    def start(self):
+        """ start streaming on a shared loop """
+        self.runtime_clock['start'] = datetime.now()
+        self.reset_stats()
+        self.source_started_ns = monotonic_ns()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        self.run_flag = False
+        if self.reconnect_timer is not None:
+            GLib.source_remove(self.reconnect_timer)
+            self.reconnect_timer = None
+        self.pipeline.set_state(Gst.State.NULL)
+        self.bus.remove_signal_watch()
+
+    def finish(self):
+        if self.owns_loop:
+            self.loop.quit()
+        else:
+            self.run_flag = False
+            self.pipeline.set_state(Gst.State.NULL)
 
     def clean_up(self):
         try:
@@ -165,11 +533,19 @@ class RtspClient:
         self.pipeline.set_state(Gst.State.PAUSED)
         logger.info(f"{__file__} clean_up: finished clean up of sources")
 
+    def report(self):
+        logger.info(f"{__file__} [{self.__my_name}] {self.rtsp_url} stats={self.stats()}")
+        self.reset_stats()
+        return self.run_flag
+
     def run(self):
+        if self.report_interval:
+            GLib.timeout_add_seconds(self.report_interval, self.report)
         # Loop forever so that if connection is lost we just reboot and try again!
         while self.run_flag:
             try:
                 logger.info(f"{__file__} Starting pipeline ...")
+                self.source_started_ns = monotonic_ns()
                 self.pipeline.set_state(Gst.State.PLAYING)
                 self.runtime_clock['start'] = datetime.now()
                 self.loop.run()
@@ -28,7 +28,20 @@ rtsp_server_config = {
 }
 
 rtsp_client_config = {
-    "url": f"rtsp://{SERVER}:8554/camera1"
+    "url": f"rtsp://{SERVER}:8554/camera1",
+    "sink": "xvimagesink",
+    "decode": True,
+    # "udp", "tcp" or None to let rtspsrc negotiate
+    "transport": None,
+    # rtspsrc is rebuilt after a jittered exponential backoff (seconds) when the connection fails or drops,
+    # or after stall_seconds without frames
+    "reconnect": {
+        "enabled": True,
+        "initial_delay": 0.05,
+        "max_delay": 1.0,
+        "jitter": 0.3,
+        "stall_seconds": 5,
+    },
 }
 
 AppConfig = {
@@ -44,6 +57,18 @@ AppConfig = {
         },
         "cameras": oakd_cameras,
         "store_img_enabled": False,
+        # image storage when store_img_enabled, written off the capture thread by SnapshotWriter
+        # (a frame is kept every `every_n` frames and at most every `every_seconds`, per camera overrides in "cameras")
+        "snapshots": {
+            "directory": "./logs/images",
+            "format": "jpg",
+            "quality": 90,
+            "workers": 2,
+            "max_queue": 16,
+            "every_n": 30,
+            "every_seconds": 0,
+            "cameras": {},
+        },
         "gst_enabled": True,
         "connection": "poe",
         "timezone": "Canada/Eastern",
@@ -9,10 +9,10 @@ CAM_HEIGHT = 1080
 PIPELINE_FPS = "30"
 COLOR_ORDER = "BGR"
 
+# camera name -> device mxid or PoE ip address, only "oakd" entries of pipeline_conf can take a device,
+# e.g. "camera3": "192.168.122.22" with a camera3 oakd entry
 ip_cameras = {
     "camera1": "19443010F1A1EE1200",
-    "camera2": "192.168.122.21",
-    "camera3": "192.168.122.22",
 }
 SERVER_IP="192.168.1.69"
 
@@ -26,7 +26,43 @@ rtsp_config = {
             "width": 1920,
             "height": 1080,
             "source": {
-                "type": "oakd"
+                "type": "oakd",
+                # "raw": host resize + x264enc, "h264": on-board encoder at sensor resolution, host only payloads
+                "encoding": "raw",
+                # raw frame format: "BGR" (getCvFrame + videoconvert on the host), "NV12" (device native,
+                # no host colour conversion) or "I420"
+                "format": "BGR",
+            },
+            # videoconvert threads when the frame format still needs converting for the encoder (0: all cores)
+            "convert_threads": 0,
+            # resize/encode only while a client is connected (or recording), stops idle_timeout s after the last one
+            "on_demand": True,
+            "idle_timeout": 10,
+            # seq_num and capture time of every frame as an H.264 SEI message, read back by RtspClient
+            "sei": True,
+            # appsrc queue bound: policy is one of block, drop-oldest, drop-newest (device h264 always blocks)
+            "backpressure": {
+                "policy": "drop-oldest",
+                "max_buffers": 2,
+                "max_bytes": 0,
+            },
+            # host encoder for raw sources: "auto" benchmarks candidates once per host/resolution/fps
+            # (cached in /gstreamer/logs/encoder_calibration.json), or a fixed profile such as
+            # {"element": "x264enc", "properties": {"speed-preset": "veryfast", "tune": "zerolatency",
+            #  "threads": 0, "sliced-threads": True, "bitrate": 4000, "key-int-max": 60}}
+            "encoder": {"element": "x264enc", "properties": {"speed-preset": "fast", "tune": "zerolatency"}},
+            # encoded once, the same H.264 stream feeds rtsp and the recording
+            "recording": {
+                "enabled": False,
+                "directory": "/device_media/recordings",
+                # continuous keyframe-aligned segments, 0 disables them
+                "segment_seconds": 60,
+                # disk quota for this camera's recordings, the oldest ones are deleted first (0: no quota),
+                # recordings still waiting for upload are kept until hard_max_bytes (default 2 * max_bytes)
+                "max_bytes": 8 * 1024 ** 3,
+                "hard_max_bytes": 16 * 1024 ** 3,
+                # encoded video kept in memory, written out by SensorFactory.trigger_recording() (0 disables it)
+                "pre_event_seconds": 10,
             },
             "extension": "/camera1"
         },
@@ -37,11 +73,33 @@ rtsp_config = {
             "height": 1080,
             "source": {
                 "type": "file",
-                "location": "/gstreamer/sample_1080p_h264.mp4"
+                "location": "/gstreamer/sample_1080p_h264.mp4",
+                # forward the file's H.264 stream as it is (no decode/encode, "prefetch" does not apply)
+                "passthrough": False,
+                # file/webcam frames are decoded ahead on a thread, into a ring of this many frames
+                "prefetch": 4,
+                # restart the file at its end instead of ending the stream (not supported by "file_av")
+                "loop": True,
             },
             "extension": "/camera2"
         }
-    ]
+    ],
+    # one mount tiling the raw oakd streams ("cameras": names in grid order, empty for all) into a single encoded
+    # canvas, tiles are downscaled from the frames already pushed to the camera mounts (file, webcam and
+    # encoded streams are skipped)
+    "mosaic": {
+        "enabled": False,
+        "name": "mosaic",
+        "extension": "/mosaic",
+        "width": 1920,
+        "height": 1080,
+        "fps": 15,
+        "cameras": [],
+        # tiles of streams without frames for this long are blanked
+        "stale_seconds": 2,
+        "on_demand": True,
+        "encoder": {"element": "x264enc", "properties": {"speed-preset": "fast", "tune": "zerolatency"}},
+    },
 }
 
 AppConfig = {
@@ -55,9 +113,75 @@ AppConfig = {
             "width": CAM_WIDTH,
             "height": CAM_HEIGHT,
         },
+        # maps camera name (pipeline_conf "name" of an oakd source) -> device mxid or PoE ip address
         "cameras": ip_cameras,
+        # oakd stream for a device missing from "cameras" (None drops it)
+        "default_stream": None,
         "store_img_enabled": False,
+        # image storage when store_img_enabled, written off the capture thread by SnapshotWriter
+        # (a frame is kept every `every_n` frames and at most every `every_seconds`, per camera overrides in "cameras")
+        "snapshots": {
+            "directory": "/gstreamer/logs/images",
+            "format": "jpg",
+            "quality": 90,
+            "workers": 2,
+            "max_queue": 16,
+            "every_n": 30,
+            "every_seconds": 0,
+            "cameras": {},
+        },
+        # finished recording segments/events and snapshots are uploaded by BlobUploader, the queue is kept in
+        # sqlite so pending uploads resume after a restart. backend "azure" (Azurite: "UseDevelopmentStorage=true")
+        # uploads files above max_single_put_size as max_block_size blocks, max_concurrency at a time;
+        # {"type": "filesystem", "root": "/path"} copies them locally instead
+        "upload": {
+            "enabled": False,
+            "backend": {
+                "type": "azure",
+                "connection_string": "UseDevelopmentStorage=true",
+                "container": "oakd",
+                "max_concurrency": 4,
+                "max_block_size": 4 * 1024 ** 2,
+                "max_single_put_size": 8 * 1024 ** 2,
+            },
+            "queue_path": "/gstreamer/logs/upload_queue.sqlite",
+            # blob name: <prefix>/<path relative to the first matching root>
+            "prefix": "",
+            "roots": ["/device_media/recordings", "/gstreamer/logs/images"],
+            "concurrency": 2,
+            "max_attempts": 10,
+            "backoff_seconds": 2,
+            "max_backoff_seconds": 300,
+            "delete_after_upload": False,
+            "drain_timeout": 10,
+        },
         "gst_enabled": True,
+        # "depthai" for OAK-D devices, "simulated" for virtual devices, e.g.
+        # {"type": "simulated", "count": 2, "width": 1920, "height": 1080, "fps": 30,
+        #  "jitter_ms": 2.0, "drop_rate": 0.01, "seed": 0, "source": "pattern" or "/path/to/video.mp4"}
+        "device_backend": {
+            "type": "depthai",
+        },
+        # per-frame stage timestamps (device capture -> rtp payloader), exported as a chrome trace json
+        "trace": {
+            "enabled": False,
+            "path": "/gstreamer/logs/frame_trace.json",
+            "max_frames": 5000,
+        },
+        # capture/convert/resize each raw camera in a worker process (scales past the GIL), frames come back
+        # through a shared memory ring of `slots` frames, dead workers restart after restart_delay seconds.
+        # With store_img_enabled the workers apply the snapshot rate limit, idle mounts only process due frames
+        "processes": {
+            "enabled": False,
+            "slots": 6,
+            "restart_delay": 2,
+        },
+        # resize worker pool (workers=0 processes frames on the capture thread)
+        "processing": {
+            "workers": 4,
+            "max_pending": 8,
+            "report_interval": 60,
+        },
         "connection": "poe",
         "timezone": "Canada/Eastern",
     },
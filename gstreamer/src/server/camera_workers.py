@@ -0,0 +1,275 @@
+"""
+Process-per-camera mode: each raw camera is captured, converted and resized in its own worker
+process, so the work scales across cores instead of sharing the GIL of the server process.
+
+Frames travel through a shared memory ring of fixed size slots. Only small tuples cross process boundaries:
+- free_slots: slot indices the worker may write, returned by the server once GStreamer releases the buffer
+- ready_frames: (slot, seq_num, capture_ns, dequeue_ns, processed_ns, dropped, snapshot) for every frame
+  written by the worker; timestamps are CLOCK_MONOTONIC, shared by all processes
+
+The server wraps ready slots in GstBuffers without a copy (SensorFactory.push with on_release), and a
+supervisor restarts workers that exit.
+"""
+
+import logging
+import multiprocessing as mp
+import threading
+from multiprocessing import shared_memory
+from queue import Empty
+from time import monotonic, monotonic_ns, sleep
+
+import numpy as np
+
+from gstreamer.common_utils import yuv
+from gstreamer.src.server.devices import create_backend, read_video_frame
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+def camera_worker(stream_id, mxid, conf, create_pipeline, frame_format, ring_name, slots, free_slots, ready_frames,
+                  active, stop_event, snapshot_limit=None):
+    """
+    Worker process main: open the device `mxid` and fill ring slots until `stop_event` is set.
+    While `active` is cleared (on demand mount without clients) frames are only drained from the device, except
+    the ones `snapshot_limit` (the camera's SnapshotWriter rate limit) admits, checked before any work.
+    """
+    _log_prefix = f"[camera_worker({stream_id})]\n-- "
+    width = conf['frame_resize']['width']
+    height = conf['frame_resize']['height']
+    shape = yuv.frame_shape(frame_format, width, height)
+
+    backend = create_backend(conf.get('device_backend'))
+    descriptor = next((d for d in backend.list_devices() if d.mxid == mxid), None)
+    if descriptor is None:
+        logger.error(f"{_log_prefix} Device (id={mxid}) is not available")
+        raise RuntimeError
+
+    ring = shared_memory.SharedMemory(name=ring_name)
+    frames = np.ndarray((slots,) + shape, dtype=np.uint8, buffer=ring.buf)
+    dropped = 0
+    try:
+        with backend.open(descriptor, create_pipeline) as device:
+            queue = device.getOutputQueue(name="video", maxSize=2, blocking=False)
+            logger.info(f"{_log_prefix} Reading device (id={mxid})")
+            while not stop_event.is_set():
+                video = queue.get()
+                dequeue_ns = monotonic_ns()
+                snapshot = snapshot_limit is not None and snapshot_limit.admit(monotonic())
+                if not active.is_set() and not snapshot:
+                    continue
+                try:
+                    index = free_slots.get_nowait()
+                except Empty:
+                    # the server is behind, drop here rather than queue frames up
+                    dropped += 1
+                    continue
+                seq_num = video.getSequenceNum()
+                img = read_video_frame(video, frame_format)
+                yuv.resize(img, frame_format, width, height, dst=frames[index])
+                ready_frames.put((index, seq_num, int(video.getTimestamp().total_seconds() * 1e9),
+                                  dequeue_ns, monotonic_ns(), dropped, snapshot))
+    finally:
+        # views on the ring have to go before it can be closed
+        frames = None
+        ring.close()
+
+
+class _Worker(object):
+    """
+    One generation of a camera worker: its process, ring and queues. Once retired (the process was replaced)
+    the ring is freed as soon as GStreamer has released every slot handed out to it.
+    """
+
+    def __init__(self, context, frame_format, width, height, slots):
+        self.shape = yuv.frame_shape(frame_format, width, height)
+        self.ring = shared_memory.SharedMemory(create=True, size=slots * int(np.prod(self.shape)))
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self.ring.buf)
+        self.free_slots = context.Queue()
+        self.ready_frames = context.Queue()
+        for index in range(slots):
+            self.free_slots.put(index)
+        self.process = None
+        self.dropped = 0
+        # slots wrapped in GstBuffers and not released yet
+        self.outstanding = 0
+        self.retired = False
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def hand_out(self):
+        """
+        @return: False if the ring is no longer usable (retired), otherwise the slot counts as outstanding
+        until release_slot()
+        """
+        with self._lock:
+            if self.retired:
+                return False
+            self.outstanding += 1
+            return True
+
+    def release_slot(self, index):
+        # called from the GStreamer thread that frees the buffer
+        with self._lock:
+            self.outstanding -= 1
+            done = self.retired and self.outstanding == 0
+        if done:
+            self.close()
+        elif not self.retired:
+            self.free_slots.put(index)
+
+    def retire(self):
+        """ @return: True if the ring could be freed right away """
+        with self._lock:
+            self.retired = True
+            done = self.outstanding == 0
+        if done:
+            self.close()
+        return done
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.frames = None
+        try:
+            self.ring.close()
+            self.ring.unlink()
+        except BufferError:
+            # a slot is still wrapped by a GstBuffer, the mapping goes away with the process
+            logger.warning(f"[_Worker.close] Shared memory ({self.ring.name}) still in use")
+
+
+class CameraWorkers(object):
+    """
+    Starts a worker process per camera and pushes the frames they produce into the camera's SensorFactory.
+    Runs a receiver thread per camera (returned by start_camera, so CameraPipeline monitors it like a reader)
+    and a supervisor thread that restarts dead workers after `restart_delay` seconds.
+    """
+
+    def __init__(self, conf, create_pipeline, tracer=None, slots=6, restart_delay=2, frame_counts=None,
+                 last_frame_time=None, snapshots=None):
+        assert slots > 1
+        # spawn: a forked child would inherit the GLib/GStreamer threads of the server
+        self.context = mp.get_context("spawn")
+        self.conf = conf
+        self.create_pipeline = create_pipeline
+        self.tracer = tracer
+        # optional SnapshotWriter, given the ring frames its rate limit admits (at the stream's output size)
+        self.snapshots = snapshots
+        self.slots = slots
+        self.restart_delay = restart_delay
+        self.frame_counts = frame_counts if frame_counts is not None else {}
+        self.last_frame_time = last_frame_time if last_frame_time is not None else {}
+        self.run_flag = True
+        self.stop_event = self.context.Event()
+        self.restarts = {}
+        # stream_id -> (mxid, factory, active event) and the current _Worker, replaced on restart
+        self.cameras = {}
+        self.workers = {}
+        # retired generations whose slots GStreamer still holds, each frees its ring with the last release
+        self.retired = []
+        self.lock = threading.Lock()
+        self.supervisor = threading.Thread(target=self.supervise, name="camera_supervisor", daemon=True)
+
+    def start_camera(self, stream_id, mxid, factory):
+        """
+        @return: the receiver thread of the camera
+        """
+        self.cameras[stream_id] = (mxid, factory, self.context.Event())
+        self.restarts[stream_id] = 0
+        self.frame_counts[stream_id] = 0
+        self.last_frame_time[stream_id] = monotonic()
+        self.spawn(stream_id)
+        receiver = threading.Thread(target=self.receive, args=(stream_id,), name=f"receiver_{stream_id}",
+                                    daemon=True)
+        receiver.start()
+        if not self.supervisor.is_alive():
+            self.supervisor.start()
+        return receiver
+
+    def spawn(self, stream_id):
+        mxid, factory, active = self.cameras[stream_id]
+        width = self.conf['frame_resize']['width']
+        height = self.conf['frame_resize']['height']
+        worker = _Worker(self.context, factory.format, width, height, self.slots)
+        worker.process = self.context.Process(
+            target=camera_worker, name=f"camera_{stream_id}", daemon=True,
+            args=(stream_id, mxid, self.conf, self.create_pipeline, factory.format, worker.ring.name, self.slots,
+                  worker.free_slots, worker.ready_frames, active, self.stop_event,
+                  self.snapshots.rate_limit(stream_id) if self.snapshots is not None else None))
+        worker.process.start()
+        with self.lock:
+            previous = self.workers.get(stream_id)
+            self.retired = [retired for retired in self.retired if not retired.closed]
+            if previous is not None and not previous.retire():
+                self.retired.append(previous)
+            self.workers[stream_id] = worker
+        logger.info(f"[CameraWorkers.spawn] stream_id=({stream_id}) worker pid=({worker.process.pid})")
+
+    def receive(self, stream_id):
+        _log_prefix = f"[CameraWorkers.receive({stream_id})]\n-- "
+        _, factory, active = self.cameras[stream_id]
+        while self.run_flag:
+            # the worker skips all work for idle on demand mounts, but for frames due as snapshots
+            if factory.is_active():
+                active.set()
+            else:
+                active.clear()
+                # an idle mount is not a stalled camera, dead workers are reported by the supervisor
+                self.last_frame_time[stream_id] = monotonic()
+            worker = self.workers[stream_id]
+            try:
+                index, seq_num, capture_ns, dequeue_ns, processed_ns, dropped, snapshot = \
+                    worker.ready_frames.get(timeout=0.5)
+            except Empty:
+                continue
+            worker.dropped = dropped
+            self.frame_counts[stream_id] += 1
+            self.last_frame_time[stream_id] = monotonic()
+            if self.tracer is not None:
+                # CLOCK_MONOTONIC is shared by all processes
+                self.tracer.mark(stream_id, seq_num, "capture", capture_ns)
+                self.tracer.mark(stream_id, seq_num, "dequeue", dequeue_ns)
+                self.tracer.mark(stream_id, seq_num, "processed", processed_ns)
+            if not worker.hand_out():
+                # the worker was replaced while this frame was in flight, its ring is going away
+                continue
+            if snapshot:
+                # admitted by the worker's rate limit, copied by submit, the slot is pushed as it is
+                self.snapshots.submit(stream_id, worker.frames[index], seq_num, factory.format, admitted=True)
+            try:
+                factory.push(frame=worker.frames[index], src_name=stream_id, seq_num=seq_num, capture_ns=capture_ns,
+                             on_release=lambda index=index, worker=worker: worker.release_slot(index))
+            except Exception as PushError:
+                logger.error(f"{_log_prefix} {PushError}")
+
+    def supervise(self, interval=1):
+        while self.run_flag:
+            sleep(interval)
+            for stream_id, worker in list(self.workers.items()):
+                if worker.process.is_alive() or not self.run_flag:
+                    continue
+                self.restarts[stream_id] += 1
+                logger.warning(f"[CameraWorkers.supervise] stream_id=({stream_id}) worker exited "
+                               f"(code={worker.process.exitcode}), restart {self.restarts[stream_id]} "
+                               f"in {self.restart_delay}s")
+                sleep(self.restart_delay)
+                if self.run_flag:
+                    self.spawn(stream_id)
+
+    def stats(self):
+        return {stream_id: {"pid": worker.process.pid, "alive": worker.process.is_alive(),
+                            "restarts": self.restarts[stream_id], "worker_dropped_frames": worker.dropped}
+                for stream_id, worker in self.workers.items()}
+
+    def stop(self, timeout=5):
+        self.run_flag = False
+        self.stop_event.set()
+        for worker in self.workers.values():
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                # blocked in a device queue get
+                worker.process.terminate()
+        for worker in list(self.workers.values()) + self.retired:
+            worker.close()
@@ -0,0 +1,355 @@
+"""
+Device backends for the capture path.
+
+- DepthaiBackend: real OAK-D devices (usb or poe)
+- SimulatedBackend: N virtual devices producing frames with depthai-like sequence numbers, timestamps,
+  jitter and drops, generated from a pattern or read from a video file. Deterministic for a given seed.
+  With "encoding": "h264" they emit access units from an H.264 elementary stream file instead, standing in
+  for the on-board video encoder.
+
+Both hand out device handles with the depthai calls the capture code uses: context manager,
+getMxId() and getOutputQueue(name, maxSize, blocking) whose messages offer getCvFrame(), getData(),
+getSequenceNum() and getTimestamp(). Simulated frames are NV12 like the ColorCamera video output,
+getCvFrame() converts them to BGR on the host as depthai does.
+"""
+
+import logging
+import random
+import threading
+from collections import deque
+from datetime import timedelta
+from time import monotonic, sleep
+
+import cv2
+import depthai as dai
+import numpy as np
+
+from gstreamer.common_utils import yuv
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+class DeviceDescriptor(object):
+    def __init__(self, mxid, name, info=None):
+        self.mxid = mxid
+        # ip address for poe devices, usb path otherwise
+        self.name = name
+        # backend specific handle (dai.DeviceInfo for depthai)
+        self.info = info
+
+    def __repr__(self):
+        return f"DeviceDescriptor(mxid={self.mxid}, name={self.name})"
+
+
+def create_backend(conf=None):
+    conf = conf or {"type": "depthai"}
+    if conf["type"] == "depthai":
+        return DepthaiBackend(conf)
+    elif conf["type"] == "simulated":
+        return SimulatedBackend(conf)
+    logger.error(f"[create_backend] Invalid device backend type ({conf['type']})")
+    raise RuntimeError
+
+
+class DepthaiBackend(object):
+    def __init__(self, conf):
+        self.conf = conf
+        self.usb_speed = dai.UsbSpeed.SUPER
+        self.openvino_version = dai.OpenVINO.Version.VERSION_2021_4
+
+    @staticmethod
+    def list_devices():
+        return [DeviceDescriptor(info.getMxId(), info.name, info) for info in dai.Device.getAllAvailableDevices()]
+
+    def open(self, descriptor, create_pipeline):
+        """
+        Connect to the device and start the pipeline built by `create_pipeline()`.
+        @return: dai.Device, close it with `with` / ExitStack.enter_context
+        """
+        device = dai.Device(self.openvino_version, descriptor.info, self.usb_speed)
+        try:
+            print("===Connected to ", descriptor.mxid)
+            cameras = device.getConnectedCameras()
+            eeprom_data = device.readCalibration2().getEepromData()
+            print("   >>> MXID:", device.getMxId())
+            print("   >>> Num of cameras:", len(cameras))
+            print("   >>> USB speed:", device.getUsbSpeed())
+            print("   >>> IPAddress:", descriptor.name)
+            if eeprom_data.boardName != "":
+                print("   >>> Board name:", eeprom_data.boardName)
+            if eeprom_data.productName != "":
+                print("   >>> Product name:", eeprom_data.productName)
+            device.startPipeline(create_pipeline())
+        except Exception:
+            device.close()
+            raise
+        return device
+
+
+def read_video_frame(video, frame_format):
+    """
+    @return: the frame of a video output message (NV12 on the device) as a BGR, NV12 or I420 array
+    """
+    if frame_format == "BGR":
+        return video.getCvFrame()
+    nv12 = video.getData().reshape(video.getHeight() * 3 // 2, video.getWidth())
+    if frame_format == "NV12":
+        return nv12
+    return yuv.nv12_to_i420(nv12)
+
+
+def split_access_units(data):
+    """
+    Split an Annex-B H.264 elementary stream into access units (one encoded frame each).
+    An access unit starts at an AUD/SPS/PPS/SEI, or at a slice with first_mb_in_slice == 0,
+    once the current one already holds a slice.
+    """
+    starts = []
+    i = data.find(b"\x00\x00\x01")
+    while i != -1:
+        start = i - 1 if i > 0 and data[i - 1] == 0 else i
+        if i + 3 < len(data):
+            starts.append((start, data[i + 3] & 0x1f, i + 4))
+        i = data.find(b"\x00\x00\x01", i + 3)
+
+    units = []
+    au_start, has_slice = None, False
+    for start, nal_type, payload in starts:
+        new_au = False
+        if has_slice and nal_type in (6, 7, 8, 9):
+            new_au = True
+        elif has_slice and nal_type in (1, 5) and payload < len(data) and data[payload] & 0x80:
+            # ue(v) first_mb_in_slice == 0 is coded as a single 1 bit
+            new_au = True
+        if au_start is None:
+            au_start = start
+        elif new_au:
+            units.append(data[au_start:start])
+            au_start, has_slice = start, False
+        if nal_type in (1, 5):
+            has_slice = True
+    if au_start is not None:
+        units.append(data[au_start:])
+    return units
+
+
+class SimulatedPacket(object):
+    """ Mimics the dai.ImgFrame calls used for VideoEncoder output """
+
+    def __init__(self, data, seq_num, timestamp):
+        self.data = data
+        self.seq_num = seq_num
+        self.timestamp = timestamp
+
+    def getData(self):
+        return self.data
+
+    def getSequenceNum(self):
+        return self.seq_num
+
+    def getTimestamp(self):
+        return self.timestamp
+
+
+class SimulatedFrame(object):
+    """ Mimics the dai.ImgFrame calls used by the capture code, `img` is an NV12 frame """
+
+    def __init__(self, img, seq_num, timestamp):
+        self.img = img
+        self.seq_num = seq_num
+        self.timestamp = timestamp
+
+    def getCvFrame(self):
+        return yuv.to_bgr(self.img, "NV12")
+
+    def getData(self):
+        return self.img.reshape(-1)
+
+    def getSequenceNum(self):
+        return self.seq_num
+
+    def getTimestamp(self):
+        return self.timestamp
+
+    def getWidth(self):
+        return self.img.shape[1]
+
+    def getHeight(self):
+        return self.img.shape[0] * 2 // 3
+
+
+class SimulatedQueue(object):
+    """ Mimics dai.DataOutputQueue: bounded, non-blocking queues overwrite their oldest message """
+
+    def __init__(self, max_size=4, blocking=False):
+        self.max_size = max_size
+        self.blocking = blocking
+        self.closed = False
+        self._messages = deque()
+        self._cond = threading.Condition()
+
+    def send(self, message):
+        with self._cond:
+            while self.blocking and len(self._messages) >= self.max_size and not self.closed:
+                self._cond.wait()
+            if len(self._messages) >= self.max_size:
+                self._messages.popleft()
+            self._messages.append(message)
+            self._cond.notify_all()
+
+    def has(self):
+        with self._cond:
+            return len(self._messages) > 0
+
+    def tryGet(self):
+        with self._cond:
+            if self.closed:
+                raise RuntimeError("Communication exception - queue is closed")
+            message = self._messages.popleft() if self._messages else None
+            self._cond.notify_all()
+            return message
+
+    def get(self):
+        with self._cond:
+            while not self._messages and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                raise RuntimeError("Communication exception - queue is closed")
+            message = self._messages.popleft()
+            self._cond.notify_all()
+            return message
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class SimulatedDevice(object):
+    """
+    Virtual device: a producer thread emits frames at `fps` with gaussian jitter (jitter_ms) and
+    randomly skipped sequence numbers (drop_rate), like frames dropped on a real device.
+    """
+
+    def __init__(self, descriptor, conf, index):
+        self.descriptor = descriptor
+        self.conf = conf
+        self.index = index
+        self.fps = conf.get("fps", 30)
+        self.width = conf.get("width", 1920)
+        self.height = conf.get("height", 1080)
+        self.jitter = conf.get("jitter_ms", 0.0) / 1e3
+        self.drop_rate = conf.get("drop_rate", 0.0)
+        self.random = random.Random(conf.get("seed", 0) + index)
+        self.queues = []
+        self.run_flag = True
+        self.thread = threading.Thread(target=self.produce, name=f"simulated_{descriptor.mxid}", daemon=True)
+
+        self.capture = None
+        self.pattern = None
+        self.access_units = None
+        self.encoding = conf.get("encoding", "raw")
+        source = conf.get("source", "pattern")
+        if self.encoding == "h264":
+            with open(source, 'rb') as f:
+                self.access_units = [np.frombuffer(au, dtype=np.uint8) for au in split_access_units(f.read())]
+            if not self.access_units:
+                logger.error(f"[SimulatedDevice] No H.264 access units found in ({source})")
+                raise RuntimeError
+        elif source == "pattern":
+            self.pattern = self.create_pattern()
+        else:
+            self.capture = cv2.VideoCapture(source)
+            if not self.capture.isOpened():
+                logger.error(f"[SimulatedDevice] Could not open video source ({source})")
+                raise RuntimeError
+
+    def create_pattern(self, count=30):
+        """ moving gradient with a per-device tint, precomputed so producing a frame is cheap """
+        x = np.linspace(0, 255, self.width, dtype=np.float32)
+        y = np.linspace(0, 255, self.height, dtype=np.float32)[:, None]
+        frames = []
+        for i in range(count):
+            shift = 255 * i / count
+            frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+            frame[..., 0] = (x + shift) % 256
+            frame[..., 1] = (y + shift) % 256
+            frame[..., 2] = (40 * self.index + shift) % 256
+            frames.append(yuv.from_bgr(frame, "NV12"))
+        return frames
+
+    def next_image(self, seq_num):
+        if self.pattern is not None:
+            # the consumer owns the frame (e.g. draws on it), hand out a copy like a device would
+            return self.pattern[seq_num % len(self.pattern)].copy()
+        ret, img = self.capture.read()
+        if not ret:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, img = self.capture.read()
+            if not ret:
+                return None
+        if img.shape[0] != self.height or img.shape[1] != self.width:
+            img = cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        return yuv.from_bgr(img, "NV12")
+
+    def produce(self):
+        interval = 1 / self.fps
+        start = monotonic()
+        seq_num = 0
+        while self.run_flag:
+            deadline = start + seq_num * interval + self.random.gauss(0, self.jitter)
+            delay = deadline - monotonic()
+            if delay > 0:
+                sleep(delay)
+            if self.access_units is not None:
+                # encoded frames are never skipped, dropping one would corrupt the following ones
+                au = self.access_units[seq_num % len(self.access_units)]
+                message = SimulatedPacket(au, seq_num, timedelta(seconds=monotonic()))
+                for queue in self.queues:
+                    queue.send(message)
+            elif self.random.random() >= self.drop_rate:
+                img = self.next_image(seq_num)
+                if img is not None:
+                    message = SimulatedFrame(img, seq_num, timedelta(seconds=monotonic()))
+                    for queue in self.queues:
+                        queue.send(message)
+            seq_num += 1
+
+    def getMxId(self):
+        return self.descriptor.mxid
+
+    def getOutputQueue(self, name, maxSize=4, blocking=False):
+        queue = SimulatedQueue(max_size=maxSize, blocking=blocking)
+        self.queues.append(queue)
+        if not self.thread.is_alive():
+            self.thread.start()
+        return queue
+
+    def close(self):
+        self.run_flag = False
+        for queue in self.queues:
+            queue.close()
+        if self.capture is not None:
+            self.capture.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SimulatedBackend(object):
+    def __init__(self, conf):
+        self.conf = conf
+        self.count = conf.get("count", 1)
+
+    def list_devices(self):
+        return [DeviceDescriptor(f"SIMULATED{i + 1}", f"simulated{i + 1}") for i in range(self.count)]
+
+    def open(self, descriptor, create_pipeline=None):
+        """ the device pipeline is not built, the virtual device produces its frames directly """
+        index = int(descriptor.mxid[len("SIMULATED"):]) - 1
+        logger.info(f"[SimulatedBackend] Opening {descriptor}")
+        return SimulatedDevice(descriptor, self.conf, index)
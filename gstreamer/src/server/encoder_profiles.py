@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+H.264 encoder profiles for SensorFactory, plus a calibration mode that measures candidate encoder
+settings on this machine and caches the best one per resolution/fps/stream count.
+
+A profile is {"element": "x264enc", "properties": {"speed-preset": "fast", ...}}.
+pipeline_conf "encoder": "auto" selects the calibrated profile (calibrating once if it is not cached yet).
+
+    python3 gstreamer/src/server/encoder_profiles.py --width 1920 --height 1080 --fps 30 --streams 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+from time import monotonic_ns, perf_counter
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+DEFAULT_PROFILE = {
+    "element": "x264enc",
+    "properties": {"speed-preset": "fast", "tune": "zerolatency"},
+}
+
+CALIBRATION_CACHE = "/gstreamer/logs/encoder_calibration.json"
+
+# raw formats each encoder takes without a conversion, the first one is used for other sources
+ENCODER_INPUT_FORMATS = {
+    "x264enc": ("I420", "NV12"),
+    "openh264enc": ("I420",),
+}
+
+# best quality first, calibration picks the first candidate that keeps up
+X264_PRESETS = ("fast", "faster", "veryfast", "superfast", "ultrafast")
+
+
+def encoder_launch_string(profile, name="encoder"):
+    profile = profile or DEFAULT_PROFILE
+    properties = []
+    for key, value in profile.get("properties", {}).items():
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        properties.append(f"{key}={value}")
+    return " ".join([profile["element"], f"name={name}"] + properties)
+
+
+def encoder_input_format(profile, source_format):
+    formats = ENCODER_INPUT_FORMATS.get((profile or DEFAULT_PROFILE)["element"], ("I420",))
+    return source_format if source_format in formats else formats[0]
+
+
+def candidate_profiles(fps):
+    candidates = []
+    if Gst.ElementFactory.find("x264enc") is not None:
+        for preset in X264_PRESETS:
+            for sliced in (False, True):
+                candidates.append({
+                    "element": "x264enc",
+                    "properties": {
+                        "speed-preset": preset,
+                        "tune": "zerolatency",
+                        "threads": 0,
+                        "sliced-threads": sliced,
+                        "key-int-max": 2 * fps,
+                    },
+                })
+    if Gst.ElementFactory.find("openh264enc") is not None:
+        for complexity in ("medium", "low"):
+            candidates.append({
+                "element": "openh264enc",
+                "properties": {"complexity": complexity, "gop-size": 2 * fps},
+            })
+    return candidates
+
+
+def measure_profile(profile, width, height, fps, frames=150):
+    """
+    Encode `frames` synthetic frames (moving test pattern) as fast as possible.
+    @return: {"fps": encoded frames per second, "latency_ms": mean per-frame encoder latency}
+    """
+    launch_string = f"videotestsrc num-buffers={frames} pattern=smpte horizontal-speed=8 " \
+                    f"! video/x-raw,format=I420,width={width},height={height},framerate={fps}/1 " \
+                    f"! {encoder_launch_string(profile)} ! fakesink name=sink sync=false"
+    pipeline = Gst.parse_launch(launch_string)
+    encoder = pipeline.get_by_name("encoder")
+
+    pushed = {}
+    latencies = []
+
+    def on_input(pad, info):
+        pushed[info.get_buffer().pts] = monotonic_ns()
+        return Gst.PadProbeReturn.OK
+
+    def on_output(pad, info):
+        start = pushed.pop(info.get_buffer().pts, None)
+        if start is not None:
+            latencies.append(monotonic_ns() - start)
+        return Gst.PadProbeReturn.OK
+
+    encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, on_input)
+    encoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, on_output)
+
+    start = perf_counter()
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(120 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    elapsed = perf_counter() - start
+    pipeline.set_state(Gst.State.NULL)
+
+    if message is None or message.type == Gst.MessageType.ERROR:
+        logger.warning(f"[measure_profile] {encoder_launch_string(profile)} failed")
+        return None
+    return {
+        "fps": round(frames / elapsed, 1),
+        "latency_ms": round(sum(latencies) / len(latencies) / 1e6, 2) if latencies else None,
+    }
+
+
+def calibration_key(width, height, fps, streams):
+    return f"{platform.node()}:{os.cpu_count()}:{width}x{height}@{fps}:{streams}"
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, encoding="UTF-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def calibrate(width, height, fps, streams=1, cache_path=CALIBRATION_CACHE, refresh=False):
+    """
+    Pick the best quality profile whose throughput covers `streams` concurrent streams at `fps`
+    with a frame interval of latency at most. Falls back to the highest throughput profile.
+    """
+    _log_prefix = "[calibrate]\n-- "
+    key = calibration_key(width, height, fps, streams)
+    cache = load_cache(cache_path)
+    if key in cache and not refresh:
+        logger.info(f"{_log_prefix} Using cached encoder profile ({key}): {cache[key]['profile']}")
+        return cache[key]["profile"]
+
+    required_fps = fps * streams
+    results = []
+    for profile in candidate_profiles(fps):
+        measurement = measure_profile(profile, width, height, fps)
+        if measurement is None:
+            continue
+        logger.info(f"{_log_prefix} {encoder_launch_string(profile)}: {measurement}")
+        results.append({"profile": profile, **measurement})
+    if not results:
+        logger.warning(f"{_log_prefix} No encoder could be measured, using the default profile")
+        return DEFAULT_PROFILE
+
+    frame_interval_ms = 1e3 / fps
+    passing = [r for r in results
+               if r["fps"] >= required_fps and (r["latency_ms"] is None or r["latency_ms"] <= frame_interval_ms)]
+    best = passing[0] if passing else max(results, key=lambda r: r["fps"])
+    if not passing:
+        logger.warning(f"{_log_prefix} No encoder reaches {required_fps} fps, using the fastest one")
+
+    cache[key] = {"profile": best["profile"], "fps": best["fps"], "latency_ms": best["latency_ms"],
+                  "required_fps": required_fps, "candidates": results}
+    try:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(cache_path, 'w', encoding="UTF-8") as f:
+            json.dump(cache, f, indent=2)
+    except OSError as err:
+        logger.warning(f"{_log_prefix} Could not save the calibration cache ({cache_path}): {err}")
+    return best["profile"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--streams", type=int, default=1, help="streams encoded concurrently on this machine")
+    parser.add_argument("--cache", default=CALIBRATION_CACHE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.INFO)
+    Gst.init(None)
+    profile = calibrate(args.width, args.height, args.fps, args.streams, args.cache, refresh=True)
+    print(f"selected: {encoder_launch_string(profile)}")
+
+
+if __name__ == "__main__":
+    main()
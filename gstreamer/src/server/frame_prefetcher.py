@@ -0,0 +1,132 @@
+import logging
+import threading
+from collections import deque
+from time import sleep
+
+import cv2
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+# queued after the last frame of a file that does not loop
+END_OF_STREAM = object()
+
+
+class FramePrefetcher(object):
+    """
+    Decodes a cv2.VideoCapture on its own thread into a bounded ring of ready frames, so appsrc need-data
+    only dequeues. Files are paced by the consumer (the decoder waits while the ring is full) and optionally
+    loop at the end; live sources (webcam) never wait and overwrite their oldest frame instead.
+    """
+
+    def __init__(self, cap, name, depth=4, loop=True, live=False):
+        assert depth > 0
+        self.cap = cap
+        self.name = name
+        self.depth = depth
+        self.loop = loop
+        self.live = live
+        self.run_flag = True
+        # set while nobody consumes the frames (on demand mounts without clients), decoding waits
+        self.paused = False
+        self.decoded_frames = 0
+        self.dropped_frames = 0
+        self.underruns = 0
+        self.loops = 0
+
+        self._frames = deque()
+        self._cond = threading.Condition()
+        self.thread = threading.Thread(target=self.decode, name=f"prefetch_{name}", daemon=True)
+
+    def start(self, timeout=1):
+        """
+        Starts decoding, or restarts it once the previous thread has ended (end of a file that does not loop,
+        a failed capture, stop()): the ring is emptied and files are rewound to their first frame.
+        """
+        if self.thread.is_alive():
+            if self.run_flag:
+                return
+            # stopped but still finishing a read
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logger.warning(f"[{self.name}.start] Previous decode thread is still running")
+                return
+        if self.thread.ident is not None:
+            with self._cond:
+                self._frames.clear()
+                self.run_flag = True
+            if not self.live:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.thread = threading.Thread(target=self.decode, name=f"prefetch_{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self._cond:
+            self.run_flag = False
+            self._cond.notify_all()
+
+    def pause(self):
+        with self._cond:
+            self.paused = True
+
+    def resume(self):
+        with self._cond:
+            self.paused = False
+            self._cond.notify_all()
+
+    def _put(self, frame):
+        with self._cond:
+            while not self.live and len(self._frames) >= self.depth and self.run_flag:
+                self._cond.wait()
+            if len(self._frames) >= self.depth:
+                self._frames.popleft()
+                self.dropped_frames += 1
+            self._frames.append(frame)
+            self._cond.notify_all()
+
+    def decode(self):
+        _log_prefix = f"[{self.name}.decode]\n-- "
+        frames_since_loop = 0
+        while self.run_flag and self.cap.isOpened():
+            with self._cond:
+                self._cond.wait_for(lambda: not self.paused or not self.run_flag)
+            ret, frame = self.cap.read()
+            if not ret:
+                if self.live:
+                    logger.warning(f"{_log_prefix} Could not read a frame from the live source")
+                    sleep(0.1)
+                    continue
+                if not self.loop or frames_since_loop == 0:
+                    logger.info(f"{_log_prefix} End of file")
+                    self._put(END_OF_STREAM)
+                    return
+                self.loops += 1
+                frames_since_loop = 0
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                continue
+            frames_since_loop += 1
+            self.decoded_frames += 1
+            self._put(frame)
+
+    def get(self, timeout):
+        """
+        @return: the next frame, None if none was decoded within `timeout` seconds, or END_OF_STREAM
+        """
+        with self._cond:
+            if not self._frames and not self._cond.wait_for(lambda: self._frames or not self.run_flag, timeout):
+                self.underruns += 1
+                return None
+            if not self._frames:
+                return None
+            frame = self._frames[0] if self._frames[0] is END_OF_STREAM else self._frames.popleft()
+            self._cond.notify_all()
+            return frame
+
+    def stats(self):
+        return {
+            "decoded_frames": self.decoded_frames,
+            "dropped_frames": self.dropped_frames,
+            "underruns": self.underruns,
+            "loops": self.loops,
+            "queued_frames": len(self._frames),
+        }
@@ -0,0 +1,112 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter
+
+from gstreamer.common_utils.stage_stats import StageStats
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+class _Lane(object):
+    """ Frames of one stream that are in flight, oldest first """
+
+    def __init__(self, max_pending):
+        self.lock = threading.Lock()
+        self.futures = deque()
+        # bounds frames queued or being processed, the stream's reader blocks when it is exhausted
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+
+class FrameProcessor(object):
+    """
+    Runs `process(stream_id, img, seq_num)` on a bounded worker pool (opencv releases the GIL,
+    so resizes scale across cores) and hands results to `deliver(result)` in frame order per stream.
+    `discard(result)` (optional) gets the results whose delivery failed, to give back what they hold.
+    With workers=0 everything runs inline on the calling thread.
+    """
+
+    def __init__(self, process, deliver, workers=4, max_pending=8, report_interval=60, discard=None):
+        assert workers >= 0
+        assert max_pending > 0
+        self.process = process
+        self.deliver = deliver
+        self.discard = discard
+        self.workers = workers
+        self.max_pending = max_pending
+        self.report_interval = report_interval
+        self.stats = StageStats(name="frame_processor")
+
+        self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame_processor")
+        self._lanes = {}
+        self._lanes_lock = threading.Lock()
+        self._last_report = monotonic()
+
+    def _get_lane(self, stream_id):
+        with self._lanes_lock:
+            lane = self._lanes.get(stream_id)
+            if lane is None:
+                lane = self._lanes[stream_id] = _Lane(self.max_pending)
+            return lane
+
+    def _timed_process(self, submitted, stream_id, img, seq_num):
+        start = perf_counter()
+        self.stats.record("queue_wait", start - submitted)
+        result = self.process(stream_id, img, seq_num)
+        self.stats.record("process", perf_counter() - start)
+        return result
+
+    def _timed_deliver(self, result):
+        try:
+            with self.stats.measure("deliver"):
+                self.deliver(result)
+        except Exception:
+            if self.discard is not None:
+                self.discard(result)
+            raise
+
+    def submit(self, stream_id, img, seq_num):
+        if self._executor is None:
+            result = self._timed_process(perf_counter(), stream_id, img, seq_num)
+            if result is not None:
+                self._timed_deliver(result)
+            self._maybe_report()
+            return
+
+        lane = self._get_lane(stream_id)
+        lane.slots.acquire()
+        with lane.lock:
+            future = self._executor.submit(self._timed_process, perf_counter(), stream_id, img, seq_num)
+            lane.futures.append(future)
+        future.add_done_callback(lambda _: self._drain(stream_id, lane))
+
+    def _drain(self, stream_id, lane):
+        # deliver completed frames from the head of the lane only, so a slow frame holds back newer ones
+        with lane.lock:
+            while lane.futures and lane.futures[0].done():
+                future = lane.futures.popleft()
+                try:
+                    result = future.result()
+                    if result is not None:
+                        self._timed_deliver(result)
+                except Exception as ProcessingError:
+                    logger.error(f"[FrameProcessor] stream_id=({stream_id}) processing error: {ProcessingError}")
+                finally:
+                    lane.slots.release()
+        self._maybe_report()
+
+    def _maybe_report(self):
+        now = monotonic()
+        if now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+        self.stats.log_summary()
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.stats.log_summary()
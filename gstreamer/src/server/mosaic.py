@@ -0,0 +1,156 @@
+"""
+Mosaic mount: the raw frames of several SensorFactory streams tiled into one canvas, encoded once by a
+SensorFactory of its own (source type "mosaic"), so a video wall pulls and decodes a single stream however
+many cameras there are.
+
+Tiles are downscaled from the frames the camera factories are pushed anyway (SensorFactory frame listeners),
+no camera is decoded or read a second time. While the mosaic mount has clients the camera factories report
+themselves active, so their frames keep flowing even when nobody watches the camera mounts themselves.
+Only pushed (oakd) streams can be tiled: file and webcam frames are pulled by need-data of their own running
+mount, encoded streams have no frames in memory.
+"""
+
+import logging
+import math
+import threading
+from time import monotonic, perf_counter, sleep
+
+import cv2
+import numpy as np
+
+from gstreamer.common_utils import yuv
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+def grid_layout(count, width, height):
+    """
+    @return: (columns, rows, tile_width, tile_height) of the most square grid holding `count` tiles
+    """
+    columns = max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / columns))
+    # even tile sizes keep yuv sources resizable plane by plane
+    return columns, rows, (width // columns) & ~1, (height // rows) & ~1
+
+
+class MosaicCompositor(object):
+    """
+    Owns a BGR canvas of the mosaic factory's size. add_frame() (called by the camera factories, from their
+    pushing threads) resizes a frame into its tile at most `fps` times per second; a ticker thread pushes
+    the canvas to the mosaic factory at `fps` while it is active. Tiles without a frame for `stale_seconds`
+    are blanked.
+    """
+
+    def __init__(self, factory, sources, conf):
+        self.factory = factory
+        self.fps = factory.fps
+        self.interval = 1 / self.fps
+        self.stale_seconds = conf.get("stale_seconds", 2)
+        self.interpolation = cv2.INTER_AREA
+
+        # only pushed raw streams reach the frame listeners: encoded ones (device h264, passthrough files) have no
+        # frames in memory, file/webcam ones only decode while their own mount runs
+        self.sources = [source for source in sources if source.encoding == "raw" and source.cap is None]
+        encoded = [source.name for source in sources if source.encoding != "raw"]
+        if encoded:
+            logger.warning(f"[MosaicCompositor] Encoded streams can not be tiled, skipping {encoded}")
+        pulled = [source.name for source in sources if source.encoding == "raw" and source.cap is not None]
+        if pulled:
+            logger.warning(f"[MosaicCompositor] File/webcam streams can not be tiled, skipping {pulled}")
+        columns, rows, tile_width, tile_height = grid_layout(len(self.sources), factory.width, factory.height)
+        self.tile_size = (tile_width, tile_height)
+        # stream name -> (x, y) of its tile
+        self.tiles = {source.name: ((i % columns) * tile_width, (i // columns) * tile_height)
+                      for i, source in enumerate(self.sources)}
+        self.canvas = np.zeros((factory.height, factory.width, 3), dtype=np.uint8)
+        self.last_update = {source.name: None for source in self.sources}
+
+        self.run_flag = True
+        self.pushed_frames = 0
+        self.tile_updates = 0
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.tick, name=f"mosaic_{factory.name}", daemon=True)
+        for source in self.sources:
+            source.add_frame_listener(self)
+
+    def is_active(self):
+        return self.factory.is_active()
+
+    def add_frame(self, name, frame, frame_format):
+        """
+        Called by a source factory with each frame it is pushed, the frame is only read during the call
+        """
+        if name not in self.tiles or not self.is_active():
+            return
+        now = monotonic()
+        last = self.last_update[name]
+        if last is not None and now - last < self.interval:
+            return
+        self.last_update[name] = now
+        # fit the frame in its tile keeping its aspect ratio, the margins stay black
+        tile_width, tile_height = self.tile_size
+        frame_width, frame_height = yuv.frame_size(frame, frame_format)
+        scale = min(tile_width / frame_width, tile_height / frame_height)
+        width, height = int(frame_width * scale) & ~1, int(frame_height * scale) & ~1
+        # yuv frames are resized plane by plane, the small tile is converted to BGR afterwards
+        tile = yuv.to_bgr(yuv.resize(frame, frame_format, width, height, interpolation=self.interpolation),
+                          frame_format)
+        x, y = self.tiles[name]
+        x += (tile_width - width) // 2
+        y += (tile_height - height) // 2
+        with self._lock:
+            self.canvas[y:y + height, x:x + width] = tile
+        self.tile_updates += 1
+
+    def blank_stale_tiles(self, now):
+        tile_width, tile_height = self.tile_size
+        for name, last in self.last_update.items():
+            if last is not None and now - last > self.stale_seconds:
+                x, y = self.tiles[name]
+                with self._lock:
+                    self.canvas[y:y + tile_height, x:x + tile_width] = 0
+                self.last_update[name] = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=2):
+        """ stops the ticker and the mosaic's encoder pipeline, the sources no longer report the mosaic active """
+        self.run_flag = False
+        for source in self.sources:
+            source.frame_listeners.remove(self)
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self.factory.stop_pipeline()
+
+    def tick(self):
+        _log_prefix = f"[MosaicCompositor.tick({self.factory.name})]\n-- "
+        start = perf_counter()
+        ticks = 0
+        while self.run_flag:
+            ticks += 1
+            delay = start + ticks * self.interval - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            else:
+                # fell behind (e.g. the mount was idle), restart the schedule instead of bursting
+                start, ticks = perf_counter(), 0
+            if not self.factory.is_active():
+                continue
+            self.blank_stale_tiles(monotonic())
+            pool_index, frame = self.factory.acquire_frame()
+            with self._lock:
+                if frame is None:
+                    frame = self.canvas.copy()
+                else:
+                    np.copyto(frame, self.canvas)
+            try:
+                self.factory.push(frame=frame, src_name=self.factory.name, pool_index=pool_index)
+                self.pushed_frames += 1
+            except Exception as PushError:
+                logger.error(f"{_log_prefix} {PushError}")
+
+    def stats(self):
+        return {"sources": list(self.tiles), "tile_size": self.tile_size, "pushed_frames": self.pushed_frames,
+                "tile_updates": self.tile_updates}
@@ -1,11 +1,19 @@
 import depthai as dai
 from threading import Thread
 import logging
-import cv2
 from pprint import pprint
 import contextlib
-from time import sleep
+from functools import partial
+from time import sleep, monotonic
 from gstreamer.src.server.rtsp_server import GstServer
+from gstreamer.src.server.frame_processor import FrameProcessor
+from gstreamer.src.server.stream_router import StreamRouter
+from gstreamer.common_utils.frame_trace import FrameTracer
+from gstreamer.common_utils import yuv
+from gstreamer.common_utils.snapshot_writer import SnapshotWriter
+from gstreamer.common_utils.blob_uploader import BlobUploader
+from gstreamer.src.server.devices import create_backend, read_video_frame
+from gstreamer.src.server.camera_workers import CameraWorkers
 
 logger = logging.getLogger(__name__)
 logging.getLogger(__name__).setLevel(logging.WARNING)
@@ -21,6 +29,9 @@ class CameraPipeline(object):
         # Camera output queues to pass data to gstreamer thread
         self.pipeline = []
         self.q_dict = {}
+        # frames received per stream and when the last one arrived, updated by the reader threads
+        self.frame_counts = {}
+        self.last_frame_time = {}
         # Class configs
         self.conf = None
         self.camera_count = 0
@@ -28,8 +39,50 @@ class CameraPipeline(object):
         # Load configs, instantiate gstreamer App & OakD camera app
         self.set_configs(conf['camera'])
 
+        # real OAK-D devices, or simulated ones to load test without hardware
+        self.device_backend = create_backend(self.conf.get('device_backend'))
+
+        # per-frame stage tracing, exported as a chrome trace when the camera thread stops
+        trace = self.conf.get('trace', {})
+        self.tracer = FrameTracer(max_frames=trace.get('max_frames', 5000)) if trace.get('enabled') else None
+
+        # finished recordings and snapshots are queued for upload to blob storage
+        self.uploader = None
+        if self.conf.get('upload', {}).get('enabled', False):
+            self.uploader = BlobUploader(self.conf['upload'])
+        on_written = self.uploader.enqueue if self.uploader is not None else None
+        # the recording quota only deletes a file before it is uploaded past its hard limit
+        keep_recording = self.uploader.is_pending if self.uploader is not None else None
+        drop_recording = self.uploader.drop if self.uploader is not None else None
+
         # Main Thread objects
-        self.gst_app = GstServer(conf['rtsp'])
+        self.gst_app = GstServer(conf['rtsp'], tracer=self.tracer, on_recorded=on_written,
+                                 keep_recording=keep_recording, drop_recording=drop_recording)
+        # device mxid -> camera name -> SensorFactory, bound as devices are opened
+        self.router = StreamRouter(self.conf['cameras'], self.gst_app.pipelines,
+                                   default_stream=self.conf.get('default_stream'))
+        # resize/push run on a worker pool, results are pushed in frame order per stream
+        processing = self.conf.get('processing', {})
+        self.processor = FrameProcessor(self.process_frame, self.deliver_frame,
+                                        workers=processing.get('workers', 4),
+                                        max_pending=processing.get('max_pending', 8),
+                                        report_interval=processing.get('report_interval', 60),
+                                        discard=self.discard_frame)
+        # frames stored as images (rate limited, written by a worker pool off the capture threads)
+        self.snapshots = None
+        if self.conf['store_img_enabled']:
+            self.snapshots = SnapshotWriter.from_conf(self.conf.get('snapshots', {}), on_written=on_written)
+        # optionally capture/resize every raw camera in its own process, frames come back through shared memory
+        processes = self.conf.get('processes', {})
+        self.workers = None
+        if processes.get('enabled', False):
+            self.workers = CameraWorkers(self.conf, partial(self.create_pipeline, self.conf, "raw"),
+                                         tracer=self.tracer,
+                                         slots=processes.get('slots', 6),
+                                         restart_delay=processes.get('restart_delay', 2),
+                                         frame_counts=self.frame_counts,
+                                         last_frame_time=self.last_frame_time,
+                                         snapshots=self.snapshots)
         self.thread = Thread(target=self.run, daemon=True)
 
     def set_configs(self, conf):
@@ -47,18 +100,54 @@ class CameraPipeline(object):
             assert isinstance(key, str)
             assert isinstance(value, int)
 
+        assert isinstance(conf['cameras'], dict)
+        for key, value in conf['cameras'].items():
+            assert isinstance(key, str)
+            assert isinstance(value, str)
+
+        if conf.get('default_stream') is not None:
+            assert isinstance(conf['default_stream'], str)
+
         assert isinstance(conf['store_img_enabled'], bool)
         assert isinstance(conf['gst_enabled'], bool)
 
         assert isinstance(conf['connection'], str)
         assert isinstance(conf['timezone'], str)
 
+        if conf.get('device_backend') is not None:
+            assert isinstance(conf['device_backend'], dict)
+            assert conf['device_backend']['type'] in ("depthai", "simulated")
+
+        if 'trace' in conf:
+            assert isinstance(conf['trace'], dict)
+            assert isinstance(conf['trace'].get('enabled', False), bool)
+
+        if 'snapshots' in conf:
+            assert isinstance(conf['snapshots'], dict)
+
+        if 'upload' in conf:
+            assert isinstance(conf['upload'], dict)
+            assert isinstance(conf['upload'].get('enabled', False), bool)
+            if conf['upload'].get('enabled', False):
+                assert conf['upload']['backend']['type'] in ("azure", "filesystem")
+
+        if 'processes' in conf:
+            assert isinstance(conf['processes'], dict)
+            assert isinstance(conf['processes'].get('enabled', False), bool)
+
+        if 'processing' in conf:
+            assert isinstance(conf['processing'], dict)
+            for key, value in conf['processing'].items():
+                assert isinstance(key, str)
+                assert isinstance(value, int)
+
         self.conf = conf
 
-    def load_cam_resolution(self):
+    @staticmethod
+    def load_cam_resolution(conf):
         _log_prefix = "[load_cam_resolution]\n-- "
 
-        code = self.conf['camera_caps']['resolution']
+        code = conf['camera_caps']['resolution']
         res = None
 
         if code.lower() == "1080p":
@@ -76,10 +165,11 @@ class CameraPipeline(object):
             raise RuntimeError
         return res
 
-    def load_cam_color_order(self):
+    @staticmethod
+    def load_cam_color_order(conf):
         _log_prefix = "[load_cam_color]\n-- "
 
-        code = self.conf['camera_caps']['color_order']
+        code = conf['camera_caps']['color_order']
         res = None
 
         if code.lower() == "rgb":
@@ -106,7 +196,13 @@ class CameraPipeline(object):
             raise RuntimeError
         return state
 
-    def create_pipeline(self):
+    @staticmethod
+    def create_pipeline(conf, encoding="raw"):
+        """
+        encoding="raw": frames are sent to the host for resize and x264enc
+        encoding="h264": the on-board video encoder compresses the frames, the host only payloads them
+        Static so camera worker processes can build the device pipeline without a CameraPipeline.
+        """
         _log_prefix = "[create_pipeline]\n-- "
         logger.info(f"{_log_prefix} Creating pipeline")
 
@@ -123,16 +219,26 @@ class CameraPipeline(object):
         # Set properties for camera video component
         # video_in.setPreviewSize(self.conf['frame_nn']['width'], self.conf['frame_nn']['height'])
         video_in.setBoardSocket(dai.CameraBoardSocket.RGB)
+        # only applies to the preview output, the video output is always NV12 (see read_frame)
         video_in.setInterleaved(False)
-        video_in.setFps(int(self.conf["camera_caps"]["fps"]))
-        video_in.setResolution(self.load_cam_resolution())
-        video_in.setColorOrder(self.load_cam_color_order())
+        video_in.setFps(int(conf["camera_caps"]["fps"]))
+        video_in.setResolution(CameraPipeline.load_cam_resolution(conf))
+        video_in.setColorOrder(CameraPipeline.load_cam_color_order(conf))
 
         # Set queue extraction <name>, extract with q = `device.getOutputQueue(<name>)`
         video_out.setStreamName("video")
 
         """ Linking """
-        video_in.video.link(video_out.input)
+        if encoding == "h264":
+            fps = int(conf["camera_caps"]["fps"])
+            video_enc = p.create(dai.node.VideoEncoder)
+            video_enc.setDefaultProfilePreset(fps, dai.VideoEncoderProperties.Profile.H264_MAIN)
+            # one keyframe per second, so rtsp clients can join quickly
+            video_enc.setKeyframeFrequency(fps)
+            video_in.video.link(video_enc.input)
+            video_enc.bitstream.link(video_out.input)
+        else:
+            video_in.video.link(video_out.input)
 
         """ Property check """
         logger.info(f"{_log_prefix} CAMERA \n"
@@ -143,9 +249,9 @@ class CameraPipeline(object):
                     f"\theight=({video_in.getStillHeight()})"
                     )
         # Catch errors where FPS is not possible
-        if int(video_in.getFps()) != int(self.conf['camera_caps']['fps']):
+        if int(video_in.getFps()) != int(conf['camera_caps']['fps']):
             logger.debug(f"{_log_prefix} Cannot run camera at this fps\n"
-                         f"\tGiven FPS ({self.conf['camera_caps']['fps']})\n"
+                         f"\tGiven FPS ({conf['camera_caps']['fps']})\n"
                          f"\tDevice FPS ({video_in.getFps()})")
             raise RuntimeError
 
@@ -154,93 +260,212 @@ class CameraPipeline(object):
     def send_frames(self, stream_id, img, seq_num):
         _log_prefix = "[send_frames]\n-- "
 
-        resized = cv2.resize(img, (self.conf['frame_resize']['width'], self.conf['frame_resize']['height']),
-                             interpolation=cv2.INTER_AREA)
-
-        if self.conf['gst_enabled']:
+        factory = self.router.route(stream_id)
+        if self.conf['gst_enabled'] and factory is not None and factory.is_active():
             logging.info(f"Sending video frame to stream: {stream_id}")
-            if stream_id == "camera1":
-                self.gst_app.pipelines[0].push(frame=resized, src_name=stream_id)
-                logging.debug("Sending frame to camera1")
-            elif stream_id == "camera2":
-                self.gst_app.pipelines[1].push(frame=resized, src_name=stream_id)
-                logging.debug("Sending frame to camera2")
-            elif stream_id == "camera3":
-                self.gst_app.pipelines[2].push(frame=resized, src_name=stream_id)
-                logging.debug("Sending frame to camera3")
+            self.processor.submit(stream_id, img, seq_num)
 
         if seq_num == 0 or seq_num % 3600 == 0:
             logger.info(f"{_log_prefix} src=({stream_id}) count=({seq_num})")
 
+    def process_frame(self, stream_id, img, seq_num):
+        """
+        Runs on the FrameProcessor worker pool: resize the frame for its stream. The frame number travels in
+        the stream as SEI metadata (see SensorFactory.stamp), the image itself is not modified.
+        @return: (stream_id, factory, frame, pool_index, seq_num), or None if the stream is not served
+        """
+        factory = self.router.route(stream_id)
+        if factory is None or not factory.is_active():
+            return None
+
+        width = self.conf['frame_resize']['width']
+        height = self.conf['frame_resize']['height']
+        pool_index = None
+        if yuv.frame_size(img, factory.format) == (width, height):
+            # source already has the output size, push the device frame itself
+            resized = img
+        else:
+            # resize straight into a pooled frame that is pushed to gstreamer without a copy
+            with self.processor.stats.measure("resize"):
+                pool_index, dst = factory.acquire_frame()
+                resized = yuv.resize(img, factory.format, width, height, dst=dst)
+            if resized is not dst:
+                # frame_resize differs from the stream caps, opencv allocated a new output
+                factory.release_frame(pool_index)
+                pool_index = None
+
+        if self.tracer is not None:
+            self.tracer.mark(stream_id, seq_num, "processed")
+        return stream_id, factory, resized, pool_index, seq_num
+
+    @staticmethod
+    def deliver_frame(result):
+        stream_id, factory, frame, pool_index, seq_num = result
+        factory.push(frame=frame, src_name=stream_id, pool_index=pool_index, seq_num=seq_num)
+        logging.debug(f"Sending frame to {stream_id}")
+
+    @staticmethod
+    def discard_frame(result):
+        # delivery failed: the pooled frame was not pushed, give it back or the pool runs dry
+        stream_id, factory, frame, pool_index, seq_num = result
+        factory.release_frame(pool_index)
+
+    def send_encoded(self, stream_id, factory, packet):
+        """
+        Access unit encoded on the device: no decode, resize or host encode, straight to the payloader
+        """
+        seq_num = packet.getSequenceNum()
+        capture_ns = int(packet.getTimestamp().total_seconds() * 1e9)
+        if self.tracer is not None:
+            self.tracer.mark(stream_id, seq_num, "capture", capture_ns)
+            self.tracer.mark(stream_id, seq_num, "dequeue")
+        if self.conf['gst_enabled']:
+            factory.push(frame=packet.getData(), src_name=stream_id, seq_num=seq_num, capture_ns=capture_ns)
+
+    def read_frame(self, video, frame_format):
+        """
+        The ColorCamera video output is NV12, only BGR (and I420) streams need a host conversion
+        """
+        if frame_format == "NV12":
+            return read_video_frame(video, frame_format)
+        with self.processor.stats.measure("host_convert"):
+            return read_video_frame(video, frame_format)
+
     def unpack_queue(self, stream_id, queue):
         _log_prefix = "[unpack_queue]\n --"
 
         img = None
-        payload = None
-        frame_width = None
-        frame_height = None
-
         video = queue['video'].get()
 
+        factory = self.router.route(stream_id)
+        # the snapshot rate limit is checked before the frame is converted, rejected frames cost nothing
+        snapshot = self.snapshots is not None and video is not None \
+            and (factory is None or factory.encoding == "raw") and self.snapshots.admit(stream_id)
+        if factory is not None and not factory.is_active() and not snapshot:
+            # on demand mount without clients: the queue is drained, nothing else is done with the frame
+            return
+        if video is not None and factory is not None and factory.encoding == "h264":
+            self.send_encoded(stream_id, factory, video)
+            return
+
         if video is not None:
             # logging.debug(f"{_log_prefix} Got an image (v_counter = {video.getSequenceNum()})")
-            img = video.getCvFrame()
-            frame_width = img.shape[0]
-            frame_height = img.shape[1]
-            f_n = video.getSequenceNum()
-            cv2.putText(img, f"frame({f_n})", (2, frame_height - 4), cv2.FONT_HERSHEY_TRIPLEX, 0.4, (255, 255, 255))
+            # device timestamps are synced to the host monotonic clock
+            seq_num = video.getSequenceNum()
+            capture_ns = int(video.getTimestamp().total_seconds() * 1e9)
+            if factory is not None:
+                factory.stamp(seq_num, capture_ns)
+            if self.tracer is not None:
+                self.tracer.mark(stream_id, seq_num, "capture", capture_ns)
+                self.tracer.mark(stream_id, seq_num, "dequeue")
+            img = self.read_frame(video, factory.format if factory is not None else "BGR")
 
         # If the frame is available, send to gstreamer pipeline and azure
         if img is not None:
+            if snapshot:
+                self.snapshots.submit(stream_id, img, video.getSequenceNum(),
+                                      factory.format if factory is not None else "BGR", admitted=True)
             self.send_frames(stream_id, img, video.getSequenceNum())
 
+    def read_device(self, stream_id, queue):
+        _log_prefix = f"[read_device({stream_id})]\n-- "
+        logger.info(f"{_log_prefix} Starting reader")
+
+        while self.run_flag:
+            try:
+                self.unpack_queue(stream_id, queue)
+                self.frame_counts[stream_id] += 1
+                self.last_frame_time[stream_id] = monotonic()
+
+            except Exception as ThreadError:
+                # only this camera stops, the other readers keep streaming
+                logging.error(f"{_log_prefix} Camera pipeline error [stream_id=({stream_id})]: {ThreadError}")
+                return
+
+    def monitor_readers(self, readers, interval=10, stall_timeout=5):
+        _log_prefix = "[monitor_readers]\n-- "
+
+        last_counts = dict(self.frame_counts)
+        last_report = monotonic()
+        while self.run_flag and any(reader.is_alive() for reader in readers):
+            sleep(interval)
+            now = monotonic()
+            elapsed = now - last_report
+            fps = {stream_id: round((count - last_counts[stream_id]) / elapsed, 1)
+                   for stream_id, count in self.frame_counts.items()}
+            logger.info(f"{_log_prefix} fps={fps} aggregate={round(sum(fps.values()), 1)}")
+            logger.info(f"{_log_prefix} gstreamer={self.gst_app.stats()}")
+            if self.workers is not None:
+                logger.info(f"{_log_prefix} workers={self.workers.stats()}")
+            if self.snapshots is not None:
+                logger.info(f"{_log_prefix} snapshots={self.snapshots.stats()}")
+            if self.uploader is not None:
+                logger.info(f"{_log_prefix} upload={self.uploader.stats()}")
+            if self.tracer is not None:
+                logger.info(f"{_log_prefix} stage latency={self.tracer.histograms()}")
+            for stream_id, last_frame in self.last_frame_time.items():
+                if now - last_frame > stall_timeout:
+                    logger.warning(f"{_log_prefix} stream_id=({stream_id}) stalled for {round(now - last_frame, 1)}s")
+            last_counts = dict(self.frame_counts)
+            last_report = now
+
     def run(self):
         _log_prefix = '[run]\n-- '
         logger.info(f"{_log_prefix} Starting thread")
 
+        readers = []
         with contextlib.ExitStack() as stack:
-            deviceInfos = dai.Device.getAllAvailableDevices()
-            usbSpeed = dai.UsbSpeed.SUPER
-            openVinoVersion = dai.OpenVINO.Version.VERSION_2021_4
-
-            devices = []
-            counter = 0
-            for deviceInfo in deviceInfos:
-                deviceInfo: dai.DeviceInfo
-                device: dai.Device = stack.enter_context(dai.Device(openVinoVersion, deviceInfo, usbSpeed))
-                devices.append(device)
-                print("===Connected to ", deviceInfo.getMxId())
-                mxId = device.getMxId()
-                cameras = device.getConnectedCameras()
-                usbSpeed = device.getUsbSpeed()
-                eepromData = device.readCalibration2().getEepromData()
-                print("   >>> MXID:", mxId)
-                print("   >>> Num of cameras:", len(cameras))
-                print("   >>> USB speed:", usbSpeed)
-                print("   >>> IPAddress:", deviceInfo.name)
-                if eepromData.boardName != "":
-                    print("   >>> Board name:", eepromData.boardName)
-                if eepromData.productName != "":
-                    print("   >>> Product name:", eepromData.productName)
-                counter += 1
-                name = "camera" + str(counter)
-                device.startPipeline(self.create_pipeline())
-
+            for descriptor in self.device_backend.list_devices():
+                # resolve the stream before opening the device, unrouted devices are never read
+                name = self.router.bind(descriptor.mxid, descriptor.name)
+                if name is None:
+                    logger.warning(f"{_log_prefix} Skipping unrouted device (id={descriptor.mxid})")
+                    continue
+                factory = self.router.route(name)
+                if self.workers is not None and factory.encoding == "raw":
+                    # the worker process opens the device itself
+                    readers.append(self.workers.start_camera(name, descriptor.mxid, factory))
+                    logger.info(f"{_log_prefix} Started worker process for device "
+                                f"(ipAdress={descriptor.name}, id={descriptor.mxid})")
+                    continue
+                device = stack.enter_context(
+                    self.device_backend.open(descriptor, partial(self.create_pipeline, self.conf, factory.encoding)))
+
+                # raw frames may be skipped, the latest one wins; encoded access units depend on each other, the
+                # device waits for the reader rather than overwriting one
+                if factory.encoding == "h264":
+                    video_queue = device.getOutputQueue(name="video", maxSize=30, blocking=True)
+                else:
+                    video_queue = device.getOutputQueue(name="video", maxSize=2, blocking=False)
                 self.q_dict[name] = {
-                    "video": device.getOutputQueue(name="video", maxSize=2, blocking=False),
+                    "video": video_queue,
                 }
-                logger.info(f"{_log_prefix} Added camera pipeline for device (ipAdress={deviceInfo.name}, id={mxId})")
-
-            while self.run_flag:
-                for stream_id, queue in self.q_dict.items():
-                    try:
-                        logging.info(f"received {stream_id}")
-                        self.unpack_queue(stream_id, queue)
-
-                    except Exception as ThreadError:
-                        logging.error(f"{_log_prefix} Camera pipeline error [stream_id=({stream_id})]: {ThreadError}")
-                        self.run_flag = False
-
+                logger.info(f"{_log_prefix} Added camera pipeline for device "
+                            f"(ipAdress={descriptor.name}, id={descriptor.mxid})")
+
+            # every device is drained by its own reader, so a stalled camera never holds back the others
+            for stream_id, queue in self.q_dict.items():
+                self.frame_counts[stream_id] = 0
+                self.last_frame_time[stream_id] = monotonic()
+                reader = Thread(target=self.read_device, args=(stream_id, queue), name=f"reader_{stream_id}",
+                                daemon=True)
+                reader.start()
+                readers.append(reader)
+
+            self.monitor_readers(readers)
+
+        if self.workers is not None:
+            self.workers.stop()
+        self.processor.stop()
+        # nothing pushes camera frames anymore, the mosaic ticker goes with them
+        self.gst_app.stop()
+        if self.snapshots is not None:
+            self.snapshots.stop()
+        if self.uploader is not None:
+            # whatever is left stays queued and is uploaded after the next start
+            self.uploader.stop(drain_timeout=self.conf['upload'].get('drain_timeout', 10))
+        if self.tracer is not None:
+            self.tracer.export(self.conf['trace'].get('path', '/gstreamer/logs/frame_trace.json'))
         # Send commands to kill the other threads
         if self.conf['gst_enabled']:
             self.gst_app.run_flag = False
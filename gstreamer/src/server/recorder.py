@@ -0,0 +1,242 @@
+"""
+Recording of the encoded stream of a SensorFactory, as extra branches of its enc_tee (no re-encode):
+
+- SegmentRecorder: continuous recording into fixed duration, keyframe aligned mpegts segments (splitmuxsink),
+  with a disk quota enforced oldest-first whenever a segment is closed (files still waiting for upload are kept)
+- PreEventBuffer: the last N seconds of encoded access units kept in memory, written to a file when a
+  recording trigger fires (SensorFactory.trigger_recording)
+"""
+
+import glob
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+def recording_prefix(directory, name):
+    return os.path.join(directory, f"{name}_")
+
+
+def enforce_quota(directory, name, max_bytes, keep=None, hard_max_bytes=None, on_dropped=None):
+    """
+    Delete the oldest recordings of `name` until they fit in `max_bytes` (0 disables the quota).
+    keep: optional callable, recordings it returns True for are not deleted (e.g. not uploaded yet), unless the
+    recordings still exceed `hard_max_bytes` (default 2 * max_bytes) without them: then the oldest kept ones go
+    too and are passed to `on_dropped` (e.g. BlobUploader.drop)
+    @return: list of deleted files
+    """
+    if max_bytes <= 0:
+        return []
+    hard_max_bytes = hard_max_bytes or 2 * max_bytes
+    files = []
+    for path in glob.glob(f"{recording_prefix(directory, name)}*.ts"):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    deleted = []
+    kept = []
+    # the newest file is the one being written, it is never evicted
+    for _, size, path in files[:-1]:
+        if total <= max_bytes:
+            break
+        if keep is not None and keep(path):
+            kept.append((size, path))
+            continue
+        if _remove(path):
+            total -= size
+            deleted.append(path)
+    # e.g. an upload outage: the disk must not fill up, recordings that were never uploaded are lost
+    for size, path in kept:
+        if total <= hard_max_bytes:
+            break
+        if _remove(path):
+            total -= size
+            deleted.append(path)
+            logger.warning(f"[enforce_quota] Over the hard limit ({hard_max_bytes} bytes), deleted ({path}) "
+                           f"before it was uploaded")
+            if on_dropped is not None:
+                on_dropped(path)
+    return deleted
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as err:
+        logger.warning(f"[enforce_quota] Could not delete ({path}): {err}")
+        return False
+
+
+class SegmentRecorder(object):
+    """
+    splitmuxsink branch: a new segment every `segment_seconds`, cut at the next keyframe (and asking the
+    encoder for one), named <directory>/<name>_<YYYYmmdd-HHMMSS>_<fragment>.ts
+    """
+
+    def __init__(self, name, conf, on_recorded=None, keep=None, on_dropped=None):
+        self.name = name
+        self.directory = conf.get("directory", "/tmp")
+        # called with the path of every finished segment (e.g. BlobUploader.enqueue)
+        self.on_recorded = on_recorded
+        # called with a path before the quota deletes it, True keeps the file (e.g. BlobUploader.is_pending)
+        # until the recordings exceed hard_max_bytes, then on_dropped is told about each kept file deleted
+        self.keep = keep
+        self.on_dropped = on_dropped
+        self.hard_max_bytes = conf.get("hard_max_bytes")
+        self.segment_seconds = conf.get("segment_seconds", 60)
+        self.max_bytes = conf.get("max_bytes", 0)
+        self.segments = 0
+        self.evicted = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def branch(self):
+        return "queue name=record_queue leaky=downstream max-size-time=0 max-size-bytes=0 max-size-buffers=300 " \
+               "! h264parse name=record_parse " \
+               f"! splitmuxsink name=record_sink muxer-factory=mpegtsmux " \
+               f"max-size-time={int(self.segment_seconds * Gst.SECOND)} send-keyframe-requests=true"
+
+    def attach(self, pipeline):
+        pipeline.get_by_name("record_sink").connect("format-location", self.on_format_location)
+
+    def on_format_location(self, splitmux, fragment_id):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return f"{recording_prefix(self.directory, self.name)}{stamp}_{fragment_id:05d}.ts"
+
+    def on_fragment_closed(self, location):
+        self.segments += 1
+        if self.on_recorded is not None:
+            self.on_recorded(location)
+        deleted = enforce_quota(self.directory, self.name, self.max_bytes, keep=self.keep,
+                                hard_max_bytes=self.hard_max_bytes, on_dropped=self.on_dropped)
+        self.evicted += len(deleted)
+        logger.info(f"[{self.name}] Segment closed ({location}), evicted {len(deleted)} old recordings")
+
+    def stats(self):
+        return {"segments": self.segments, "evicted": self.evicted}
+
+
+class PreEventBuffer(object):
+    """
+    Keeps whole GOPs of encoded access units covering at least `seconds`, fed by an appsink branch.
+    trigger() writes them with a one-shot appsrc ! h264parse ! mpegtsmux ! filesink pipeline.
+    """
+
+    def __init__(self, name, conf, on_recorded=None, keep=None, on_dropped=None):
+        self.name = name
+        self.directory = conf.get("directory", "/tmp")
+        # called with the path of every event file written
+        self.on_recorded = on_recorded
+        # see SegmentRecorder
+        self.keep = keep
+        self.on_dropped = on_dropped
+        self.hard_max_bytes = conf.get("hard_max_bytes")
+        self.seconds = conf.get("pre_event_seconds", 10)
+        self.max_bytes = conf.get("max_bytes", 0)
+        self.caps = None
+        self.triggers = 0
+        # each GOP is a list of buffers starting with a keyframe
+        self._gops = deque()
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def branch(self):
+        return "queue name=pre_event_queue leaky=downstream " \
+               "! appsink name=pre_event_sink emit-signals=true sync=false max-buffers=30 drop=true"
+
+    def attach(self, pipeline):
+        pipeline.get_by_name("pre_event_sink").connect("new-sample", self.on_sample)
+
+    def on_sample(self, appsink):
+        sample = appsink.emit("pull-sample")
+        if sample is None:
+            return Gst.FlowReturn.EOS
+        buf = sample.get_buffer()
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.FlowReturn.OK
+        with self._lock:
+            self.caps = sample.get_caps()
+            if not buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                self._gops.append([])
+            elif not self._gops:
+                # the ring starts at a keyframe
+                return Gst.FlowReturn.OK
+            self._gops[-1].append(buf)
+            # drop the oldest GOP once the remaining ones still cover the window
+            while len(self._gops) > 1 and buf.pts - self._gops[1][0].pts >= self.seconds * Gst.SECOND:
+                self._gops.popleft()
+        return Gst.FlowReturn.OK
+
+    def buffered_seconds(self):
+        with self._lock:
+            if not self._gops:
+                return 0
+            return (self._gops[-1][-1].pts - self._gops[0][0].pts) / Gst.SECOND
+
+    def trigger(self, location=None):
+        """
+        Write the buffered access units to `location` (default <directory>/<name>_<YYYYmmdd-HHMMSS>_event.ts)
+        on a separate pipeline, so the live stream is not held up by the disk.
+        @return: the file written to, or None if nothing was buffered yet
+        """
+        with self._lock:
+            buffers = [buf for gop in self._gops for buf in gop]
+            caps = self.caps
+        if not buffers:
+            logger.warning(f"[{self.name}] Pre-event buffer is empty")
+            return None
+        if location is None:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            location = f"{recording_prefix(self.directory, self.name)}{stamp}_event.ts"
+        self.triggers += 1
+        threading.Thread(target=self.write, args=(buffers, caps, location), name=f"pre_event_{self.name}",
+                         daemon=True).start()
+        return location
+
+    def write(self, buffers, caps, location):
+        _log_prefix = f"[{self.name}.PreEventBuffer.write]\n-- "
+        pipeline = Gst.parse_launch("appsrc name=src format=time "
+                                    "! h264parse ! mpegtsmux ! filesink name=sink")
+        src = pipeline.get_by_name("src")
+        src.set_property("caps", caps)
+        pipeline.get_by_name("sink").set_property("location", location)
+        pipeline.set_state(Gst.State.PLAYING)
+
+        base = buffers[0].pts
+        for buf in buffers:
+            # shallow copies rebased to 0, the encoded memory is shared with the live branches
+            out = buf.copy()
+            out.pts = buf.pts - base
+            out.dts = buf.dts - base if buf.dts != Gst.CLOCK_TIME_NONE and buf.dts >= base else Gst.CLOCK_TIME_NONE
+            if src.emit("push-buffer", out) != Gst.FlowReturn.OK:
+                logger.error(f"{_log_prefix} Could not push to the pre-event pipeline")
+                break
+        src.emit("end-of-stream")
+
+        message = pipeline.get_bus().timed_pop_filtered(30 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if message is None or message.type == Gst.MessageType.ERROR:
+            logger.error(f"{_log_prefix} Writing ({location}) failed")
+        else:
+            logger.info(f"{_log_prefix} Wrote {len(buffers)} access units to ({location})")
+        pipeline.set_state(Gst.State.NULL)
+        if message is not None and message.type == Gst.MessageType.EOS and self.on_recorded is not None:
+            self.on_recorded(location)
+        enforce_quota(self.directory, self.name, self.max_bytes, keep=self.keep,
+                      hard_max_bytes=self.hard_max_bytes, on_dropped=self.on_dropped)
+
+    def stats(self):
+        return {"buffered_seconds": round(self.buffered_seconds(), 2), "triggers": self.triggers}
@@ -5,25 +5,62 @@
 import cv2
 import gi
 import logging
-from threading import Thread
+from threading import Lock, Thread
 import calendar
+from collections import OrderedDict
 from datetime import datetime
+from time import monotonic_ns, time_ns
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 gi.require_version('GstApp', '1.0')
-from gi.repository import Gst, GstRtspServer, GLib, GstApp, GObject
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstRtspServer, GLib, GstApp, GstVideo
+from gstreamer.common_utils.gst_buffer import FramePool, push_ndarray, push_copy, zero_copy_available
+from gstreamer.common_utils import sei, yuv
+from gstreamer.src.server.encoder_profiles import DEFAULT_PROFILE, calibrate, encoder_input_format, \
+    encoder_launch_string
+from gstreamer.src.server.frame_prefetcher import END_OF_STREAM, FramePrefetcher
+from gstreamer.src.server.mosaic import MosaicCompositor
+from gstreamer.src.server.recorder import PreEventBuffer, SegmentRecorder
 
 logger = logging.getLogger(__name__)
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
+BACKPRESSURE_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+def appsrc_has_property(name):
+    """ leaky-type / max-buffers only exist on appsrc from GStreamer 1.20 """
+    appsrc = Gst.ElementFactory.make("appsrc", None)
+    return appsrc is not None and appsrc.find_property(name) is not None
+
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
-    def __init__(self, pipeline_conf, **properties):
+    def __init__(self, pipeline_conf, tracer=None, on_recorded=None, keep_recording=None, drop_recording=None,
+                 **properties):
         super(SensorFactory, self).__init__(**properties)
         self.name = pipeline_conf["name"]
-
-        if pipeline_conf["source"]["type"] == "file":
+        # optional FrameTracer, frames are marked at push, encoder output and pay0 output
+        self.tracer = tracer
+        # objects with add_frame(name, frame, format) and is_active(), given every raw frame pushed (mosaic)
+        self.frame_listeners = []
+        # pre-encoded files are demuxed and forwarded without decoding or encoding
+        self.passthrough = pipeline_conf["source"].get("passthrough", False) \
+            and pipeline_conf["source"]["type"] in ("file", "file_av")
+        self.loop = pipeline_conf["source"].get("loop", pipeline_conf["source"]["type"] != "file_av")
+        if self.loop and pipeline_conf["source"]["type"] == "file_av":
+            # the audio+video media pipeline is run by the rtsp media, it has no segment seek (see loop_file())
+            logger.warning(f"[{self.name}] file_av sources do not loop, the stream ends with the file")
+            self.loop = False
+        self.file_loops = 0
+        # set while a looping passthrough file prerolls, see start_file()
+        self.file_seek_pending = False
+
+        if pipeline_conf["source"]["type"] == "file" and self.passthrough:
+            self.cap = None
+            self.location = pipeline_conf["source"]["location"]
+        elif pipeline_conf["source"]["type"] == "file":
             self.cap = cv2.VideoCapture(pipeline_conf["source"]["location"])
         elif pipeline_conf["source"]["type"] == "webcam":
             self.cap = cv2.VideoCapture(0)
@@ -32,75 +69,324 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
             logging.info(f"[{self.name}] Connecting to oakd camera capture")
         elif pipeline_conf["source"]["type"] == "file_av":
             self.cap = None
+        elif pipeline_conf["source"]["type"] == "mosaic":
+            # frames composited from the other streams, see mosaic.py
+            self.cap = None
         else:
             logging.warning(f"[{self.name}] Invalid configuration for SensoryFactory")
             raise RuntimeError
 
+        # "raw": BGR frames encoded here, "h264": access units already encoded on the device
+        self.encoding = "h264" if self.passthrough else pipeline_conf["source"].get("encoding", "raw")
+        if self.encoding not in ("raw", "h264") or (self.encoding == "h264" and self.cap is not None):
+            logging.warning(f"[{self.name}] Invalid encoding ({self.encoding}) for SensoryFactory")
+            raise RuntimeError
+        # raw frame layout pushed to appsrc, NV12/I420 frames reach the encoder without a colour conversion
+        self.format = pipeline_conf["source"].get("format", "BGR")
+        if self.format not in yuv.FRAME_FORMATS or (self.format != "BGR" and self.cap is not None):
+            logging.warning(f"[{self.name}] Invalid format ({self.format}) for SensoryFactory")
+            raise RuntimeError
+
         self.run_flag = True
         self.number_frames = 0
         self.fps = pipeline_conf["fps"]
         self.width = pipeline_conf["width"]
         self.height = pipeline_conf["height"]
         self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
+        # x264enc/openh264enc settings for raw sources, "auto" is resolved by GstServer (see encoder_profiles.py)
+        self.encoder_profile = pipeline_conf.get("encoder") or DEFAULT_PROFILE
+        # videoconvert threads when the source format is not an encoder input format, 0 uses every core
+        self.convert_threads = pipeline_conf.get("convert_threads", 0)
+        # wrap numpy frames in GstBuffers instead of copying them (falls back to copying if unavailable)
+        self.zero_copy = pipeline_conf.get("zero_copy", True) and zero_copy_available()
+        self.bytes_copied = 0
+        # preallocated frames that callers resize into, recycled when GStreamer releases them
+        self.frame_pool = None
+        if self.zero_copy and self.encoding == "raw":
+            self.frame_pool = FramePool(yuv.frame_shape(self.format, self.width, self.height),
+                                        size=pipeline_conf.get("pool_size", 4))
         logger.info(
             f"[{pipeline_conf['name']}] Setting configs: fps={self.fps}, width={self.width}, height={self.height}")
 
-        # create objects for RTSP pipeline
-        self.pipeline = self.create_rtsp_pipeline(pipeline_conf["source"])
-        self.source = self.pipeline.get_by_name("source")
-
-        # create objects for recording pipeline
-        self.record_pipeline = self.create_filesink_pipeline()
-        self.record_source = self.record_pipeline.get_by_name("source_record")
-        self.record_loop = None
-        self.record_bus = None
-        self.record_thread = Thread(target=self.record, daemon=True)
+        # bounded appsrc queue: block the pushing thread, or drop the oldest/newest frame when it is full
+        # encoded access units vary in size, budget them as a generous worst case (keyframes)
+        if self.encoding == "raw":
+            self.frame_bytes = yuv.frame_bytes(self.format, self.width, self.height)
+        else:
+            self.frame_bytes = self.width * self.height // 2
+        self.backpressure = self.load_backpressure(pipeline_conf.get("backpressure", {}))
+        self.pushed_frames = 0
+        self.dropped_frames = 0
+        self.blocked_pushes = 0
+
+        # every access unit sent over rtsp carries the frame's seq_num and capture time in an SEI (see sei.py),
+        # looked up by pts in the bridge. Frames of a passthrough file have neither, they are sent as they are.
+        self.sei = pipeline_conf.get("sei", True) and not self.passthrough
+        self.sei_frames = 0
+        # seq_num -> capture time (CLOCK_MONOTONIC ns) of frames on their way to push(), see stamp()
+        self.capture_times = OrderedDict()
+        # pts -> (seq_num, capture wall clock ns) of pushed frames, until the encoder outputs them
+        self.frame_meta = OrderedDict()
+        self.meta_lock = Lock()
+
+        # file/webcam frames are decoded on a prefetch thread, need-data only dequeues them
+        self.prefetcher = None
+        self.last_frame = None
+        if self.cap is not None:
+            self.prefetcher = FramePrefetcher(self.cap, self.name,
+                                              depth=pipeline_conf["source"].get("prefetch", 4),
+                                              loop=pipeline_conf["source"].get("loop", True),
+                                              live=pipeline_conf["source"]["type"] == "webcam")
+
+        # recording shares the encoded stream with rtsp, see create_encoder_pipeline_string()
+        self.recording = pipeline_conf.get("recording", {"enabled": False})
+        self.recorder = None
+        self.pre_event = None
+        if self.recording.get("enabled", False) and self.recording.get("segment_seconds", 60) > 0:
+            self.recorder = SegmentRecorder(self.name, self.recording, on_recorded=on_recorded, keep=keep_recording,
+                                            on_dropped=drop_recording)
+        if self.recording.get("enabled", False) and self.recording.get("pre_event_seconds", 0) > 0:
+            self.pre_event = PreEventBuffer(self.name, self.recording, on_recorded=on_recorded, keep=keep_recording,
+                                            on_dropped=drop_recording)
+
+        # on demand: the encoder pipeline only runs while an rtsp media is prepared, recording keeps it running
+        self.on_demand = pipeline_conf.get("on_demand", True) and not self.recording.get("enabled", False)
+        self.idle_timeout = pipeline_conf.get("idle_timeout", 10)
+        self.running = False
+        self.media_count = 0
+        self.idle_timer = None
+
+        # the RTSP pipeline is created per media, see do_create_element()
+        self.source_conf = pipeline_conf["source"]
+        self.pipeline = None
+        self.rtsp_source = None
+        self.rtsp_pts_base = None
+        # the bridge never drops single access units: past this many bytes queued for a slow media it skips to
+        # the next keyframe (asking the encoder for one), so clients only ever miss whole GOPs
+        self.bridge_max_bytes = pipeline_conf.get("bridge_max_bytes", 8 * 1024 ** 2)
+        self.skip_to_keyframe = False
+        self.dropped_gops = 0
+
+        # raw frames are converted and encoded once, the encoded stream is fanned out with a tee
+        self.encoder_pipeline = None
+        self.source = None
+        if pipeline_conf["source"]["type"] != "file_av":
+            self.encoder_pipeline = self.create_encoder_pipeline()
+            self.source = self.encoder_pipeline.get_by_name("source")
+            self.encoded_sink = self.encoder_pipeline.get_by_name("rtsp_sink")
+            self.encoded_sink.connect("new-sample", self.on_encoded_sample)
+            if self.cap is not None:
+                self.source.connect('need-data', self.on_need_data)
+            for branch in (self.recorder, self.pre_event):
+                if branch is not None:
+                    branch.attach(self.encoder_pipeline)
+            self.bus = self.encoder_pipeline.get_bus()
+            self.bus.add_signal_watch()
+            self.bus.connect("message", self.bus_call)
+            if self.tracer is not None:
+                encoder_name = "encoder" if self.encoding == "raw" else "enc_parse"
+                encoder_pad = self.encoder_pipeline.get_by_name(encoder_name).get_static_pad("src")
+                encoder_pad.add_probe(Gst.PadProbeType.BUFFER, self.on_encoded_probe)
+
+    def start(self):
+        if self.on_demand:
+            logger.info(f"[{self.name}] Encoder pipeline starts with the first client")
+            return
+        self.start_pipeline()
 
-    def record(self):
+    def start_pipeline(self):
+        """ called from the rtsp configure callback on the main loop: never blocks, never raises """
+        if self.encoder_pipeline is None or self.running:
+            return
+        # timestamps restart with the running time of the restarted pipeline
+        self.number_frames = 0
+        self.last_frame = None
         try:
-            logger.info()
-            self.record_pipeline.set_state(Gst.State.PLAYING)
-            self.record_loop.run()
-        except Exception as RecordingException:
-            logger.error(f"{__file__} [record] error: {RecordingException}")
-        finally:
-            self.record_pipeline.set_state(Gst.State.NULL)
+            if self.prefetcher is not None:
+                self.prefetcher.resume()
+                self.prefetcher.start()
+            if self.passthrough:
+                logger.info(f"[{self.name}] Starting file passthrough pipeline")
+                self.start_file()
+            else:
+                logger.info(f"[{self.name}] Starting encoder pipeline")
+                if self.encoder_pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+                    raise RuntimeError("encoder pipeline could not go to PLAYING")
+        except Exception as StartError:
+            logger.error(f"[{self.name}] Could not start the encoder pipeline: {StartError}")
+            self.encoder_pipeline.set_state(Gst.State.NULL)
+            return
+        self.running = True
 
-    def stop_record(self):
-        self.record_pipeline.send_event(Gst.event_new_eos())
+    def stop_pipeline(self):
+        if not self.running:
+            return
+        logger.info(f"[{self.name}] Stopping idle encoder pipeline")
+        # pushers check running first, frames still queued are released with the pipeline
+        self.running = False
+        self.file_seek_pending = False
+        if self.prefetcher is not None:
+            self.prefetcher.pause()
+        self.encoder_pipeline.set_state(Gst.State.NULL)
+
+    def is_active(self):
+        """
+        @return: False while an on demand mount has no client and no active frame listener, frames for it can be
+        skipped before any work
+        """
+        return self.running or any(listener.is_active() for listener in self.frame_listeners)
+
+    def add_frame_listener(self, listener):
+        self.frame_listeners.append(listener)
+
+    def notify_frame_listeners(self, frame):
+        if self.encoding != "raw":
+            return
+        for listener in self.frame_listeners:
+            try:
+                listener.add_frame(self.name, frame, self.format)
+            except Exception as ListenerError:
+                logger.error(f"[{self.name}] Frame listener failed: {ListenerError}")
+
+    def start_file(self):
+        if not self.loop:
+            self.encoder_pipeline.set_state(Gst.State.PLAYING)
+            return
+        # a segment seek ends every pass with SEGMENT_DONE instead of EOS, see loop_file(). Seeking needs the
+        # prerolled pipeline, the seek and PLAYING follow its ASYNC_DONE (see bus_call), the main loop never waits
+        self.file_seek_pending = True
+        if self.encoder_pipeline.set_state(Gst.State.PAUSED) == Gst.StateChangeReturn.FAILURE:
+            self.file_seek_pending = False
+            raise RuntimeError("file pipeline could not go to PAUSED")
+
+    def on_file_prerolled(self):
+        self.file_seek_pending = False
+        self.encoder_pipeline.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.SEGMENT, 0)
+        self.encoder_pipeline.set_state(Gst.State.PLAYING)
+
+    def loop_file(self):
+        # non-flushing: the running time carries on from the previous pass, timestamps downstream stay monotonic
+        self.file_loops += 1
+        logger.debug(f"[{self.name}] Restarting file (loop={self.file_loops})")
+        self.encoder_pipeline.seek_simple(Gst.Format.TIME, Gst.SeekFlags.SEGMENT, 0)
+
+    def trigger_recording(self, location=None):
+        """
+        Write the pre-event buffer (the last pre_event_seconds of encoded video) to disk.
+        @return: the file written to, or None
+        """
+        if self.pre_event is None:
+            logger.warning(f"[{self.name}] Pre-event recording is not enabled")
+            return None
+        return self.pre_event.trigger(location)
 
-    def setup_recording_pipeline(self):
-        self.record_pipeline = self.create_filesink_pipeline()
-        self.record_source = self.record_pipeline.get_by_name("source_record")
-        self.record_loop = GObject.MainLoop()
-        self.record_bus = self.record_pipeline.get_bus()
-        self.record_bus.add_signal_watch()
-        self.record_bus.connect("message", self.bus_call, self.record_loop)
+    def stop_record(self):
+        # EOS only on the recording branch so the muxer finalises the segment while rtsp keeps streaming
+        record_queue = self.encoder_pipeline.get_by_name("record_queue") if self.encoder_pipeline else None
+        if record_queue is None:
+            logger.warning(f"[{self.name}] Recording is not enabled")
+            return
+        record_queue.get_static_pad("sink").send_event(Gst.Event.new_eos())
 
-    def bus_call(bus, message, loop):
+    def bus_call(self, bus, message):
         t = message.type
         if t == Gst.MessageType.EOS:
-            logger.info("End-of-stream\n")
-            loop.quit()
+            logger.info(f"[{self.name}] End-of-stream\n")
+        elif t == Gst.MessageType.SEGMENT_DONE and self.passthrough:
+            self.loop_file()
+        elif t == Gst.MessageType.ASYNC_DONE and self.file_seek_pending:
+            self.on_file_prerolled()
+        elif t == Gst.MessageType.ELEMENT and self.recorder is not None:
+            structure = message.get_structure()
+            if structure is not None and structure.get_name() == "splitmuxsink-fragment-closed":
+                self.recorder.on_fragment_closed(structure.get_string("location"))
         elif t == Gst.MessageType.WARNING:
             err, debug = message.parse_warning()
-            logger.warning("Warning: %s: %s\n" % (err, debug))
+            logger.warning(f"[{self.name}] Warning: {err}: {debug}\n")
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
-            logger.error("Error: %s: %s\n" % (err, debug))
-            loop.quit()
+            logger.error(f"[{self.name}] Error: {err}: {debug}\n")
         return True
 
+    def load_backpressure(self, conf):
+        _log_prefix = f"[{self.name}.load_backpressure]\n-- "
+        policy = conf.get("policy", "block")
+        if policy not in BACKPRESSURE_POLICIES:
+            logger.error(f"{_log_prefix} Invalid backpressure policy ({policy}), "
+                         f"expected one of {BACKPRESSURE_POLICIES}")
+            raise RuntimeError
+        if self.encoding == "h264" and policy != "block":
+            # a dropped access unit corrupts every frame up to the next keyframe, encoded streams always block
+            logger.warning(f"{_log_prefix} Backpressure policy ({policy}) does not apply to encoded streams, "
+                           f"using block")
+            policy = "block"
+
+        max_buffers = conf.get("max_buffers", 2)
+        max_bytes = conf.get("max_bytes", 0)
+        # appsrc only limits bytes before 1.20, express the buffer limit in bytes as well (frames are fixed size)
+        limits = [limit for limit in (max_bytes, max_buffers * self.frame_bytes) if limit > 0]
+        max_bytes = min(limits) if limits else 0
+
+        leaky = policy != "block" and appsrc_has_property("leaky-type")
+        if policy == "drop-oldest" and not leaky:
+            logger.warning(f"{_log_prefix} appsrc has no leaky-type (GStreamer < 1.20), using drop-newest")
+            policy = "drop-newest"
+
+        return {"policy": policy, "max_bytes": max_bytes, "leaky": leaky}
+
+    def create_src_properties(self):
+        properties = f"do-timestamp=true is-live=true format=time max-bytes={self.backpressure['max_bytes']} " \
+                     f"block={'true' if self.backpressure['policy'] == 'block' else 'false'}"
+        if self.backpressure["leaky"]:
+            leaky_type = "downstream" if self.backpressure["policy"] == "drop-oldest" else "upstream"
+            properties += f" leaky-type={leaky_type}"
+        return properties
+
     def create_src_caps(self):
-        src_caps = f"do-timestamp=true is-live=true block=true format=GST_FORMAT_TIME" \
-                   f"caps=" \
-                   f"video/x-raw," \
-                   f"format=BGR," \
+        if self.encoding == "h264":
+            # the picture size comes from the SPS of the device bitstream
+            return f"video/x-h264,stream-format=byte-stream,alignment=au,framerate=(fraction){self.fps}/1"
+        src_caps = f"video/x-raw," \
+                   f"format={self.format}," \
                    f"width=(int){self.width}," \
                    f"height=(int){self.height}," \
                    f"framerate=(fraction){self.fps}/1"
         return src_caps
 
+    def admit_frame(self):
+        """
+        Applies the backpressure policy before a push.
+        @return: False if the frame has to be dropped (drop-newest)
+        """
+        max_bytes = self.backpressure["max_bytes"]
+        if max_bytes == 0:
+            return True
+        if self.source.get_property("current-level-bytes") + self.frame_bytes <= max_bytes:
+            return True
+
+        policy = self.backpressure["policy"]
+        if policy == "block":
+            self.blocked_pushes += 1
+            return True
+        # drop-oldest: the leaky appsrc discards its oldest queued frame to make room for this one
+        self.dropped_frames += 1
+        return policy == "drop-oldest"
+
+    def stats(self):
+        return {
+            "pushed_frames": self.pushed_frames,
+            "dropped_frames": self.dropped_frames,
+            "blocked_pushes": self.blocked_pushes,
+            "queued_bytes": self.source.get_property("current-level-bytes") if self.source else 0,
+            "bytes_copied": self.bytes_copied,
+            "prefetch": self.prefetcher.stats() if self.prefetcher else None,
+            "file_loops": self.file_loops,
+            "sei_frames": self.sei_frames,
+            "dropped_gops": self.dropped_gops,
+            "recording": self.recorder.stats() if self.recorder else None,
+            "pre_event": self.pre_event.stats() if self.pre_event else None,
+        }
+
     @staticmethod
     def create_unix_timestamp():
         date = datetime.utcnow()
@@ -108,39 +394,56 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         return utc_time
 
     def create_rtsp_pipeline_string(self):
-        src = f"appsrc name=source {self.create_src_caps()} "
+        # the rtsp media only payloads the stream encoded by the encoder pipeline
+        src = "appsrc name=rtsp_source is-live=true format=time " \
+              "caps=video/x-h264,stream-format=byte-stream,alignment=au "
         launch_string = f"{src} " \
-                        "! videoconvert name=rtsp_vid_convert ! video/x-raw,format=I420 " \
-                        "! x264enc name=rtsp_x264 speed-preset=fast tune=zerolatency " \
+                        "! h264parse name=rtsp_parse " \
                         "! rtph264pay config-interval=1 name=pay0 pt=96"
         return launch_string
 
-    def create_file_sink_string(self):
-        now = self.create_unix_timestamp()
-        file = f"/tmp/{now}-{self.name}_recording.ts"
-
-        src = f"appsrc name=source_record {self.create_src_caps()} "
+    def create_encoder_pipeline_string(self):
+        if self.passthrough:
+            # the file's own H.264 stream, parsebin picks the demuxer for the container
+            src = f"filesrc location={self.location} ! parsebin name=file_parse ! video/x-h264 "
+        else:
+            src = f"appsrc name=source {self.create_src_properties()} caps={self.create_src_caps()} "
+        # pull sources (files/webcam) are paced by the sink clock, pushed camera frames are not held back
+        sync = "true" if self.cap is not None or self.passthrough else "false"
+        encoder = ""
+        if self.encoding == "raw":
+            # videoconvert passes through when the source already has the encoder input format
+            encoder = f"! videoconvert name=vid_convert n-threads={self.convert_threads} " \
+                      f"! video/x-raw,format={encoder_input_format(self.encoder_profile, self.format)} " \
+                      f"! {encoder_launch_string(self.encoder_profile)} "
         launch_string = f"{src} " \
-                        "! videoconvert name=record_convert ! video/x-raw,format=I420 " \
-                        "! x264enc name=record_x264 speed-preset=fast tune=zerolatency " \
-                        "! queue name=record_videoQ leaky=1" \
-                        "! mpegtsmux name=record_mux " \
-                        f"! filesink location={file} " \
-                        "! pulsesrc " \
-                        "! audioconvert " \
-                        "! avenc_aac " \
-                        "! queue leaky=1 name=name=record_audioQ " \
-                        " record_mux."
-
+                        f"{encoder}" \
+                        "! h264parse name=enc_parse ! video/x-h264,stream-format=byte-stream,alignment=au " \
+                        "! tee name=enc_tee " \
+                        "enc_tee. ! queue name=rtsp_queue max-size-buffers=30 " \
+                        f"! appsink name=rtsp_sink emit-signals=true sync={sync} max-buffers=30 drop=false "
+        for branch in self.create_encoded_branches():
+            launch_string += f"enc_tee. ! {branch} "
         return launch_string
 
+    def create_encoded_branches(self):
+        """
+        Extra consumers of the encoded stream, each one is linked to a request pad of enc_tee
+        """
+        return [branch.branch() for branch in (self.recorder, self.pre_event) if branch is not None]
+
     @staticmethod
-    def two_way_call(video_path):
+    def two_way_call(video_path, passthrough=False):
         logger.info(f"{__file__} reading from file {video_path} ")
         src = f"filesrc location={video_path}"
         demux = "qtdemux name=demux mpegtsmux name=mux alignment=7"
-        video_branch = "queue leaky=1 ! h264parse ! avdec_h264 ! x264enc"
-        audio_branch = "queue leaky=1 ! mpegaudioparse !  mpg123audiodec !  audioconvert !  avenc_aac"
+        if passthrough:
+            # mpegtsmux takes the H.264 and mp3 streams as they are
+            video_branch = "queue leaky=1 ! h264parse"
+            audio_branch = "queue leaky=1 ! mpegaudioparse"
+        else:
+            video_branch = "queue leaky=1 ! h264parse ! avdec_h264 ! x264enc"
+            audio_branch = "queue leaky=1 ! mpegaudioparse !  mpg123audiodec !  audioconvert !  avenc_aac"
 
         launch_string = f" {src} ! {demux} ! tee name=v_t v_t. ! rtpmp2tpay name=pay0 " \
                         f"demux. ! {video_branch}  " \
@@ -153,17 +456,57 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def create_rtsp_pipeline(self, src):
         logger.info(f"{__file__} creating rtsp stream for {src}")
         if src['type'] == "file_av":
-            launch_string = self.two_way_call(src['location'])
+            launch_string = self.two_way_call(src['location'], self.passthrough)
         else:
             launch_string = self.create_rtsp_pipeline_string()
         return Gst.parse_launch(launch_string)
 
-    def create_filesink_pipeline(self):
-        logger.info(f"{__file__} creating filesink pipeline for {self.name} ")
-        launch_string = self.create_file_sink_string()
+    def create_encoder_pipeline(self):
+        logger.info(f"{__file__} creating encoder pipeline for {self.name} ")
+        launch_string = self.create_encoder_pipeline_string()
         return Gst.parse_launch(launch_string)
 
-    def push(self, frame=None, src_name=None):
+    def acquire_frame(self):
+        """
+        @return: (pool_index, frame) to write the next output frame into, or (None, None) if no pool frame is free
+        """
+        if self.frame_pool is None:
+            return None, None
+        return self.frame_pool.acquire()
+
+    def release_frame(self, pool_index, on_release=None):
+        if pool_index is not None:
+            self.frame_pool.release(pool_index)
+        if on_release is not None:
+            on_release()
+
+    def stamp(self, seq_num, capture_ns):
+        """
+        Record the capture time (CLOCK_MONOTONIC ns, as depthai timestamps) of a frame that reaches push()
+        later through the frame processor
+        """
+        if not self.sei:
+            return
+        with self.meta_lock:
+            self.capture_times[seq_num] = capture_ns
+            while len(self.capture_times) > 256:
+                self.capture_times.popitem(last=False)
+
+    def bind_frame_meta(self, timestamp, seq_num, capture_ns):
+        with self.meta_lock:
+            if capture_ns is None:
+                capture_ns = self.capture_times.pop(seq_num, None)
+            # frames without a capture time (files, webcam) are stamped when pushed
+            wall_ns = time_ns() if capture_ns is None else time_ns() - (monotonic_ns() - capture_ns)
+            self.frame_meta[timestamp] = (seq_num, wall_ns)
+            while len(self.frame_meta) > 256:
+                self.frame_meta.popitem(last=False)
+
+    def push(self, frame=None, src_name=None, pool_index=None, seq_num=None, on_release=None, capture_ns=None):
+        """
+        `on_release` is called once the frame memory is no longer used (e.g. a shared memory slot can be reused)
+        `capture_ns`: capture time of the frame (CLOCK_MONOTONIC ns), otherwise the one given to stamp()
+        """
         _log_prefix = f"[push({src_name})]\n-- "
         assert frame is not None
         assert src_name is not None
@@ -171,60 +514,204 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         if self.number_frames % 100 == 0 or self.number_frames == 0:
             logger.debug(f"{_log_prefix} src=({src_name}) count=({self.number_frames})")
 
+        if not self.running:
+            # on demand mount without clients, the frame may still be tiled into a mosaic
+            self.notify_frame_listeners(frame)
+            self.release_frame(pool_index, on_release)
+            return
         if not self.run_flag:
             msg = f"{_log_prefix} self.run_flag is false, therefore the pipeline is down"
             logger.warning(msg)
+            self.release_frame(pool_index, on_release)
             GstApp.AppSrc.end_of_stream(self.source)
-            self.pipeline.send_event(Gst.event_new_eos())
             return
         try:
-            data = frame.tobytes()
-            buf = Gst.Buffer.new_allocate(None, len(data), None)
-            buf.fill(0, data)
-            buf.duration = self.duration
-            timestamp = self.number_frames * self.duration
-            buf.pts = buf.dts = int(timestamp)
-            buf.offset = timestamp
-            self.number_frames += 1
-            rtsp_retval = self.source.emit('push-buffer', buf)
-            if rtsp_retval != Gst.FlowReturn.OK:
-                logger.error(f"Could not push buffer to rtsp pipeline: error_code={rtsp_retval}")
-            logger.info(f"pushed buffer, "
-                         f"frame {self.number_frames}, "
-                         f"duration {self.duration} ns, "
-                         f"durations {self.duration / Gst.SECOND} s ")
-
+            self.push_frame(frame, pool_index, seq_num, on_release, capture_ns)
         except Exception as VideoSrcError:
             logger.error(f"{_log_prefix} VideoSrcError {VideoSrcError}")
             raise VideoSrcError
 
+    def push_frame(self, frame, pool_index=None, seq_num=None, on_release=None, capture_ns=None):
+        timestamp = int(self.number_frames * self.duration)
+        seq_num = self.number_frames if seq_num is None else seq_num
+        if self.frame_listeners:
+            self.notify_frame_listeners(frame)
+        if self.sei:
+            self.bind_frame_meta(timestamp, seq_num, capture_ns)
+        if self.tracer is not None:
+            self.tracer.mark(self.name, seq_num, "push")
+            self.tracer.bind_pts(self.name, seq_num, timestamp)
+        if not self.admit_frame():
+            # the frame keeps its slot on the timeline so later timestamps stay in real time
+            self.release_frame(pool_index, on_release)
+            self.number_frames += 1
+            return Gst.FlowReturn.OK
+        if pool_index is not None:
+            rtsp_retval, copied = self.frame_pool.push(self.source, pool_index, timestamp, int(self.duration),
+                                                       self.number_frames)
+        elif self.zero_copy:
+            rtsp_retval, copied = push_ndarray(self.source, frame, timestamp, int(self.duration), self.number_frames,
+                                               on_release=on_release)
+        else:
+            rtsp_retval, copied = push_copy(self.source, frame, timestamp, int(self.duration), self.number_frames)
+            self.release_frame(None, on_release)
+        self.bytes_copied += copied
+        self.number_frames += 1
+        self.pushed_frames += 1
+        if rtsp_retval != Gst.FlowReturn.OK:
+            logger.error(f"Could not push buffer to rtsp pipeline: error_code={rtsp_retval}")
+        logger.debug(f"pushed buffer, "
+                     f"frame {self.number_frames}, "
+                     f"duration {self.duration} ns, "
+                     f"bytes copied {copied}")
+        return rtsp_retval
+
     def on_need_data(self, src, dummy):
-        if self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if ret:
-                data = frame.tobytes()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                buf.fill(0, data)
-                buf.duration = self.duration
-                timestamp = self.number_frames * self.duration
-                buf.pts = buf.dts = int(timestamp)
-                buf.offset = timestamp
-                self.number_frames += 1
-                rtsp_retval = self.source.emit('push-buffer', buf)
-                if rtsp_retval != Gst.FlowReturn.OK:
-                    logger.error(f"Could not push buffer to rtsp pipeline: error_code={rtsp_retval}")
-                logger.info(f"pushed buffer, "
-                             f"frame {self.number_frames}, "
-                             f"duration {self.duration} ns, "
-                             f"durations {self.duration / Gst.SECOND} s ")
+        # never decodes here, a slow read must not stall the pipeline thread
+        timeout = self.duration / Gst.SECOND
+        frame = self.prefetcher.get(timeout)
+        while frame is None and self.last_frame is None and self.running and self.prefetcher.run_flag:
+            # appsrc waits for a buffer after need-data, keep waiting for the first frame
+            frame = self.prefetcher.get(timeout)
+        if frame is END_OF_STREAM:
+            GstApp.AppSrc.end_of_stream(self.source)
+            return
+        if frame is None:
+            # decoder underrun: repeat the last frame so the stream keeps its frame rate
+            frame = self.last_frame
+            if frame is None:
+                return
+        self.last_frame = frame
+        self.push_frame(frame)
+
+    def on_encoded_sample(self, appsink):
+        """
+        Bridges the shared encoded stream into the rtsp media pipeline while a media is prepared
+        """
+        sample = appsink.emit("pull-sample")
+        if sample is None:
+            return Gst.FlowReturn.EOS
+        rtsp_source = self.rtsp_source
+        if rtsp_source is None:
+            return Gst.FlowReturn.OK
+
+        buf = sample.get_buffer()
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.FlowReturn.OK
+        # running time rather than pts: a looping file restarts its pts on every pass
+        running_time = sample.get_segment().to_running_time(Gst.Format.TIME, buf.pts)
+        if self.rtsp_pts_base is None:
+            # a new media starts at the next keyframe, with timestamps rebased to its running time
+            if buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                return Gst.FlowReturn.OK
+            self.rtsp_pts_base = running_time
+        if running_time < self.rtsp_pts_base:
+            return Gst.FlowReturn.OK
+        if self.skip_to_keyframe:
+            if buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                return Gst.FlowReturn.OK
+            self.skip_to_keyframe = False
+        elif rtsp_source.get_property("current-level-bytes") > self.bridge_max_bytes:
+            self.skip_to_keyframe = True
+            self.dropped_gops += 1
+            logger.warning(f"[{self.name}] rtsp media is {rtsp_source.get_property('current-level-bytes')} bytes "
+                           f"behind, skipping to the next keyframe")
+            self.request_keyframe()
+            return Gst.FlowReturn.OK
+
+        meta = None
+        if self.sei:
+            with self.meta_lock:
+                meta = self.frame_meta.pop(buf.pts, None)
+        if meta is not None:
+            out = self.insert_sei(buf, sei.frame_meta_nal(*meta))
+            self.sei_frames += 1
+        else:
+            # shallow copy, the encoded memory is shared with the other tee branches
+            out = buf.copy()
+        out.pts = running_time - self.rtsp_pts_base
+        out.dts = Gst.CLOCK_TIME_NONE
+        rtsp_source.emit("push-buffer", out)
+        return Gst.FlowReturn.OK
+
+    @staticmethod
+    def insert_sei(buf, nal):
+        """
+        @return: a buffer with the SEI `nal` before the first slice of the access unit `buf`, sharing its slices
+        """
+        size = buf.get_size()
+        head = buf.extract_dup(0, min(size, sei.HEAD_BYTES))
+        offset = sei.vcl_offset(head)
+        if offset is None and len(head) < size:
+            head = buf.extract_dup(0, size)
+            offset = sei.vcl_offset(head)
+        if offset is None:
+            return buf.copy()
+        out = Gst.Buffer.new_wrapped(head[:offset] + nal)
+        out = out.append(buf.copy_region(Gst.BufferCopyFlags.MEMORY, offset, size - offset))
+        out.set_flags(buf.get_flags())
+        out.duration = buf.duration
+        return out
+
+    def on_encoded_probe(self, pad, info):
+        self.tracer.mark_pts(self.name, info.get_buffer().pts, "encoded")
+        return Gst.PadProbeReturn.OK
+
+    def on_payloaded_probe(self, pad, info):
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            buf = info.get_buffer_list().get(0)
+        else:
+            buf = info.get_buffer()
+        pts_base = self.rtsp_pts_base
+        if buf is not None and pts_base is not None:
+            # undo the rebasing done in on_encoded_sample
+            self.tracer.mark_pts(self.name, buf.pts + pts_base, "payloaded")
+        return Gst.PadProbeReturn.OK
+
+    def request_keyframe(self):
+        if self.encoder_pipeline is None:
+            return
+        event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+        self.encoded_sink.send_event(event)
+
+    def on_media_unprepared(self, rtsp_media):
+        logger.info(f"[{self.name}] rtsp media unprepared")
+        if rtsp_media.get_element().get_by_name("rtsp_source") is self.rtsp_source:
+            self.rtsp_source = None
+        self.media_count -= 1
+        if self.on_demand and self.media_count == 0:
+            self.idle_timer = GLib.timeout_add_seconds(self.idle_timeout, self.on_idle_timeout)
+
+    def on_idle_timeout(self):
+        self.idle_timer = None
+        if self.media_count == 0:
+            self.stop_pipeline()
+        return False
 
     def do_create_element(self, url):
+        # a new element per media, the previous one is owned by its (possibly unpreparing) media
+        self.pipeline = self.create_rtsp_pipeline(self.source_conf)
         return self.pipeline
 
     def do_configure(self, rtsp_media):
-        self.number_frames = 0
-        if self.cap is not None:
-            self.source.connect('need-data', self.on_need_data)
+        if self.encoder_pipeline is None:
+            return
+        # the media is shared by all clients of the mount, it is unprepared after the last one leaves
+        self.media_count += 1
+        if self.idle_timer is not None:
+            GLib.source_remove(self.idle_timer)
+            self.idle_timer = None
+        self.start_pipeline()
+        self.rtsp_pts_base = None
+        self.skip_to_keyframe = False
+        element = rtsp_media.get_element()
+        self.rtsp_source = element.get_by_name("rtsp_source")
+        rtsp_media.connect("unprepared", self.on_media_unprepared)
+        if self.tracer is not None:
+            element.get_by_name("pay0").get_static_pad("src").add_probe(
+                Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, self.on_payloaded_probe)
+        # new clients should not wait for the next scheduled keyframe
+        self.request_keyframe()
 
     def link_to_filesink(self, gst_object, pad, u_data):
         now = self.create_unix_timestamp()
@@ -244,7 +731,13 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
 
 
 class GstServer(GstRtspServer.RTSPServer):
-    def __init__(self, server_conf, **properties):
+    def __init__(self, server_conf, tracer=None, on_recorded=None, keep_recording=None, drop_recording=None,
+                 **properties):
+        """
+        on_recorded: called with the path of every finished recording file (segments and events)
+        keep_recording: called with a recording path before the disk quota deletes it, True keeps the file
+        drop_recording: called with a kept recording deleted anyway, over the quota's hard limit
+        """
         super(GstServer, self).__init__(**properties)
         Gst.init(None)
         # Set basic server configs
@@ -258,18 +751,75 @@ class GstServer(GstRtspServer.RTSPServer):
         # configure camera streams
         self.pipelines = []
         pipeline_conf = server_conf["pipeline_conf"]
+        raw_streams = sum(1 for conf in pipeline_conf
+                          if conf["source"]["type"] != "file_av" and not conf["source"].get("passthrough", False)
+                          and conf["source"].get("encoding", "raw") == "raw")
         for conf in pipeline_conf:
-            appsrc = SensorFactory(conf)
+            if conf.get("encoder") == "auto":
+                # all raw streams share the cpu, a profile has to keep up with every one of them
+                conf = dict(conf, encoder=calibrate(conf["width"], conf["height"], conf["fps"], streams=raw_streams))
+            appsrc = SensorFactory(conf, tracer=tracer, on_recorded=on_recorded, keep_recording=keep_recording,
+                                   drop_recording=drop_recording)
             appsrc.set_shared(True)
             self.mount_points.add_factory(conf["extension"], appsrc)
             logger.info(f"Stream available: {server_conf['ip_address']}:{server_conf['port']}{conf['extension']}")
             self.pipelines.append(appsrc)
+            appsrc.start()
+
+        # optional mount tiling every raw stream into one encoded canvas
+        self.mosaic = None
+        mosaic_conf = server_conf.get("mosaic", {"enabled": False})
+        if mosaic_conf.get("enabled", False):
+            self.mosaic = self.create_mosaic(mosaic_conf, raw_streams + 1)
+            self.mount_points.add_factory(mosaic_conf["extension"], self.mosaic.factory)
+            logger.info(f"Stream available: {server_conf['ip_address']}:{server_conf['port']}"
+                        f"{mosaic_conf['extension']}")
 
         # attach and continue
         self.attach(None)
         self.loop = GLib.MainLoop()
         self.thread = Thread(target=self.loop.run, daemon=True)
 
+    def create_mosaic(self, mosaic_conf, raw_streams):
+        conf = {
+            "name": mosaic_conf.get("name", "mosaic"),
+            "fps": mosaic_conf.get("fps", 15),
+            "width": mosaic_conf.get("width", 1920),
+            "height": mosaic_conf.get("height", 1080),
+            "source": {"type": "mosaic", "format": "BGR"},
+            "on_demand": mosaic_conf.get("on_demand", True),
+            "idle_timeout": mosaic_conf.get("idle_timeout", 10),
+            "backpressure": mosaic_conf.get("backpressure", {"policy": "drop-oldest", "max_buffers": 2}),
+            "encoder": mosaic_conf.get("encoder"),
+            "extension": mosaic_conf["extension"],
+        }
+        if conf["encoder"] == "auto":
+            conf["encoder"] = calibrate(conf["width"], conf["height"], conf["fps"], streams=raw_streams)
+        factory = SensorFactory(conf)
+        factory.set_shared(True)
+        # tiles every stream unless "cameras" lists the ones to show (in grid order)
+        names = mosaic_conf.get("cameras") or [pipeline.name for pipeline in self.pipelines]
+        by_name = {pipeline.name: pipeline for pipeline in self.pipelines}
+        sources = [by_name[name] for name in names if name in by_name]
+        compositor = MosaicCompositor(factory, sources, mosaic_conf)
+        factory.start()
+        compositor.start()
+        return compositor
+
+    def stop(self):
+        """ stops the mosaic compositor and its encoder before the application tears down """
+        if self.mosaic is not None:
+            self.mosaic.stop()
+
+    def stats(self):
+        """
+        @return: {camera name: push/drop counters of its SensorFactory}, and the mosaic's if it is enabled
+        """
+        stats = {factory.name: factory.stats() for factory in self.pipelines}
+        if self.mosaic is not None:
+            stats[self.mosaic.factory.name] = dict(self.mosaic.factory.stats(), mosaic=self.mosaic.stats())
+        return stats
+
 
 if __name__ == "__main__":
 
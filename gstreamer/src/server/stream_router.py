@@ -0,0 +1,61 @@
+import logging
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+
+class StreamRouter(object):
+    """
+    Routes devices to streams: device MXID (or PoE ip address) -> camera name from the AppConfig
+    'cameras' map -> SensorFactory of the pipeline_conf entry with that name, which has to be an "oakd" source.
+    Devices are bound once when they are opened, per-frame dispatch is a single dict lookup.
+    """
+
+    def __init__(self, cameras, factories, default_stream=None):
+        assert isinstance(cameras, dict)
+        # device id (mxid or ip address) -> camera name
+        self.device_names = {device_id: name for name, device_id in cameras.items()}
+        self.factories = {factory.name: factory for factory in factories}
+        # stream used by a device that is not in the 'cameras' map, None drops such devices
+        self.default_stream = default_stream
+        # stream_id -> SensorFactory, filled by bind()
+        self.routes = {}
+
+    def bind(self, mxid, ip_address=None):
+        """
+        Resolve the stream for a device before it is opened.
+        @return: stream_id to read the device into, or None if its frames should be dropped
+        """
+        _log_prefix = "[StreamRouter.bind]\n-- "
+
+        stream_id = self.device_names.get(mxid)
+        if stream_id is None and ip_address is not None:
+            stream_id = self.device_names.get(ip_address)
+        if stream_id is None:
+            stream_id = self.default_stream
+            logger.warning(f"{_log_prefix} Device (id={mxid}, ip={ip_address}) is not in the cameras map, "
+                           f"using default stream ({stream_id})")
+        if stream_id is None:
+            return None
+
+        if stream_id in self.routes:
+            # two devices pushing into one appsrc would interleave their timestamps
+            logger.warning(f"{_log_prefix} Stream ({stream_id}) already has a device, dropping (id={mxid})")
+            return None
+
+        factory = self.factories.get(stream_id)
+        if factory is None:
+            logger.warning(f"{_log_prefix} No pipeline_conf entry named ({stream_id}), dropping (id={mxid})")
+            return None
+        if factory.source_conf["type"] != "oakd":
+            # file/webcam/mosaic mounts produce their own frames, a device would interleave with them
+            logger.warning(f"{_log_prefix} Stream ({stream_id}) is a ({factory.source_conf['type']}) source, "
+                           f"not oakd, dropping (id={mxid})")
+            return None
+
+        self.routes[stream_id] = factory
+        logger.info(f"{_log_prefix} Device (id={mxid}, ip={ip_address}) -> stream ({stream_id})")
+        return stream_id
+
+    def route(self, stream_id):
+        return self.routes.get(stream_id)
@@ -0,0 +1,66 @@
+"""
+FramePrefetcher lifecycle without a video file: python3 -m pytest gstreamer/src/server/test_frame_prefetcher.py
+"""
+
+import cv2
+
+from gstreamer.src.server.frame_prefetcher import END_OF_STREAM, FramePrefetcher
+
+
+class FakeCapture(object):
+    """ cv2.VideoCapture stand-in returning `count` numbered frames """
+
+    def __init__(self, count):
+        self.count = count
+        self.position = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        if self.position >= self.count:
+            return False, None
+        self.position += 1
+        return True, self.position
+
+    def set(self, prop, value):
+        assert prop == cv2.CAP_PROP_POS_FRAMES
+        self.position = value
+
+
+def read_until_end(prefetcher):
+    frames = []
+    while True:
+        frame = prefetcher.get(timeout=1)
+        assert frame is not None
+        if frame is END_OF_STREAM:
+            return frames
+        frames.append(frame)
+
+
+def test_restart_after_end_of_file():
+    prefetcher = FramePrefetcher(FakeCapture(3), "test", depth=2, loop=False)
+    prefetcher.start()
+    assert read_until_end(prefetcher) == [1, 2, 3]
+    prefetcher.thread.join(timeout=1)
+    assert not prefetcher.thread.is_alive()
+
+    # the mount went idle and a client reconnects
+    prefetcher.pause()
+    prefetcher.resume()
+    prefetcher.start()
+    assert read_until_end(prefetcher) == [1, 2, 3]
+    prefetcher.stop()
+
+
+def test_restart_after_stop():
+    prefetcher = FramePrefetcher(FakeCapture(100), "test", depth=2, loop=True)
+    prefetcher.start()
+    assert prefetcher.get(timeout=1) == 1
+    prefetcher.stop()
+    prefetcher.thread.join(timeout=1)
+
+    prefetcher.start()
+    assert prefetcher.thread.is_alive()
+    assert prefetcher.get(timeout=1) == 1
+    prefetcher.stop()